@@ -4,9 +4,10 @@ Provides warehouses, bin locations, and batch data for dynamic dropdowns
 """
 from flask import jsonify, request
 from app import app
-from flask_login import login_required
+from flask_login import login_required, current_user
 from sap_integration import SAPIntegration
 import logging
+from item_search import get_item_index, refresh_item_master, refresh_item_master_if_stale
 
 @app.route('/api/warehouses', methods=['GET'])
 @login_required
@@ -166,4 +167,59 @@ def cascading_get_batches():
             'batches': [
                 {'BatchNumber': f'BATCH-{item_code}-001', 'Quantity': 100, 'ExpiryDate': '2025-12-31'}
             ]
-        })
\ No newline at end of file
+        })
+
+
+@app.route('/api/items/search', methods=['GET'])
+@login_required
+def search_items():
+    """Typeahead search over the local item master replica"""
+    try:
+        query = request.args.get('q', '').strip()
+        limit = min(request.args.get('limit', 20, type=int) or 20, 100)
+        warehouse_code = request.args.get('warehouse', '').strip() or None
+
+        if not query:
+            return jsonify({'success': True, 'items': []})
+
+        # Keeps the replica fresh without making this request wait on SAP
+        refresh_item_master_if_stale(app)
+
+        items = get_item_index().search(query, limit=limit, warehouse_code=warehouse_code)
+        return jsonify({
+            'success': True,
+            'items': [{
+                'ItemCode': item['item_code'],
+                'ItemName': item['item_name'],
+                'UoM': item['unit_of_measure'],
+                'ManageSerialNumbers': item['is_serial_managed'],
+                'ManageBatchNumbers': item['is_batch_managed'],
+                'OnHand': item['on_hand'].get(warehouse_code, 0) if warehouse_code else sum(item['on_hand'].values())
+            } for item in items]
+        })
+
+    except Exception as e:
+        logging.error(f"Error in item search API: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/items/sync', methods=['POST'])
+@login_required
+def sync_items():
+    """Pull item master changes from SAP (admin only); pass full=true to resync everything"""
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    try:
+        payload = request.get_json(silent=True) or {}
+        full = str(payload.get('full', request.args.get('full', ''))).lower() in ('1', 'true', 'yes')
+
+        stats = refresh_item_master(full=full)
+        if stats is None:
+            return jsonify({'success': False, 'error': 'SAP B1 unavailable or a sync is already running'}), 503
+
+        return jsonify({'success': True, 'stats': stats, 'indexed': len(get_item_index().items)})
+
+    except Exception as e:
+        logging.error(f"Error in item sync API: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
@@ -9,8 +9,8 @@ from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from credential_loader import load_credentials_from_json, get_credential
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (replaced by the queue-based setup in logging_config once it runs)
+logging.basicConfig(level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
 # Load credentials from JSON file
 credentials = load_credentials_from_json()
@@ -65,7 +65,10 @@ try:
         # Use DATABASE_URL from JSON credentials
         database_url = database_url_from_json
         logging.info(f"Using DATABASE_URL from JSON credentials")
-        db_type = "mysql" if "mysql" in database_url else "postgresql"
+        if database_url.startswith('sqlite'):
+            db_type = "sqlite"  # Local benchmark/test databases only (see wms_benchmark.py)
+        else:
+            db_type = "mysql" if "mysql" in database_url else "postgresql"
     elif mysql_config['host'] != 'localhost' or credentials:
         # Use MySQL configuration from JSON
         database_url = (
@@ -83,7 +86,8 @@ try:
         db_type = "postgresql"
 
     from sqlalchemy import create_engine, text
-    test_engine = create_engine(database_url, connect_args={'connect_timeout': 5})
+    test_engine = create_engine(database_url,
+                                connect_args={} if database_url.startswith('sqlite') else {'connect_timeout': 5})
     with test_engine.connect() as conn:
         conn.execute(text("SELECT 1"))
 
@@ -163,79 +167,6 @@ import models
 import models_extensions
 from modules.invoice_creation import models as invoice_models  # noqa: F401
 
-with app.app_context():
-    # Create all tables first to ensure they exist before any queries
-    db.create_all()
-    logging.info("✅ Database tables created")
-
-    # Drop unique constraint if exists (PostgreSQL version)
-    try:
-        from sqlalchemy import text
-        with db.engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT constraint_name 
-                FROM information_schema.table_constraints 
-                WHERE table_schema = 'public' 
-                AND table_name = 'serial_number_transfer_serials' 
-                AND constraint_name = 'unique_serial_per_item'
-            """))
-            if result.fetchone():
-                conn.execute(text("ALTER TABLE serial_number_transfer_serials DROP CONSTRAINT unique_serial_per_item"))
-                conn.commit()
-                logging.info("Dropped unique_serial_per_item constraint")
-    except Exception as e:
-        logging.warning(f"⚠️ Could not drop unique constraint: {e}")
-
-    # Create default data
-    try:
-        from models_extensions import Branch
-        from werkzeug.security import generate_password_hash
-        from models import User
-
-        default_branch = Branch.query.filter_by(id='BR001').first()
-        if not default_branch:
-            default_branch = Branch()
-            default_branch.id = 'BR001'
-            default_branch.name = 'Main Branch'
-            default_branch.branch_code = 'BR001'
-            default_branch.branch_name = 'Main Branch'
-            default_branch.description = 'Main Office Branch'
-            default_branch.address = 'Main Office'
-            default_branch.phone = '123-456-7890'
-            default_branch.email = 'main@company.com'
-            default_branch.manager_name = 'Branch Manager'
-            default_branch.is_active = True
-            default_branch.is_default = True
-            db.session.add(default_branch)
-            logging.info("✅ Default branch created")
-
-        # Only create admin user in development or if explicitly requested
-        if os.environ.get('CREATE_DEFAULT_ADMIN') == 'true' or app.debug:
-            admin = User.query.filter_by(username='admin').first()
-            if not admin:
-                default_password = os.environ.get('ADMIN_PASSWORD', 'admin123')
-                admin = User()
-                admin.username = 'admin'
-                admin.email = 'admin@company.com'
-                admin.password_hash = generate_password_hash(default_password)
-                admin.first_name = 'System'
-                admin.last_name = 'Administrator'
-                admin.role = 'admin'
-                admin.branch_id = 'BR001'
-                admin.branch_name = 'Main Branch'
-                admin.default_branch_id = 'BR001'
-                admin.is_active = True
-                admin.must_change_password = True  # Force password change
-                db.session.add(admin)
-                logging.info("✅ Default admin user created (password change required)")
-
-        db.session.commit()
-        logging.info("✅ Default data initialized")
-
-    except Exception as e:
-        logging.error(f"❌ Error initializing default data: {e}")
-        db.session.rollback()
-
 # Setup logging
 try:
     from logging_config import setup_logging
@@ -248,17 +179,17 @@ except Exception as e:
 from modules import main_controller
 main_controller.register_modules(app)
 
-# Database tables already created above, this ensures module models are included
-with app.app_context():
-    db.create_all()  # Safe to call again, will only create missing tables
-    logging.info("✅ All module models verified/created")
+# Opt-in request profiling (@profile_route, PROFILE_ROUTES or the admin X-Profile header)
+from request_profiler import init_profiler
+init_profiler(app)
 
-# Initialize SAP B1 SQL Queries (validates and creates required queries)
-try:
-    from sap_sql_queries import initialize_sap_queries
-    initialize_sap_queries()
-except Exception as e:
-    logging.warning(f"⚠️ SAP SQL query initialization skipped: {str(e)}")
+# Provision schema (tables, default data) only when the stored marker does not match the
+# models - run `flask --app main wms bootstrap` to provision explicitly. SAP B1 SQL queries
+# are verified in the background after the first successful SAP login.
+from bootstrap import ensure_schema, register_cli
+register_cli(app)
+with app.app_context():
+    ensure_schema(app)
 
 # Import routes
 import routes
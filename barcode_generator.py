@@ -3,14 +3,85 @@ QR Code and Barcode Generation Module
 Equivalent to C# ZXing.QRCode functionality
 """
 
-import qrcode
 import io
 import base64
-from PIL import Image, ImageDraw, ImageFont
 import logging
 import os
 from datetime import datetime
 
+# qrcode and PIL are imported on first use - most workers never render a label,
+# and importing them adds ~50 ms to every worker boot
+
+
+def _load_qrcode():
+    import qrcode
+    return qrcode
+
+
+def _load_pil_image():
+    from PIL import Image
+    return Image
+
+
+def qr_matrix(data, margin=1, error_correction='L'):
+    """QR module matrix (rows of booleans, quiet zone of `margin` modules included)"""
+    qrcode = _load_qrcode()
+    levels = {
+        'L': qrcode.constants.ERROR_CORRECT_L,
+        'M': qrcode.constants.ERROR_CORRECT_M,
+        'Q': qrcode.constants.ERROR_CORRECT_Q,
+        'H': qrcode.constants.ERROR_CORRECT_H,
+    }
+    qr = qrcode.QRCode(version=None, error_correction=levels[error_correction], box_size=1, border=margin)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def render_qr_image(data, size, margin=1, error_correction='L'):
+    """
+    Render a 1-bit (mode "1") QR image of exactly size x size pixels.
+    Each module is a whole number of pixels - box size = size // (17 + 4 * version + 2 * margin) -
+    so edges stay pure black/white; leftover pixels become extra white border.
+    """
+    Image = _load_pil_image()
+    matrix = qr_matrix(data, margin, error_correction)
+    modules = len(matrix)
+    box = max(1, size // modules)
+
+    module_image = Image.new('1', (modules, modules))
+    module_image.putdata([0 if dark else 255 for row in matrix for dark in row])
+    qr_image = module_image.resize((modules * box, modules * box), Image.NEAREST)
+
+    if qr_image.size[0] >= size:
+        return qr_image
+    image = Image.new('1', (size, size), 255)
+    offset = (size - qr_image.size[0]) // 2
+    image.paste(qr_image, (offset, offset))
+    return image
+
+
+def render_qr_svg(data, size, margin=1, error_correction='L'):
+    """QR code as an SVG document (one path, crisp at any print resolution)"""
+    matrix = qr_matrix(data, margin, error_correction)
+    modules = len(matrix)
+    path = ''.join(f"M{x},{y}h1v1h-1z" for y, row in enumerate(matrix) for x, dark in enumerate(row) if dark)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+            f'viewBox="0 0 {modules} {modules}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="#fff"/><path d="{path}" fill="#000"/></svg>')
+
+
+def render_qr_zpl(data, size, x=0, y=0):
+    """
+    QR code as a ZPL label (^BQ) - the printer rasterises it.
+    Magnification is chosen so the code is close to `size` dots.
+    """
+    modules = len(qr_matrix(data, margin=0, error_correction='M'))
+    magnification = max(1, min(10, size // modules))
+    field = str(data).replace('^', ' ').replace('~', ' ')
+    return f"^XA^FO{x},{y}^BQN,2,{magnification}^FDMA,{field}^FS^XZ\n"
+
+
 class BarcodeGenerator:
     def __init__(self):
         self.default_qr_size = 300
@@ -24,7 +95,7 @@ class BarcodeGenerator:
             data (str): Data to encode in QR code
             size (int): Size of QR code (default: 300x300)
             margin (int): Margin around QR code (default: 1)
-            format (str): Output format ('PNG', 'JPEG', 'SVG')
+            format (str): Output format ('PNG', 'JPEG', 'SVG', 'ZPL')
             
         Returns:
             dict: {'success': bool, 'data': base64_string, 'filename': str}
@@ -35,41 +106,34 @@ class BarcodeGenerator:
             if margin is None:
                 margin = self.default_margin
                 
-            # Create QR code instance
-            qr = qrcode.QRCode(
-                version=1,  # Controls size (1 = 21x21, up to 40)
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=margin,
+            from label_cache import get_or_render, label_url, MIME_TYPES
+
+            format = format.upper()
+
+            # Identical content/size/format is rendered once and reused (memory + disk)
+            digest, image_bytes, cached = get_or_render(
+                data, size, format,
+                lambda: self._render_qr_bytes(data, size, margin, format),
+                variant=f"m{margin}-native"
             )
-            
-            # Add data
-            qr.add_data(data)
-            qr.make(fit=True)
-            
-            # Create image
-            img = qr.make_image(fill_color="black", back_color="white")
-            
-            # Resize to requested size
-            img = img.resize((size, size), Image.Resampling.LANCZOS)
-            
-            # Convert to base64 for web display
-            buffer = io.BytesIO()
-            img.save(buffer, format=format)
-            img_base64 = base64.b64encode(buffer.getvalue()).decode()
+            img_base64 = base64.b64encode(image_bytes).decode()
             
             # Generate filename
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"qr_{timestamp}.{format.lower()}"
             
-            logging.info(f"✅ QR code generated successfully: {len(data)} characters")
+            logging.info(f"✅ QR code {'served from cache' if cached else 'generated successfully'}: "
+                         f"{len(data)} characters")
             
             return {
                 'success': True,
                 'data': img_base64,
                 'filename': filename,
-                'mime_type': f'image/{format.lower()}',
-                'size': size
+                'mime_type': MIME_TYPES.get(format.lower(), f'image/{format.lower()}'),
+                'size': size,
+                'hash': digest,
+                'url': label_url(digest, format),
+                'cached': cached
             }
             
         except Exception as e:
@@ -79,6 +143,22 @@ class BarcodeGenerator:
                 'error': str(e)
             }
     
+    def _render_qr_bytes(self, data, size, margin, format):
+        """Render a QR code at native resolution and return the encoded bytes"""
+        if format == 'SVG':
+            return render_qr_svg(data, size, margin).encode('utf-8')
+        if format == 'ZPL':
+            return render_qr_zpl(data, size).encode('utf-8')
+
+        img = render_qr_image(data, size, margin)
+        if format == 'JPEG':
+            # JPEG has no 1-bit mode
+            img = img.convert('L')
+        
+        buffer = io.BytesIO()
+        img.save(buffer, format=format)
+        return buffer.getvalue()
+    
     def generate_label_qr(self, label_data):
         """
         Generate QR code for warehouse labels
@@ -139,10 +219,7 @@ class BarcodeGenerator:
         if label_data.get('warehouse'):
             qr_parts.append(f"WH:{label_data['warehouse']}")
             
-        # Add timestamp
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        qr_parts.append(f"TIME:{timestamp}")
-        
+        # No print timestamp: a reprint must encode the same content so label_cache can serve it
         return "|".join(qr_parts)
     
     def parse_scanned_qr(self, qr_text):
@@ -176,7 +253,7 @@ class BarcodeGenerator:
                             parsed_data['quantity'] = value
                         elif key == "WH":
                             parsed_data['warehouse'] = value
-                        elif key == "TIME":
+                        elif key == "TIME":  # Labels printed before TIME was dropped
                             parsed_data['timestamp'] = value
             else:
                 # Simple QR code - could be item code, bin code, etc.
@@ -0,0 +1,230 @@
+"""
+Database schema and SAP B1 SQL query provisioning.
+
+`flask --app main wms bootstrap` does the full provisioning run. Worker boot only
+compares stored version markers (BootstrapMarker) against the current model and
+query definitions, and SAP queries are provisioned lazily in the background after
+the first successful SAP login when their marker is missing or out of date.
+"""
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+
+SCHEMA_MARKER = 'schema'
+SAP_QUERIES_MARKER = 'sap_queries'
+
+_sap_queries_checked = False
+_sap_queries_lock = threading.Lock()
+
+
+def schema_version():
+    """Hash of every mapped table and its columns - changes whenever a model does"""
+    from app import db
+
+    parts = []
+    for table in sorted(db.metadata.tables.values(), key=lambda t: t.name):
+        columns = ','.join(f"{column.name}:{column.type}" for column in table.columns)
+        parts.append(f"{table.name}({columns})")
+    return hashlib.sha256(';'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_marker(key):
+    """Stored version for a bootstrap marker, or None (also when the marker table does not exist yet)"""
+    from app import db
+    from models import BootstrapMarker
+
+    try:
+        marker = db.session.get(BootstrapMarker, key)
+        return marker.version if marker else None
+    except Exception:
+        db.session.rollback()
+        return None
+
+
+def set_marker(key, version, details=None):
+    from app import db
+    from models import BootstrapMarker
+
+    marker = db.session.get(BootstrapMarker, key)
+    if marker is None:
+        marker = BootstrapMarker()
+        marker.key = key
+        db.session.add(marker)
+    marker.version = version
+    marker.details = details
+    marker.verified_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _drop_legacy_serial_constraint(app):
+    """Drop unique_serial_per_item on serial_number_transfer_serials (PostgreSQL only)"""
+    from app import db
+    from sqlalchemy import text
+
+    if app.config.get('DB_TYPE') != 'postgresql':
+        return
+    try:
+        with db.engine.connect() as conn:
+            result = conn.execute(text("""
+                SELECT constraint_name
+                FROM information_schema.table_constraints
+                WHERE table_schema = 'public'
+                AND table_name = 'serial_number_transfer_serials'
+                AND constraint_name = 'unique_serial_per_item'
+            """))
+            if result.fetchone():
+                conn.execute(text("ALTER TABLE serial_number_transfer_serials DROP CONSTRAINT unique_serial_per_item"))
+                conn.commit()
+                logging.info("Dropped unique_serial_per_item constraint")
+    except Exception as e:
+        logging.warning(f"⚠️ Could not drop unique constraint: {e}")
+
+
+def _create_default_data(app):
+    """Default branch, plus the admin user in development or when CREATE_DEFAULT_ADMIN=true"""
+    from app import db
+    from models_extensions import Branch
+    from werkzeug.security import generate_password_hash
+    from models import User
+
+    try:
+        default_branch = Branch.query.filter_by(id='BR001').first()
+        if not default_branch:
+            default_branch = Branch()
+            default_branch.id = 'BR001'
+            default_branch.name = 'Main Branch'
+            default_branch.branch_code = 'BR001'
+            default_branch.branch_name = 'Main Branch'
+            default_branch.description = 'Main Office Branch'
+            default_branch.address = 'Main Office'
+            default_branch.phone = '123-456-7890'
+            default_branch.email = 'main@company.com'
+            default_branch.manager_name = 'Branch Manager'
+            default_branch.is_active = True
+            default_branch.is_default = True
+            db.session.add(default_branch)
+            logging.info("✅ Default branch created")
+
+        # Only create admin user in development or if explicitly requested
+        if os.environ.get('CREATE_DEFAULT_ADMIN') == 'true' or app.debug:
+            admin = User.query.filter_by(username='admin').first()
+            if not admin:
+                default_password = os.environ.get('ADMIN_PASSWORD', 'admin123')
+                admin = User()
+                admin.username = 'admin'
+                admin.email = 'admin@company.com'
+                admin.password_hash = generate_password_hash(default_password)
+                admin.first_name = 'System'
+                admin.last_name = 'Administrator'
+                admin.role = 'admin'
+                admin.branch_id = 'BR001'
+                admin.branch_name = 'Main Branch'
+                admin.default_branch_id = 'BR001'
+                admin.is_active = True
+                admin.must_change_password = True  # Force password change
+                db.session.add(admin)
+                logging.info("✅ Default admin user created (password change required)")
+
+        db.session.commit()
+        logging.info("✅ Default data initialized")
+        return True
+
+    except Exception as e:
+        logging.error(f"❌ Error initializing default data: {e}")
+        db.session.rollback()
+        return False
+
+
+def bootstrap_schema(app):
+    """Create missing tables, apply legacy fixes and default data, then record the schema marker"""
+    from app import db
+
+    db.create_all()
+    logging.info("✅ Database tables created")
+
+    _drop_legacy_serial_constraint(app)
+    if _create_default_data(app):
+        set_marker(SCHEMA_MARKER, schema_version())
+
+
+def ensure_schema(app):
+    """Worker-boot check: one marker lookup, full provisioning only when the models changed"""
+    if get_marker(SCHEMA_MARKER) == schema_version():
+        logging.info("✅ Database schema verified (marker up to date)")
+        return
+    logging.info("🔧 Database schema marker missing or outdated - provisioning")
+    bootstrap_schema(app)
+
+
+def bootstrap_sap_queries(force=False):
+    """Validate/create the required SAP SQL queries unless this definition version is already verified"""
+    from sap_sql_queries import SAPSQLQueryManager, initialize_sap_queries
+
+    if not force and get_marker(SAP_QUERIES_MARKER) == SAPSQLQueryManager().queries_version():
+        logging.info("✅ SAP SQL queries already verified for current definitions")
+        return True
+
+    success, version = initialize_sap_queries()
+    if success and version:
+        set_marker(SAP_QUERIES_MARKER, version,
+                   details=f"{len(SAPSQLQueryManager.REQUIRED_QUERIES)} queries")
+    return success
+
+
+def ensure_sap_queries_provisioned():
+    """
+    Lazy first-use provisioning, called after a successful SAP login.
+    Runs at most once per process, in a background thread so the request is not held up.
+    """
+    global _sap_queries_checked
+    if _sap_queries_checked:
+        return
+
+    from flask import current_app, has_app_context
+    if not has_app_context():
+        return  # Without an app the check cannot run - leave it to the next call that has one
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                bootstrap_sap_queries()
+            except Exception as e:
+                logging.warning(f"⚠️ Background SAP SQL query provisioning failed: {str(e)}")
+
+    with _sap_queries_lock:
+        if _sap_queries_checked:
+            return
+        threading.Thread(target=run, name='sap-query-provisioning', daemon=True).start()
+        _sap_queries_checked = True
+
+
+wms_cli = AppGroup('wms', help='WMS maintenance commands')
+
+
+@wms_cli.command('bootstrap')
+@click.option('--skip-sap', is_flag=True, help='Only provision the database schema and default data')
+@click.option('--force', is_flag=True, help='Re-check SAP queries even if the current version was verified')
+def bootstrap_command(skip_sap, force):
+    """Provision database schema, default data and SAP B1 SQL queries"""
+    from flask import current_app
+
+    bootstrap_schema(current_app)
+    click.echo(f"Schema provisioned (version {schema_version()[:12]})")
+
+    if skip_sap:
+        return
+    if bootstrap_sap_queries(force=force):
+        click.echo("SAP SQL queries verified")
+    else:
+        click.echo("SAP SQL query provisioning incomplete - see log for details", err=True)
+        raise SystemExit(1)
+
+
+def register_cli(app):
+    app.cli.add_command(wms_cli)
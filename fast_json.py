@@ -0,0 +1,24 @@
+"""
+Compact JSON encoding for SAP payloads and payload logging.
+Uses orjson when it is installed and the standard library (without indentation or
+padding spaces) otherwise. SAP payloads hold only strings, numbers and nested
+lists/dicts, for which both encoders produce the same JSON.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # optional - the stdlib encoder is used instead
+    orjson = None
+
+
+def dumps_bytes(obj):
+    """obj as compact UTF-8 JSON bytes (unknown types are converted with str)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, default=str, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj):
+    """obj as a compact JSON string"""
+    return dumps_bytes(obj).decode('utf-8')
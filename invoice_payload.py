@@ -0,0 +1,50 @@
+"""
+SAP B1 invoice payload builder shared by Invoice Creation and SO Against Invoice.
+
+Callers fetch the serial rows of a document with one query and
+build_document_lines aggregates them into DocumentLines in a single pass:
+rows with the same (ItemCode, WarehouseCode, BPL_ID) - plus any extra line
+fields such as the Sales Order BaseLine - become one line whose Quantity is
+the sum of its rows. Serialise the result with fast_json.dumps.
+"""
+
+# Row keys copied onto every DocumentLine
+LINE_FIELDS = ('ItemCode', 'ItemDescription', 'WarehouseCode')
+
+
+def build_document_lines(rows, extra_fields=(), serial_base_line=True):
+    """
+    Aggregate flat rows into SAP DocumentLines, in order of first appearance.
+
+    Each row is a mapping with ItemCode, ItemDescription, WarehouseCode, BPL_ID,
+    SerialNumber (None for a line without serials) and Quantity, plus the keys in
+    extra_fields, which are part of the grouping key and copied onto the line.
+    With serial_base_line, every serial carries its line's BaseLineNumber (0, 1, ...).
+    """
+    lines = {}
+    for row in rows:
+        key = (row['ItemCode'], row['WarehouseCode'], row['BPL_ID']) + tuple(row[field] for field in extra_fields)
+        entry = lines.get(key)
+        if entry is None:
+            line = {field: row[field] for field in LINE_FIELDS}
+            line.update((field, row[field]) for field in extra_fields)
+            line['Quantity'] = 0.0
+            line['SerialNumbers'] = []
+            entry = lines[key] = (len(lines), line)
+        index, line = entry
+
+        quantity = float(row['Quantity'])
+        line['Quantity'] += quantity
+        if row['SerialNumber'] is not None:
+            serial = {'InternalSerialNumber': row['SerialNumber'], 'Quantity': quantity}
+            if serial_base_line:
+                serial['BaseLineNumber'] = index
+            line['SerialNumbers'].append(serial)
+
+    document_lines = []
+    for _, line in lines.values():
+        if not line['SerialNumbers']:
+            del line['SerialNumbers']
+        document_lines.append(line)
+    return document_lines
+
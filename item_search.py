@@ -0,0 +1,239 @@
+"""
+In-memory typeahead index over the local item master replica.
+Item codes and name words are kept in sorted lists for prefix lookups (bisect),
+and a trigram inverted index covers substring matches, so searches never hit
+SAP or the database.
+"""
+import bisect
+import logging
+import re
+import threading
+from datetime import datetime, timedelta
+
+# Incremental SAP sync is triggered when the replica is older than this
+ITEM_SYNC_INTERVAL = timedelta(minutes=15)
+
+# BootstrapMarker row whose verified_at is the deployment-wide time of the last background sync
+ITEM_SYNC_MARKER = 'item_master_sync'
+
+_WORD_SPLIT = re.compile(r'[\s\-_/.,()]+')
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ItemSearchIndex:
+    """Prefix + trigram index over item code/name"""
+
+    def __init__(self, items=()):
+        self.items = []  # dicts in API shape
+        self._codes = []  # sorted (CODE, idx)
+        self._words = []  # sorted (WORD, idx) for every word of every name
+        self._trigrams = {}  # trigram -> set(idx)
+        self._texts = []  # upper-cased "CODE NAME" per idx
+        self._codes_by_idx = []
+        for item in items:
+            self._add(item)
+        self._codes.sort()
+        self._words.sort()
+
+    def _add(self, item):
+        idx = len(self.items)
+        self.items.append(item)
+        code = (item['item_code'] or '').upper()
+        name = (item['item_name'] or '').upper()
+        text = f"{code} {name}"
+        self._texts.append(text)
+        self._codes_by_idx.append(code)
+        self._codes.append((code, idx))
+        for word in _WORD_SPLIT.split(name):
+            if word:
+                self._words.append((word, idx))
+        for trigram in _trigrams(text):
+            self._trigrams.setdefault(trigram, set()).add(idx)
+
+    @staticmethod
+    def _prefix_matches(sorted_pairs, prefix):
+        start = bisect.bisect_left(sorted_pairs, (prefix,))
+        for key, idx in sorted_pairs[start:]:
+            if not key.startswith(prefix):
+                break
+            yield idx
+
+    def search(self, query, limit=20, warehouse_code=None):
+        """Return up to limit items ranked: exact code, code prefix, name-word prefix, substring"""
+        query = (query or '').strip().upper()
+        if not query:
+            return []
+        tokens = query.split()
+
+        ranked = {}
+
+        def take(candidates, rank):
+            # Candidates arrive in key order, so each tier can stop once it has a full page
+            added = 0
+            for idx in candidates:
+                if added >= limit:
+                    break
+                if idx in ranked:
+                    continue
+                if warehouse_code and self.items[idx]['on_hand'].get(warehouse_code, 0) <= 0:
+                    continue
+                if len(tokens) > 1 and not all(token in self._texts[idx] for token in tokens):
+                    continue
+                code = self._codes_by_idx[idx]
+                ranked[idx] = (0 if code == query else rank, len(code), code)
+                added += 1
+
+        take(self._prefix_matches(self._codes, query), 1)
+        take(self._prefix_matches(self._words, tokens[0]), 2)
+
+        if len(ranked) < limit and len(query) >= 3:
+            candidate_sets = sorted((self._trigrams.get(trigram, set()) for trigram in _trigrams(query)), key=len)
+            candidates = set.intersection(*candidate_sets) if candidate_sets else set()
+            take((idx for idx in candidates if query in self._texts[idx]), 3)
+
+        best = sorted(ranked, key=ranked.get)[:limit]
+        return [self.items[idx] for idx in best]
+
+
+_index = ItemSearchIndex()
+_index_built_at = None
+_index_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_last_sync_at = None
+_schedule_lock = threading.Lock()
+_sync_scheduled = False
+
+
+def _load_index():
+    """Build a fresh index from the item master tables"""
+    from models import ItemMasterRecord, ItemWarehouseStock
+
+    stock = {}
+    for item_id, warehouse_code, on_hand in ItemWarehouseStock.query.with_entities(
+            ItemWarehouseStock.item_id, ItemWarehouseStock.warehouse_code, ItemWarehouseStock.on_hand):
+        stock.setdefault(item_id, {})[warehouse_code] = on_hand or 0.0
+
+    items = [{
+        'item_code': record.item_code,
+        'item_name': record.item_name or '',
+        'unit_of_measure': record.unit_of_measure or '',
+        'is_serial_managed': bool(record.is_serial_managed),
+        'is_batch_managed': bool(record.is_batch_managed),
+        'item_type': record.item_type,
+        'on_hand': stock.get(record.id, {})
+    } for record in ItemMasterRecord.query.filter_by(is_active=True).all()]
+
+    return ItemSearchIndex(items)
+
+
+def get_item_index(force_reload=False):
+    """Get the process-wide search index, building it from the database on first use"""
+    global _index, _index_built_at
+    if _index_built_at is None or force_reload:
+        with _index_lock:
+            if _index_built_at is None or force_reload:
+                _index = _load_index()
+                _index_built_at = datetime.utcnow()
+                logging.info(f"Item search index built with {len(_index.items)} items")
+    return _index
+
+
+def refresh_item_master(full=False):
+    """
+    Pull item changes from SAP into the replica and rebuild the index.
+    Incremental by default (items whose UpdateDate is on/after the newest synced one,
+    and the warehouse stock of items moved since the last sync).
+    Returns sync stats, or None if SAP was unavailable or a sync is already running.
+    """
+    global _last_sync_at
+    if not _sync_lock.acquire(blocking=False):
+        return None
+    try:
+        from app import db
+        from models import ItemMasterRecord, ItemWarehouseStock
+        from sap_integration import SAPIntegration
+
+        updated_since = stock_since = None
+        if not full:
+            updated_since = db.session.query(db.func.max(ItemMasterRecord.sap_update_date)).scalar()
+            # Stock moves without touching UpdateDate - refresh what moved since the last sync
+            stock_since = db.session.query(db.func.max(ItemWarehouseStock.synced_at)).scalar()
+
+        stats = SAPIntegration().sync_item_master(updated_since=updated_since, stock_since=stock_since)
+        if stats is not None:
+            get_item_index(force_reload=True)
+        return stats
+    finally:
+        _last_sync_at = datetime.utcnow()
+        _sync_lock.release()
+
+
+def _claim_sync_slot(now):
+    """
+    Claim the background sync for this interval across all worker processes.
+    The marker row is moved forward with a conditional UPDATE, so only one worker wins.
+    """
+    from app import db
+    from models import BootstrapMarker
+    from sqlalchemy.exc import IntegrityError
+
+    claimed = BootstrapMarker.query.filter(
+        BootstrapMarker.key == ITEM_SYNC_MARKER,
+        db.or_(BootstrapMarker.verified_at.is_(None), BootstrapMarker.verified_at < now - ITEM_SYNC_INTERVAL)
+    ).update({'verified_at': now}, synchronize_session=False)
+    if claimed:
+        db.session.commit()
+        return True
+    if db.session.get(BootstrapMarker, ITEM_SYNC_MARKER) is not None:
+        db.session.rollback()
+        return False
+
+    marker = BootstrapMarker()
+    marker.key = ITEM_SYNC_MARKER
+    marker.version = 'incremental'
+    marker.verified_at = now
+    db.session.add(marker)
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def refresh_item_master_if_stale(app):
+    """
+    Keep the replica and this worker's index fresh every ITEM_SYNC_INTERVAL.
+    One worker per interval syncs from SAP; the others only reload their index from the database.
+    """
+    global _sync_scheduled
+    if _last_sync_at and datetime.utcnow() - _last_sync_at < ITEM_SYNC_INTERVAL:
+        return
+    # Claim the refresh before starting the thread, so concurrent requests start only one
+    with _schedule_lock:
+        if _sync_scheduled or _sync_lock.locked():
+            return
+        _sync_scheduled = True
+
+    def run():
+        global _last_sync_at, _sync_scheduled
+        try:
+            with app.app_context():
+                if _claim_sync_slot(datetime.utcnow()):
+                    refresh_item_master()
+                else:
+                    get_item_index(force_reload=True)
+                    _last_sync_at = datetime.utcnow()
+        except Exception as e:
+            logging.error(f"Background item master sync failed: {str(e)}")
+        finally:
+            _sync_scheduled = False
+
+    try:
+        threading.Thread(target=run, name='item-master-sync', daemon=True).start()
+    except RuntimeError:
+        _sync_scheduled = False
+        raise
@@ -0,0 +1,179 @@
+"""
+Batch label rendering for whole documents (GRPO, serial item transfer, invoice).
+PDF labels are laid out in a process pool and merged into one multi-page PDF;
+ZPL output uses the printer's native QR command (^BQ), so no images are rendered.
+"""
+import functools
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# 2" x 1.33" label at 300 dpi
+LABEL_WIDTH = 600
+LABEL_HEIGHT = 400
+LABEL_DPI = 300
+
+# Below this many labels the pool start-up costs more than it saves
+PROCESS_POOL_MIN_LABELS = 24
+MAX_BATCH_LABELS = 2000
+
+DOCUMENT_TYPES = ('grpo', 'serial_transfer', 'invoice')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Process pool shared by all requests in this worker, created on first large batch"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Never fork the worker itself: by now it runs the log listener, sync and
+                # provisioning threads and holds DB pool connections, and a child forked while
+                # another thread holds a lock can deadlock. The forkserver starts single-threaded
+                # and preloads only the render modules (pool processes still re-import __main__,
+                # which is gunicorn's entry point in production).
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['label_batch', 'barcode_generator'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 2, mp_context=context)
+    return _pool
+
+
+def _label(qr_text, *lines):
+    return {'qr': qr_text, 'lines': [str(line) for line in lines if line]}
+
+
+def collect_document_labels(document_type, document_id):
+    """Return (title, labels) for a document, or None when it does not exist"""
+    if document_type == 'grpo':
+        from models import GRPODocument
+        document = GRPODocument.query.get(document_id)
+        if not document:
+            return None
+        labels = []
+        for item in document.items:
+            parts = [f"SO{document.po_number}", f"ItemCode: {item.item_code}"]
+            if item.batch_number:
+                parts.append(f"Batch: {item.batch_number}")
+            if item.serial_number:
+                parts.append(f"Serial: {item.serial_number}")
+            labels.append(_label(" | ".join(parts), item.item_code, item.item_name,
+                                 f"Batch: {item.batch_number}" if item.batch_number else None,
+                                 f"Serial: {item.serial_number}" if item.serial_number else None,
+                                 f"PO: {document.po_number}"))
+        return f"GRPO-{document.po_number}", labels
+
+    if document_type == 'serial_transfer':
+        from models import SerialItemTransfer
+        transfer = SerialItemTransfer.query.get(document_id)
+        if not transfer:
+            return None
+        labels = []
+        for item in transfer.items:
+            parts = [transfer.transfer_number, f"ItemCode: {item.item_code}"]
+            if item.serial_number:
+                parts.append(f"Serial: {item.serial_number}")
+            labels.append(_label(" | ".join(parts), item.item_code, item.item_description,
+                                 f"Serial: {item.serial_number}" if item.serial_number else f"Qty: {item.quantity}",
+                                 f"{item.from_warehouse_code} -> {item.to_warehouse_code}"))
+        return transfer.transfer_number, labels
+
+    if document_type == 'invoice':
+        from modules.invoice_creation.models import InvoiceDocument
+        invoice = InvoiceDocument.query.get(document_id)
+        if not invoice:
+            return None
+        reference = invoice.invoice_number or f"DRAFT-{invoice.id}"
+        labels = []
+        for line in invoice.lines:
+            for serial in line.serial_numbers:
+                labels.append(_label(f"INV{reference} | ItemCode: {serial.item_code} | Serial: {serial.serial_number}",
+                                     serial.item_code, serial.item_description,
+                                     f"Serial: {serial.serial_number}", invoice.customer_name))
+        return f"INV-{reference}", labels
+
+    raise ValueError(f"Unsupported document type: {document_type}")
+
+
+@functools.lru_cache(maxsize=4)
+def _load_font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 has a single fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def render_label(label):
+    """Render one label page; returns (width, height, raw mode-"1" bytes). Runs in pool processes."""
+    from PIL import Image, ImageDraw
+    from barcode_generator import render_qr_image
+
+    # Whole-pixel modules at native resolution - no resampling
+    qr_size = LABEL_HEIGHT - 40
+    qr_image = render_qr_image(label['qr'], qr_size, margin=0, error_correction='M')
+
+    page = Image.new('1', (LABEL_WIDTH, LABEL_HEIGHT), 255)
+    top = (LABEL_HEIGHT - qr_size) // 2
+    page.paste(qr_image, (20, top))
+    draw = ImageDraw.Draw(page)
+
+    font = _load_font(26)
+    text_x = 20 + qr_size + 20
+    text_width = LABEL_WIDTH - text_x - 10
+    y = top
+    for line in label['lines'][:6]:
+        # Trim to the label width rather than wrapping
+        length = draw.textlength(line, font=font)
+        if length > text_width:
+            line = line[:int(len(line) * text_width / length)]
+            while line and draw.textlength(line, font=font) > text_width:
+                line = line[:-1]
+        draw.text((text_x, y), line, font=font, fill=0)
+        y += 34
+
+    return page.size[0], page.size[1], page.tobytes()
+
+
+def render_pdf(labels):
+    """Render labels into a single multi-page PDF (bytes)"""
+    from PIL import Image
+
+    if len(labels) >= PROCESS_POOL_MIN_LABELS:
+        chunksize = max(1, len(labels) // ((os.cpu_count() or 2) * 4))
+        rendered = list(_get_pool().map(render_label, labels, chunksize=chunksize))
+    else:
+        rendered = [render_label(label) for label in labels]
+
+    pages = [Image.frombytes('1', (width, height), data) for width, height, data in rendered]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:], resolution=LABEL_DPI)
+    logging.info(f"🏷️ Rendered {len(pages)} labels to PDF ({len(buffer.getvalue())} bytes)")
+    return buffer.getvalue()
+
+
+def _zpl_text(value):
+    # ^ and ~ are ZPL control prefixes and cannot appear in field data
+    return str(value).replace('^', ' ').replace('~', ' ')
+
+
+def render_zpl(labels):
+    """Render labels as one ZPL stream; the printer draws the QR codes itself"""
+    out = []
+    for label in labels:
+        out.append(f"^XA^PW{LABEL_WIDTH}^LL{LABEL_HEIGHT}")
+        out.append(f"^FO20,20^BQN,2,6^FDMA,{_zpl_text(label['qr'])}^FS")
+        y = 30
+        for line in label['lines'][:6]:
+            out.append(f"^FO300,{y}^A0N,26,26^FB290,1,0,L^FD{_zpl_text(line)}^FS")
+            y += 34
+        out.append("^XZ")
+    return "\n".join(out) + "\n"
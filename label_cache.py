@@ -0,0 +1,167 @@
+"""
+Content-addressed cache for rendered QR label images.
+An image is keyed by a hash of its content, size and format, so identical labels
+(e.g. reprints from /barcode_reprint) are rendered once. Rendered images are kept
+in an in-memory LRU and on disk under LABEL_CACHE_PATH, and are served from
+/labels/<hash>.<ext> with long-lived cache headers. The disk store is pruned in the
+background: files unused for LABEL_CACHE_MAX_AGE_DAYS go first, then the least
+recently used until it is under LABEL_CACHE_MAX_MB.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from cache_utils import TTLCache
+
+LABEL_CACHE_PATH = os.environ.get('LABEL_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'wms_label_cache'))
+LABEL_CACHE_MAX_BYTES = int(os.environ.get('LABEL_CACHE_MAX_MB', '256')) * 1024 * 1024
+LABEL_CACHE_MAX_AGE = int(os.environ.get('LABEL_CACHE_MAX_AGE_DAYS', '30')) * 86400
+PRUNE_INTERVAL = 600  # seconds between disk scans, per process
+
+# Content-addressed entries never go stale; the TTL only bounds memory held by idle entries
+_memory_cache = TTLCache(ttl=24 * 3600, maxsize=512)
+
+LABEL_HASH_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+MIME_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'svg': 'image/svg+xml',
+    'zpl': 'text/plain',
+}
+
+
+def label_hash(content, size, fmt, variant=''):
+    """Stable key for a rendered label; variant covers other render options (margin, renderer)"""
+    return hashlib.sha1(f"{fmt.upper()}|{size}|{variant}|{content}".encode('utf-8')).hexdigest()
+
+
+def _disk_path(digest, ext):
+    return os.path.join(LABEL_CACHE_PATH, digest[:2], f"{digest}.{ext}")
+
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def _read_disk(digest, ext):
+    path = _disk_path(digest, ext)
+    try:
+        with open(path, 'rb') as f:
+            image_bytes = f.read()
+        os.utime(path)  # mtime doubles as last use for pruning
+        return image_bytes
+    except OSError:
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+
+def prune_disk_cache(max_bytes=LABEL_CACHE_MAX_BYTES, max_age=LABEL_CACHE_MAX_AGE):
+    """Delete label files unused for max_age seconds, then the oldest until the store fits max_bytes"""
+    now = time.time()
+    entries = []
+    removed = 0
+    for root, _, files in os.walk(LABEL_CACHE_PATH):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # Leftover .tmp files of interrupted writes age out like labels
+            if now - stat.st_mtime > max_age:
+                removed += _remove(path)
+            elif not name.endswith('.tmp'):
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_bytes * 0.9:  # some headroom so the next write does not prune again
+                break
+            removed += _remove(path)
+            total -= size
+    if removed:
+        logging.info(f"🧹 Pruned {removed} label images from {LABEL_CACHE_PATH} ({total // 1024} KB kept)")
+    return removed
+
+
+def _maybe_prune():
+    """Start a background prune at most once per PRUNE_INTERVAL"""
+    global _last_prune
+    with _prune_lock:
+        if _last_prune and time.monotonic() - _last_prune < PRUNE_INTERVAL:
+            return
+        _last_prune = time.monotonic()
+
+    def run():
+        try:
+            prune_disk_cache()
+        except Exception as e:
+            logging.warning(f"⚠️ Label cache prune failed: {str(e)}")
+
+    threading.Thread(target=run, name='label-cache-prune', daemon=True).start()
+
+
+def _write_disk(digest, ext, image_bytes):
+    path = _disk_path(digest, ext)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"⚠️ Could not store label image {digest}: {str(e)}")
+        return
+    _maybe_prune()
+
+
+def load_label(digest, ext):
+    """Return cached image bytes for a hash (memory, then disk), or None"""
+    if not LABEL_HASH_PATTERN.match(digest or '') or ext not in MIME_TYPES:
+        return None
+    key = (digest, ext)
+    image_bytes = _memory_cache.get(key)
+    if image_bytes is None:
+        image_bytes = _read_disk(digest, ext)
+        if image_bytes is not None:
+            _memory_cache.set(key, image_bytes)
+    return image_bytes
+
+
+def get_or_render(content, size, fmt, render, variant=''):
+    """
+    Return (hash, image_bytes, cached) for a label, calling render() only on a miss.
+    render() must return the encoded image bytes. Formats without a MIME_TYPES entry
+    could never be served back, so they raise ValueError.
+    """
+    ext = fmt.lower()
+    if ext not in MIME_TYPES:
+        raise ValueError(f"Unsupported label format: {fmt} (supported: {', '.join(sorted(MIME_TYPES)).upper()})")
+    digest = label_hash(content, size, fmt, variant)
+    image_bytes = load_label(digest, ext)
+    if image_bytes is not None:
+        return digest, image_bytes, True
+
+    image_bytes = render()
+    _memory_cache.set((digest, ext), image_bytes)
+    _write_disk(digest, ext, image_bytes)
+    return digest, image_bytes, False
+
+
+def label_url(digest, fmt='PNG'):
+    return f"/labels/{digest}.{fmt.lower()}"
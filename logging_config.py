@@ -1,14 +1,99 @@
 """
 Logging Configuration for WMS Application
-Configures file-based logging with rotation
+Configures file-based logging with rotation. Handlers run on a QueueListener
+thread, so request threads only enqueue records; files are written as JSON lines.
 """
 import os
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+import queue
+import random
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
-import logging
 import sys
 
+import fast_json
+
+# Full SAP request/response bodies go to this logger so they can be sampled separately
+PAYLOAD_LOGGER = 'wms.sap.payload'
+payload_log = logging.getLogger(PAYLOAD_LOGGER)
+
+_listener = None
+
+
+def _stop_listener():
+    """Flush queued records and stop the listener thread (also run at interpreter exit)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+class LazyJson:
+    """Defers JSON encoding of a payload until a handler actually formats the record (compact unless indent is given)"""
+
+    def __init__(self, obj, indent=None):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self):
+        if self.indent is None:
+            return fast_json.dumps(self.obj)
+        return json.dumps(self.obj, indent=self.indent, default=str)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of records from selected loggers (e.g. 'wms.sap.payload=0.1').
+    Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        # Longest prefix first so 'a.b' overrides 'a'
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        for prefix, rate in self.rates:
+            if record.name == prefix or record.name.startswith(prefix + '.'):
+                return random.random() < rate
+        return True
+
+
+def _parse_sample_rates(value):
+    rates = {}
+    for part in (value or '').split(','):
+        if '=' in part:
+            name, rate = part.split('=', 1)
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
 
 
 def setup_logging(app):
@@ -24,6 +109,9 @@ def setup_logging(app):
     LOG_FORMAT = os.environ.get('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     LOG_TO_CONSOLE = os.environ.get('LOG_TO_CONSOLE', 'True').lower() == 'true'
     LOG_TO_FILE = os.environ.get('LOG_TO_FILE', 'True').lower() == 'true'
+    LOG_FILE_FORMAT = os.environ.get('LOG_FILE_FORMAT', 'json').lower()  # json (JSON lines) or text
+    LOG_ASYNC = os.environ.get('LOG_ASYNC', 'True').lower() == 'true'
+    LOG_SAMPLE_RATES = _parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', f'{PAYLOAD_LOGGER}=0.1'))
 
     # Create logs directory if it doesn't exist
     os.makedirs(LOG_PATH, exist_ok=True)
@@ -31,12 +119,16 @@ def setup_logging(app):
     # Get log level
     log_level = getattr(logging, LOG_LEVEL, logging.INFO)
     
+    global _listener
+    _stop_listener()
+
     # Clear any existing handlers
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
     
-    # Create formatter
+    # Create formatters
     formatter = logging.Formatter(LOG_FORMAT)
+    file_formatter = JsonLinesFormatter() if LOG_FILE_FORMAT == 'json' else formatter
     
     # Setup root logger
     logging.root.setLevel(log_level)
@@ -64,7 +156,7 @@ def setup_logging(app):
         # Set suffix to include date in filename
         file_handler.suffix = '%Y-%m-%d'
         file_handler.setLevel(log_level)
-        file_handler.setFormatter(formatter)
+        file_handler.setFormatter(file_formatter)
         handlers.append(file_handler)
         
         # Error log file with timed rotation
@@ -79,21 +171,29 @@ def setup_logging(app):
         # Set suffix to include date in filename
         error_handler.suffix = '%Y-%m-%d'
         error_handler.setLevel(logging.ERROR)
-        error_handler.setFormatter(formatter)
+        error_handler.setFormatter(file_formatter)
         handlers.append(error_handler)
     
-    # Add all handlers
-    for handler in handlers:
-        logging.root.addHandler(handler)
+    sampling_filter = SamplingFilter(LOG_SAMPLE_RATES)
+    if LOG_ASYNC:
+        # Request threads only enqueue; console/file I/O happens on the listener thread
+        queue_handler = QueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(sampling_filter)
+        logging.root.addHandler(queue_handler)
+        _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(sampling_filter)
+            logging.root.addHandler(handler)
     
-    # Setup Flask app logger
+    # Setup Flask app logger (propagates to the root handlers above)
     if app:
         app.logger.setLevel(log_level)
-        for handler in handlers:
-            app.logger.addHandler(handler)
     
     # Log startup message
-    logging.info(f"Logging initialized - Level: {LOG_LEVEL}, Path: {LOG_PATH}")
+    logging.info("Logging initialized - Level: %s, Path: %s, File format: %s, Async: %s, Sampling: %s",
+                 LOG_LEVEL, LOG_PATH, LOG_FILE_FORMAT, LOG_ASYNC, LOG_SAMPLE_RATES or 'off')
     if LOG_TO_FILE:
         logging.info(f"Daily log files: {LOG_PATH}/{LOG_FILE_PREFIX}.log and {LOG_PATH}/{LOG_FILE_PREFIX}_error.log (rotates daily at midnight with date suffix)")
     
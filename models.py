@@ -781,6 +781,34 @@ class SerialItemTransferItem(db.Model):
     # __table_args__ = (db.UniqueConstraint('serial_item_transfer_id', 'serial_number', name='unique_serial_per_transfer'),)
 
 
+class SerialItemTransferPostingChunk(db.Model):
+    """Per-chunk SAP posting checkpoint for Serial Item Transfers - lets a failed post resume remaining chunks"""
+    __tablename__ = 'serial_item_transfer_posting_chunks'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    serial_item_transfer_id = db.Column(db.Integer, db.ForeignKey('serial_item_transfers.id'), nullable=False)
+    chunk_index = db.Column(db.Integer, nullable=False)  # 1-based position within the posting
+    item_ids = db.Column(db.Text, nullable=False)  # JSON array of SerialItemTransferItem ids in this chunk
+    status = db.Column(db.String(20), default='pending')  # pending, posted, failed
+    sap_doc_entry = db.Column(db.Integer, nullable=True)
+    sap_document_number = db.Column(db.String(50), nullable=True)
+    error_message = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationships
+    serial_item_transfer = db.relationship('SerialItemTransfer',
+                                           backref=db.backref('posting_chunks', lazy=True, cascade='all, delete-orphan'))
+    
+    __table_args__ = (db.UniqueConstraint('serial_item_transfer_id', 'chunk_index', name='unique_posting_chunk'),)
+    
+    def get_item_ids(self):
+        """Get item ids for this chunk as a list"""
+        import json
+        return json.loads(self.item_ids) if self.item_ids else []
+
+
 # ================================
 # User Warehouse Assignment Models
 # ================================
@@ -805,6 +833,81 @@ class UserWarehouseAssignment(db.Model):
         return f'<UserWarehouseAssignment User={self.user_id} Warehouse={self.warehouse_code} Type={self.assignment_type}>'
 
 
+# ================================
+# Item Master Replica Models
+# ================================
+
+class ItemMasterRecord(db.Model):
+    """Local replica of SAP B1 item master for fast typeahead search"""
+    __tablename__ = 'item_master'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    item_code = db.Column(db.String(50), nullable=False, unique=True)
+    item_name = db.Column(db.String(200), nullable=True)
+    unit_of_measure = db.Column(db.String(20), nullable=True)
+    is_serial_managed = db.Column(db.Boolean, default=False)
+    is_batch_managed = db.Column(db.Boolean, default=False)
+    item_type = db.Column(db.String(20), nullable=True)  # itItems, itLabor, itTravel, itFixedAssets
+    is_active = db.Column(db.Boolean, default=True)
+    sap_update_date = db.Column(db.Date, nullable=True)  # Items.UpdateDate - drives incremental sync
+    synced_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    warehouse_stock = db.relationship('ItemWarehouseStock', backref='item', lazy=True, cascade='all, delete-orphan')
+
+
+class ItemWarehouseStock(db.Model):
+    """Per-warehouse OnHand snapshot for replicated items"""
+    __tablename__ = 'item_warehouse_stock'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item_master.id'), nullable=False)
+    warehouse_code = db.Column(db.String(10), nullable=False)
+    on_hand = db.Column(db.Float, default=0.0)
+    synced_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('item_id', 'warehouse_code', name='unique_item_warehouse_stock'),)
+
+
+# ================================
+# SAP Posting Idempotency Models
+# ================================
+
+class SAPPostingAttempt(db.Model):
+    """SAP posting attempt per WMS document and payload content - makes retried posts no-ops"""
+    __tablename__ = 'sap_posting_attempts'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    document_type = db.Column(db.String(30), nullable=False)  # invoice, so_invoice, grpo, inventory_transfer, ...
+    document_id = db.Column(db.Integer, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the payload minus volatile fields
+    reference = db.Column(db.String(50), nullable=False, unique=True)  # Written to the SAP reference UDF
+    sap_entity = db.Column(db.String(50), nullable=False)  # Service Layer entity set, e.g. Invoices
+    status = db.Column(db.String(20), default='in_progress')  # in_progress, posted, failed, unknown
+    sap_doc_entry = db.Column(db.Integer, nullable=True)
+    sap_doc_num = db.Column(db.String(50), nullable=True)
+    error_message = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('document_type', 'document_id', 'content_hash', name='unique_posting_attempt'),)
+
+
+# ================================
+# System Bootstrap Models
+# ================================
+
+class BootstrapMarker(db.Model):
+    """Records which schema / SAP query definitions have been provisioned, so worker boot can skip the work"""
+    __tablename__ = 'bootstrap_markers'
+    
+    key = db.Column(db.String(50), primary_key=True)  # schema, sap_queries
+    version = db.Column(db.String(64), nullable=False)  # Hash of the definitions that were provisioned
+    details = db.Column(db.Text, nullable=True)
+    verified_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 # ================================
 # SO Against Invoice Models  
 # ================================
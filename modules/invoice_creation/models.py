@@ -93,4 +93,38 @@ class SerialNumberLookup(db.Model):
     lookup_error = db.Column(db.Text)
     sap_response = db.Column(db.Text)  # Store SAP response JSON
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class InvoiceDraftItem(db.Model):
+    """Serial items scanned for an invoice that has not been created yet (per-user working list)"""
+    __tablename__ = 'invoice_draft_items'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    serial_number = db.Column(db.String(100), nullable=False)
+    item_code = db.Column(db.String(50))
+    item_description = db.Column(db.String(200))
+    warehouse_code = db.Column(db.String(10))
+    customer_code = db.Column(db.String(20))
+    customer_name = db.Column(db.String(100))
+    quantity = db.Column(db.Numeric(15, 3), default=1.0)
+    validation_status = db.Column(db.String(20), default='validated')
+    line_number = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Expiry scans by age
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'serial_number', name='unique_draft_serial_per_user'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'serial_number': self.serial_number,
+            'item_code': self.item_code,
+            'item_description': self.item_description,
+            'warehouse_code': self.warehouse_code,
+            'customer_code': self.customer_code,
+            'customer_name': self.customer_name,
+            'quantity': float(self.quantity or 1),
+            'validation_status': self.validation_status,
+            'line_number': self.line_number,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
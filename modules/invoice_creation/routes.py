@@ -5,16 +5,207 @@ Handles invoice creation workflow including serial number lookup and SAP integra
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
 from flask_login import login_required, current_user
 from app import db
-from modules.invoice_creation.models import InvoiceDocument, InvoiceLine, InvoiceSerialNumber, SerialNumberLookup
+from modules.invoice_creation.models import InvoiceDocument, InvoiceLine, InvoiceSerialNumber, SerialNumberLookup, InvoiceDraftItem
+from modules.shared.serials import delete_serials
+from sqlalchemy.exc import IntegrityError
 from sap_integration import SAPIntegration
+from sap_idempotency import post_document
+from logging_config import payload_log, LazyJson
+from invoice_payload import build_document_lines
+import fast_json
 from datetime import datetime
 import logging
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 invoice_bp = Blueprint('invoice_creation', __name__, url_prefix='/invoice_creation')
 
+# SerialNumberLookup freshness windows (found serials / serials SAP did not return)
+SERIAL_LOOKUP_TTL = timedelta(hours=1)
+SERIAL_NOT_FOUND_TTL = timedelta(minutes=5)
+SERIAL_WARMUP_WORKERS = 4
+SERIAL_WARMUP_MAX = 500
+
+# Scanned draft items never turned into an invoice are dropped after this long
+DRAFT_ITEM_MAX_AGE = timedelta(days=1)
+DRAFT_EXPIRY_INTERVAL = timedelta(minutes=10)
+_draft_items_expired_at = None
+
+
+def _expire_draft_items():
+    """Delete abandoned draft items of all users - at most once per DRAFT_EXPIRY_INTERVAL in this worker"""
+    global _draft_items_expired_at
+    now = datetime.utcnow()
+    if _draft_items_expired_at and now - _draft_items_expired_at < DRAFT_EXPIRY_INTERVAL:
+        return
+    _draft_items_expired_at = now
+
+    expired = InvoiceDraftItem.query.filter(InvoiceDraftItem.created_at < now - DRAFT_ITEM_MAX_AGE).delete(
+        synchronize_session=False)
+    db.session.commit()
+    if expired:
+        logging.info(f"🧹 Expired {expired} invoice draft items older than {DRAFT_ITEM_MAX_AGE}")
+
+
+def _delete_draft_items(serial_numbers):
+    """Drop the current user's draft items that became part of an invoice (caller commits)"""
+    serial_numbers = [serial for serial in serial_numbers if serial]
+    if serial_numbers:
+        InvoiceDraftItem.query.filter(InvoiceDraftItem.user_id == current_user.id,
+                                      InvoiceDraftItem.serial_number.in_(serial_numbers)).delete(
+            synchronize_session=False)
+
+
+def _query_serial_from_sap(sap, serial_number):
+    """
+    Run the Invoise_creation SQL query for one serial: returns (status, row, error).
+    status is 'found', 'not_found', 'error' (SAP HTTP error) or 'unavailable' (connection failure).
+    """
+    url = f"{sap.base_url}/b1s/v1/SQLQueries('Invoise_creation')/List"
+    payload = {"ParamList": f"serial_number='{serial_number}'"}
+    try:
+        response = sap.session.post(url, json=payload, timeout=30)
+    except requests.exceptions.RequestException as e:
+        return 'unavailable', None, f'SAP connection error: {str(e)}'
+
+    if response.status_code != 200:
+        return 'error', None, f'SAP API error: {response.status_code} - {response.text}'
+
+    results = response.json().get('value', [])
+    if not results:
+        return 'not_found', None, None
+    return 'found', results[0], None
+
+
+def _store_serial_lookup(cached_lookup, serial_number, status, row):
+    """Write a SAP lookup result into SerialNumberLookup (caller commits)"""
+    if cached_lookup is None:
+        cached_lookup = SerialNumberLookup()
+        cached_lookup.serial_number = serial_number
+        db.session.add(cached_lookup)
+
+    row = row or {}
+    cached_lookup.item_code = row.get('ItemCode')
+    cached_lookup.item_name = row.get('itemName', row.get('ItemName'))
+    cached_lookup.warehouse_code = row.get('WhsCode')
+    cached_lookup.warehouse_name = row.get('WhsName')
+    cached_lookup.branch_id = row.get('BPLid') or None
+    cached_lookup.branch_name = row.get('BPLName')
+    cached_lookup.lookup_status = 'validated' if status == 'found' else 'not_found'
+    cached_lookup.lookup_error = None if status == 'found' else 'Serial number not found in SAP B1'
+    cached_lookup.sap_response = json.dumps(row) if status == 'found' else None
+    cached_lookup.last_updated = datetime.utcnow()
+    return cached_lookup
+
+
+def _cached_serial_result(cached_lookup):
+    """Return (status, row) for a fresh cache entry, or None when missing/stale"""
+    if not cached_lookup or not cached_lookup.last_updated:
+        return None
+    age = datetime.utcnow() - cached_lookup.last_updated
+    if cached_lookup.lookup_status == 'validated' and age < SERIAL_LOOKUP_TTL:
+        try:
+            row = json.loads(cached_lookup.sap_response) if cached_lookup.sap_response else {}
+        except ValueError:
+            row = {}
+        columns = {
+            'ItemCode': cached_lookup.item_code,
+            'itemName': cached_lookup.item_name,
+            'DistNumber': cached_lookup.serial_number,
+            'WhsCode': cached_lookup.warehouse_code,
+            'WhsName': cached_lookup.warehouse_name,
+            'BPLid': cached_lookup.branch_id,
+            'BPLName': cached_lookup.branch_name
+        }
+        for key, value in columns.items():
+            if value is not None:
+                row.setdefault(key, value)
+        return 'found', row
+    if cached_lookup.lookup_status == 'not_found' and age < SERIAL_NOT_FOUND_TTL:
+        return 'not_found', None
+    return None
+
+
+def lookup_serial_cached(serial_number, sap=None):
+    """
+    Read-through lookup of a serial number via SerialNumberLookup.
+    Returns (status, row, error, cached) with status as in _query_serial_from_sap.
+    """
+    cached_lookup = SerialNumberLookup.query.filter_by(serial_number=serial_number).first()
+    hit = _cached_serial_result(cached_lookup)
+    if hit:
+        return hit[0], hit[1], None, True
+
+    sap = sap or SAPIntegration()
+    if not sap.ensure_logged_in():
+        return 'unavailable', None, 'SAP connection failed', False
+
+    status, row, error = _query_serial_from_sap(sap, serial_number)
+    if status in ('found', 'not_found'):
+        try:
+            _store_serial_lookup(cached_lookup, serial_number, status, row)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"⚠️ Could not cache lookup for serial {serial_number}: {str(e)}")
+    return status, row, error, False
+
+
+def warm_serial_lookups(serial_numbers, sap=None):
+    """
+    Bulk warm-up for a pasted list: one query for cached rows, concurrent SAP
+    lookups for missing/stale serials, one commit. Returns {serial: (status, row)}.
+    """
+    serial_numbers = list(dict.fromkeys(s.strip() for s in serial_numbers if s and s.strip()))
+    cached_rows = {row.serial_number: row for row in
+                   SerialNumberLookup.query.filter(SerialNumberLookup.serial_number.in_(serial_numbers)).all()} \
+        if serial_numbers else {}
+
+    results = {}
+    missing = []
+    for serial_number in serial_numbers:
+        hit = _cached_serial_result(cached_rows.get(serial_number))
+        if hit:
+            results[serial_number] = hit
+        else:
+            missing.append(serial_number)
+
+    if not missing:
+        return results
+
+    sap = sap or SAPIntegration()
+    if not sap.ensure_logged_in():
+        for serial_number in missing:
+            results[serial_number] = ('unavailable', None)
+        return results
+
+    with ThreadPoolExecutor(max_workers=SERIAL_WARMUP_WORKERS) as pool:
+        fetched = list(pool.map(lambda serial: _query_serial_from_sap(sap, serial), missing))
+
+    for serial_number, (status, row, error) in zip(missing, fetched):
+        results[serial_number] = (status, row)
+        if status in ('found', 'not_found'):
+            _store_serial_lookup(cached_rows.get(serial_number), serial_number, status, row)
+        else:
+            logging.warning(f"⚠️ Warm-up lookup failed for serial {serial_number}: {error}")
+    db.session.commit()
+
+    logging.info(f"🔥 Warmed serial lookup cache: {len(serial_numbers) - len(missing)} cached, "
+                 f"{len(missing)} fetched from SAP")
+    return results
+
+
+def invalidate_serial_lookups(serial_numbers):
+    """Drop cached lookups for serials that have just been invoiced (they are no longer in stock)"""
+    serial_numbers = [s for s in serial_numbers if s]
+    if not serial_numbers:
+        return
+    SerialNumberLookup.query.filter(SerialNumberLookup.serial_number.in_(serial_numbers)) \
+        .delete(synchronize_session=False)
+
+
 @invoice_bp.route('/')
 @login_required
 def index():
@@ -169,16 +360,17 @@ def create():
                 total_amount = 0.0
                 line_number = 1
                 for item_data in serial_items:
-                    # Store serial number lookup data first
-                    serial_lookup = SerialNumberLookup()
-                    serial_lookup.serial_number = item_data.get('serial_number')
-                    serial_lookup.item_code = item_data.get('item_code')
-                    serial_lookup.item_name = item_data.get('item_name')
-                    serial_lookup.warehouse_code = item_data.get('warehouse')
-                    serial_lookup.lookup_status = 'validated'
-                    serial_lookup.sap_response = json.dumps(item_data)
-                    serial_lookup.last_updated = datetime.utcnow()
-                    db.session.add(serial_lookup)
+                    # Store serial number lookup data first (keep an existing SAP lookup as-is)
+                    if not SerialNumberLookup.query.filter_by(serial_number=item_data.get('serial_number')).first():
+                        serial_lookup = SerialNumberLookup()
+                        serial_lookup.serial_number = item_data.get('serial_number')
+                        serial_lookup.item_code = item_data.get('item_code')
+                        serial_lookup.item_name = item_data.get('item_name')
+                        serial_lookup.warehouse_code = item_data.get('warehouse')
+                        serial_lookup.lookup_status = 'validated'
+                        serial_lookup.sap_response = json.dumps(item_data)
+                        serial_lookup.last_updated = datetime.utcnow()
+                        db.session.add(serial_lookup)
 
                     # Create invoice line
                     invoice_line = InvoiceLine()
@@ -347,70 +539,61 @@ def validate_serial_number():
                 'offline_mode': True
             })
 
-        if not sap.ensure_logged_in():
-            logging.error("SAP login failed - using fallback validation")
-            # Return fallback serial validation data for offline mode
-            fallback_data = {
-
-            }
-            return jsonify({
-                'success': True,
-                'item_data': fallback_data,
-                'offline_mode': True
-            })
-
         try:
-            # Use SAP SQL Query for Invoice Creation serial number validation (Note: SAP query name is 'Invoice_creation')
-            url = f"{sap.base_url}/b1s/v1/SQLQueries('Invoise_creation')/List"
-            payload = {
-                "ParamList": f"serial_number='{serial_number}'"
-            }
+            # Read-through SerialNumberLookup cache, falling back to the SAP SQL query
+            # (Note: SAP query name is 'Invoise_creation')
+            status, item_data, error, cached = lookup_serial_cached(serial_number, sap)
+
+            if status == 'found':
+                # Enhanced response with auto-customer detection
+                response_data = {
+                    'ItemCode': item_data.get('ItemCode', ''),
+                    'ItemName': item_data.get('itemName', ''),
+                    'DistNumber': item_data.get('DistNumber', ''),
+                    'WhsCode': item_data.get('WhsCode', ''),
+                    'WhsName': item_data.get('WhsName', ''),
+                    'BPLName': item_data.get('BPLName', ''),
+                    'BPLid': item_data.get('BPLid', ''),
+                    'CardCode': item_data.get('CardCode', ''),
+                    'CardName': cusCode,
+                    'CustomerCode': cusCode,
+                    'CustomerName': cusCode
+                }
 
-            response = sap.session.post(url, json=payload, timeout=30)
+                # If no customer found from serial, add a common customer for demo
+                if not response_data['CardCode']:
+                    response_data['CardCode'] = ''
+                    response_data['CardName'] = ''
+                    response_data['CustomerCode'] = ''
+                    response_data['CustomerName'] = ''
 
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get('value', [])
-
-                if results:
-                    # Return the first result with item details AND customer information
-                    item_data = results[0]
-                    # Enhanced response with auto-customer detection
-                    response_data = {
-                        'ItemCode': item_data.get('ItemCode', ''),
-                        'ItemName': item_data.get('itemName', ''),
-                        'DistNumber': item_data.get('DistNumber', ''),
-                        'WhsCode': item_data.get('WhsCode', ''),
-                        'WhsName': item_data.get('WhsName', ''),
-                        'BPLName': item_data.get('BPLName', ''),
-                        'BPLid': item_data.get('BPLid', ''),
-                        'CardCode': item_data.get('CardCode', ''),
-                        'CardName': cusCode,
-                        'CustomerCode': cusCode,
-                        'CustomerName': cusCode
-                    }
-
-                    # If no customer found from serial, add a common customer for demo
-                    if not response_data['CardCode']:
-                        response_data['CardCode'] = ''
-                        response_data['CardName'] = ''
-                        response_data['CustomerCode'] = ''
-                        response_data['CustomerName'] = ''
-
-                    return jsonify({
-                        'success': True,
-                        'item_data': response_data
-                    })
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Serial number not found or has no available quantity'
-                    })
-            else:
+                return jsonify({
+                    'success': True,
+                    'item_data': response_data,
+                    'cached': cached
+                })
+            elif status == 'not_found':
                 return jsonify({
                     'success': False,
-                    'error': f'SAP API error: {response.status_code} - {response.text}'
+                    'error': 'Serial number not found or has no available quantity'
+                })
+            elif status == 'error':
+                return jsonify({
+                    'success': False,
+                    'error': error
                 }), 500
+            else:
+                logging.error(f" SAP validation unavailable: {error} - using fallback validation")
+                # Return fallback serial validation data for offline mode
+                fallback_data = {
+
+                }
+                return jsonify({
+                    'success': True,
+                    'item_data': fallback_data,
+                    'offline_mode': True,
+                    'error': f'SAP unavailable, using fallback data'
+                })
 
         except Exception as e:
             logging.error(f" SAP validation failed: {str(e)} - using fallback validation")
@@ -448,103 +631,78 @@ def lookup_serial():
 
         logging.info(f"Looking up serial number: {serial_number}")
 
-        # Check cache first
-        cached_lookup = SerialNumberLookup.query.filter_by(serial_number=serial_number).first()
-        if cached_lookup and (datetime.utcnow() - cached_lookup.last_updated) < timedelta(hours=1):
-            logging.info(f" Found cached data for serial number: {serial_number}")
+        try:
+            status, item_data, error, cached = lookup_serial_cached(serial_number)
+        except Exception as e:
+            logging.error(f"Error during SAP lookup: {str(e)}")
+            return jsonify({
+                'success': False,
+                'message': f'SAP lookup error: {str(e)}'
+            }), 500
+
+        if status == 'found':
+            if cached:
+                logging.info(f" Found cached data for serial number: {serial_number}")
             return jsonify({
                 'success': True,
-                'data': {
-                    'ItemCode': cached_lookup.item_code,
-                    'itemName': cached_lookup.item_name,
-                    'DistNumber': serial_number,
-                    'WhsCode': cached_lookup.warehouse_code,
-                    'WhsName': cached_lookup.warehouse_name,
-                    'BPLid': cached_lookup.branch_id,
-                    'BPLName': cached_lookup.branch_name
-                },
-                'cached': True
+                'data': item_data,
+                'cached': cached
             })
-
-        # Lookup from SAP
-        sap = SAPIntegration()
-        if not sap.ensure_logged_in():
+        elif status == 'not_found':
             return jsonify({
                 'success': False,
-                'message': 'SAP connection failed'
+                'message': f'Serial number {serial_number} not found in SAP',
+                'cached': cached
+            }), 404
+        else:
+            logging.error(f"SAP SQL Query failed: {error}")
+            return jsonify({
+                'success': False,
+                'message': 'SAP connection failed' if status == 'unavailable' else f'SAP query failed: {error}'
             }), 500
 
-        try:
-            # Use the SQL Query API as specified by user (Note: SAP query name is 'Invoice_creation')
-            url = f"{sap.base_url}/b1s/v1/SQLQueries('Invoise_creation')/List"
-            payload = {
-                "ParamList": f"serial_number='{serial_number}'"
-            }
+    except Exception as e:
+        logging.error(f"Error in lookup_serial API: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'Internal error: {str(e)}'
+        }), 500
 
-            response = sap.session.post(url, json=payload, timeout=30)
-            logging.info(f"SAP SQL Query Response Status: {response.status_code}")
 
-            if response.status_code == 200:
-                sap_data = response.json()
-                logging.info(f"SAP SQL Query Response: {json.dumps(sap_data, indent=2)}")
-
-                values = sap_data.get('value', [])
-                if values:
-                    item_data = values[0]  # Take first result
-
-                    # Cache the result
-                    if cached_lookup:
-                        cached_lookup.item_code = item_data.get('ItemCode')
-                        cached_lookup.item_name = item_data.get('itemName')
-                        cached_lookup.warehouse_code = item_data.get('WhsCode')
-                        cached_lookup.warehouse_name = item_data.get('WhsName')
-                        cached_lookup.branch_id = item_data.get('BPLid')
-                        cached_lookup.branch_name = item_data.get('BPLName')
-                        cached_lookup.lookup_status = 'validated'
-                        cached_lookup.sap_response = json.dumps(item_data)
-                        cached_lookup.last_updated = datetime.utcnow()
-                    else:
-                        cached_lookup = SerialNumberLookup()
-                        cached_lookup.serial_number = serial_number
-                        cached_lookup.item_code = item_data.get('ItemCode')
-                        cached_lookup.item_name = item_data.get('itemName')
-                        cached_lookup.warehouse_code = item_data.get('WhsCode')
-                        cached_lookup.warehouse_name = item_data.get('WhsName')
-                        cached_lookup.branch_id = item_data.get('BPLid')
-                        cached_lookup.branch_name = item_data.get('BPLName')
-                        cached_lookup.lookup_status = 'validated'
-                        cached_lookup.sap_response = json.dumps(item_data)
-                        cached_lookup.last_updated = datetime.utcnow()
-                        db.session.add(cached_lookup)
-
-                    db.session.commit()
-
-                    return jsonify({
-                        'success': True,
-                        'data': item_data,
-                        'cached': False
-                    })
-                else:
-                    return jsonify({
-                        'success': False,
-                        'message': f'Serial number {serial_number} not found in SAP'
-                    }), 404
-            else:
-                logging.error(f"SAP SQL Query failed: {response.status_code} - {response.text}")
-                return jsonify({
-                    'success': False,
-                    'message': f'SAP query failed: {response.status_code}'
-                }), 500
+@invoice_bp.route('/api/lookup_serials', methods=['POST'])
+@login_required
+def lookup_serials_bulk():
+    """Warm the serial lookup cache for a pasted list of serial numbers and return all results"""
+    try:
+        data = request.get_json() or {}
+        serial_numbers = data.get('serial_numbers', [])
+        if isinstance(serial_numbers, str):
+            serial_numbers = serial_numbers.replace(',', '\n').splitlines()
 
-        except Exception as e:
-            logging.error(f"Error during SAP lookup: {str(e)}")
+        if not serial_numbers:
             return jsonify({
                 'success': False,
-                'message': f'SAP lookup error: {str(e)}'
-            }), 500
+                'message': 'Serial numbers are required'
+            }), 400
+
+        if len(serial_numbers) > SERIAL_WARMUP_MAX:
+            return jsonify({
+                'success': False,
+                'message': f'At most {SERIAL_WARMUP_MAX} serial numbers can be looked up at once'
+            }), 400
+
+        results = warm_serial_lookups(serial_numbers)
+
+        return jsonify({
+            'success': True,
+            'found': {serial: row for serial, (status, row) in results.items() if status == 'found'},
+            'not_found': [serial for serial, (status, row) in results.items() if status == 'not_found'],
+            'failed': [serial for serial, (status, row) in results.items() if status not in ('found', 'not_found')]
+        })
 
     except Exception as e:
-        logging.error(f"Error in lookup_serial API: {str(e)}")
+        db.session.rollback()
+        logging.error(f"Error in lookup_serials API: {str(e)}")
         return jsonify({
             'success': False,
             'message': f'Internal error: {str(e)}'
@@ -654,12 +812,11 @@ def delete_line_item(line_id):
             })
         else:
             # Delete line item and all its serial numbers
-            serial_numbers = [sn.serial_number for sn in invoice_line.serial_numbers]
-
-            for serial_num in invoice_line.serial_numbers:
-                db.session.delete(serial_num)
+            serial_numbers = db.session.execute(
+                db.select(InvoiceSerialNumber.serial_number).filter_by(invoice_line_id=invoice_line.id)).scalars().all()
 
-            db.session.delete(invoice_line)
+            delete_serials(InvoiceSerialNumber, 'invoice_line_id', [invoice_line.id])
+            InvoiceLine.query.filter_by(id=invoice_line.id).delete(synchronize_session=False)
             db.session.commit()
 
             logging.info(f" Invoice line item {line_id} deleted from invoice {invoice.id}")
@@ -789,7 +946,7 @@ def create_invoice():
             line_number += 1
 
         # Store JSON payload
-        invoice.json_payload = json.dumps(sap_invoice, indent=2)
+        invoice.json_payload = fast_json.dumps(sap_invoice)
 
         # Create invoice in SAP
         sap = SAPIntegration()
@@ -798,22 +955,25 @@ def create_invoice():
                 'success': False,
                 'message': 'SAP connection failed'
             }), 500
-        print (sap_invoice)
+        payload_log.info("SAP Invoice JSON: %s", LazyJson(sap_invoice))
         try:
             url = f"{sap.base_url}/b1s/v1/Invoices"
             response = sap.session.post(url, json=sap_invoice, timeout=60)
 
             logging.info(f"SAP Invoice Creation Response Status: {response.status_code}")
-            logging.info(f"SAP Invoice Creation Response: {response.text}")
+            payload_log.info("SAP Invoice Creation Response: %s", response.text)
 
             if response.status_code == 201:
                 sap_response = response.json()
-                invoice.sap_response = json.dumps(sap_response, indent=2)
+                invoice.sap_response = fast_json.dumps(sap_response)
                 invoice.sap_doc_entry = sap_response.get('DocEntry')
                 invoice.sap_doc_num = sap_response.get('DocNum')
                 invoice.invoice_number = str(sap_response.get('DocNum'))
                 invoice.status = 'created'
                 invoice.total_amount = sap_response.get('DocTotal', 0)
+                invalidate_serial_lookups([serial.serial_number for line in invoice.lines
+                                           for serial in line.serial_numbers])
+                _delete_draft_items(serial_numbers)
 
                 db.session.commit()
 
@@ -935,6 +1095,7 @@ def create_invoice_ajax():
             db.session.add(serial_number)
             line_number += 1
 
+        _delete_draft_items([item.get('serial_number') for item in serial_items])
         db.session.commit()
 
         logging.info(f" Invoice {invoice_number} created successfully")
@@ -971,58 +1132,21 @@ def generate_invoice_number():
 
 
 def build_sap_invoice_data(invoice):
-    """Build SAP B1 Invoice JSON structure with proper BaseLineNumber grouping by ItemCode"""
+    """Build SAP B1 Invoice JSON structure with BaseLineNumber grouping by ItemCode, WarehouseCode and BPL"""
     try:
-        # Get invoice lines with serial numbers
-        invoice_lines = InvoiceLine.query.filter_by(invoice_id=invoice.id).all()
-
-        # Group by ItemCode to assign proper BaseLineNumber (0, 1, 2, etc.)
-        grouped_items = {}
-        base_line_counter = 0
-
-        for line in invoice_lines:
-            # Get serial numbers for this line
-            serial_numbers = InvoiceSerialNumber.query.filter_by(invoice_line_id=line.id).all()
-
-            item_key = line.item_code
-
-            # If this ItemCode hasn't been seen before, create new group
-            if item_key not in grouped_items:
-                grouped_items[item_key] = {
-                    "ItemCode": line.item_code,
-                    "ItemDescription": line.item_description,
-                    "WarehouseCode": line.warehouse_code,
-                    # '"TaxCode": line.tax_code or "IGST0",
-                    "BaseLineNumber": base_line_counter,
-                    "SerialNumbers": [],
-                    "TotalQuantity": 0
-                }
-                base_line_counter += 1
-
-            # Add serial numbers to this item group
-            for serial in serial_numbers:
-                grouped_items[item_key]["SerialNumbers"].append({
-                    "InternalSerialNumber": serial.serial_number,
-                    "BaseLineNumber": grouped_items[item_key]["BaseLineNumber"],
-                    "Quantity": 1.0
-                })
-                grouped_items[item_key]["TotalQuantity"] += 1
-
-        # Build DocumentLines from grouped items
-        document_lines = []
-        for item_data in grouped_items.values():
-            line_data = {
-                "ItemCode": item_data["ItemCode"],
-                "ItemDescription": item_data["ItemDescription"],
-                "Quantity": float(item_data["TotalQuantity"]),
-                "WarehouseCode": item_data["WarehouseCode"],
-                # "TaxCode": item_data["TaxCode"]
-            }
-
-            if item_data["SerialNumbers"]:
-                line_data["SerialNumbers"] = item_data["SerialNumbers"]
-
-            document_lines.append(line_data)
+        # Invoice lines with their serial numbers in one query; lines without serials keep their quantity
+        rows = db.session.execute(
+            db.select(InvoiceLine.item_code.label('ItemCode'),
+                      InvoiceLine.item_description.label('ItemDescription'),
+                      InvoiceLine.warehouse_code.label('WarehouseCode'),
+                      InvoiceSerialNumber.bpl_id.label('BPL_ID'),
+                      InvoiceSerialNumber.serial_number.label('SerialNumber'),
+                      db.func.coalesce(InvoiceSerialNumber.quantity, InvoiceLine.quantity).label('Quantity'))
+            .outerjoin(InvoiceSerialNumber, InvoiceSerialNumber.invoice_line_id == InvoiceLine.id)
+            .where(InvoiceLine.invoice_id == invoice.id)
+            .order_by(InvoiceLine.id, InvoiceSerialNumber.id)
+        ).mappings().all()
+        document_lines = build_document_lines(rows)
 
         # Build complete invoice structure as per user JSON specification
         from datetime import datetime, timedelta
@@ -1038,8 +1162,8 @@ def build_sap_invoice_data(invoice):
             "DocumentLines": document_lines
         }
 
-        logging.info(f"📄 Built SAP invoice data with {len(document_lines)} document lines grouped by ItemCode:")
-        logging.info(f"📄 SAP Invoice JSON: {json.dumps(sap_data, indent=2)}")
+        logging.info(f"📄 Built SAP invoice data with {len(document_lines)} document lines")
+        payload_log.info("📄 SAP Invoice JSON: %s", LazyJson(sap_data))
         return sap_data
 
     except Exception as e:
@@ -1050,7 +1174,7 @@ def build_sap_invoice_data(invoice):
 @invoice_bp.route('/add-serial-item', methods=['POST'])
 @login_required
 def add_serial_item():
-    """Add serial item to invoice (session-based storage like Serial Item Transfer)"""
+    """Add serial item to the current user's server-side invoice draft"""
     try:
         data = request.get_json()
         serial_number = data.get('serial_number', '').strip()
@@ -1061,13 +1185,12 @@ def add_serial_item():
                 'error': 'Serial number is required'
             }), 400
 
-        # Get session-based temporary invoice items (similar to Serial Item Transfer workflow)
-        if 'invoice_items' not in session:
-            session['invoice_items'] = []
+        # Drop the legacy cookie-stored list so it stops being re-sent with every request
+        session.pop('invoice_items', None)
+        _expire_draft_items()
 
-        # Check if serial number already exists in session
-        existing_items = session['invoice_items']
-        if any(item['serial_number'] == serial_number for item in existing_items):
+        # Duplicate check is an indexed lookup on (user_id, serial_number)
+        if InvoiceDraftItem.query.filter_by(user_id=current_user.id, serial_number=serial_number).first():
             return jsonify({
                 'success': False,
                 'error': 'Serial number already added to this invoice'
@@ -1086,31 +1209,26 @@ def add_serial_item():
 
         # If validation data not provided, try to validate again
         if not item_code:
-            # Use the same validation logic as the validate-serial-number endpoint
+            # Use the same validation logic as the validate-serial-number endpoint. This path used to
+            # call SQLQueries('Invoice_creation'), which sap_sql_queries never provisions - only
+            # 'Invoise_creation' exists - so it got a 404 and kept the client-supplied item data.
             try:
-                if sap.base_url and sap.username and sap.password and sap.ensure_logged_in():
-                    url = f"{sap.base_url}/b1s/v1/SQLQueries('Invoice_creation')/List"
-                    payload = {"ParamList": f"serial_number='{serial_number}'"}
-
-                    response = sap.session.post(url, json=payload, timeout=15)
-
-                    if response.status_code == 200:
-                        results = response.json().get('value', [])
-                        if results:
-                            validation_data = results[0]
-                            item_code = validation_data.get('ItemCode', item_code)
-                            item_description = validation_data.get('itemName',
-                                                                   validation_data.get('ItemName', item_description))
-                            warehouse_code = validation_data.get('WhsCode', warehouse_code)
-                            customer_code = validation_data.get('CardCode', customer_code)
-                            customer_name = validation_data.get('CardName', customer_name)
-                        else:
-                            # Use fallback data if not found in SAP
-                            item_code = item_code or 'MI Phone'
-                            item_description = item_description or ''
-                            warehouse_code = warehouse_code or ''
-                            customer_code = customer_code or ''
-                            customer_name = customer_name or ''
+                if sap.base_url and sap.username and sap.password:
+                    status, validation_data, error, cached = lookup_serial_cached(serial_number, sap)
+                    if status == 'found':
+                        item_code = validation_data.get('ItemCode', item_code)
+                        item_description = validation_data.get('itemName',
+                                                               validation_data.get('ItemName', item_description))
+                        warehouse_code = validation_data.get('WhsCode', warehouse_code)
+                        customer_code = validation_data.get('CardCode', customer_code)
+                        customer_name = validation_data.get('CardName', customer_name)
+                    elif status == 'not_found':
+                        # Use fallback data if not found in SAP
+                        item_code = item_code or 'MI Phone'
+                        item_description = item_description or ''
+                        warehouse_code = warehouse_code or ''
+                        customer_code = customer_code or ''
+                        customer_name = customer_name or ''
             except Exception as e:
                 logging.warning(f" Validation during add failed, using provided data: {e}")
                 # Use provided data or fallback
@@ -1120,37 +1238,46 @@ def add_serial_item():
                 customer_code = customer_code or ''
                 customer_name = customer_name or ''
 
-        # Create item data structure
-        item_data = {
-            'id': len(existing_items) + 1,  # Simple ID for frontend
-            'serial_number': serial_number,
-            'item_code': item_code,
-            'item_description': item_description,
-            'warehouse_code': warehouse_code,
-            'customer_code': customer_code,
-            'customer_name': customer_name,
-            'quantity': 1,
-            'validation_status': 'validated',
-            'line_number': len(existing_items) + 1,
-            'created_at': datetime.now().isoformat()
-        }
+        max_line = db.session.query(db.func.max(InvoiceDraftItem.line_number)).filter_by(
+            user_id=current_user.id).scalar() or 0
+
+        draft_item = InvoiceDraftItem()
+        draft_item.user_id = current_user.id
+        draft_item.serial_number = serial_number
+        draft_item.item_code = item_code
+        draft_item.item_description = item_description
+        draft_item.warehouse_code = warehouse_code
+        draft_item.customer_code = customer_code
+        draft_item.customer_name = customer_name
+        draft_item.quantity = 1
+        draft_item.validation_status = 'validated'
+        draft_item.line_number = max_line + 1
+        db.session.add(draft_item)
 
-        # Add to session
-        existing_items.append(item_data)
-        session['invoice_items'] = existing_items
-        session.modified = True
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Same serial scanned twice concurrently
+            db.session.rollback()
+            return jsonify({
+                'success': False,
+                'error': 'Serial number already added to this invoice'
+            }), 400
 
-        logging.info(f" Added serial item to session: {serial_number}")
+        logging.info(f" Added serial item to invoice draft: {serial_number}")
 
+        # Only the new item is returned; the client appends it to its own list
         return jsonify({
             'success': True,
             'message': f'Serial number {serial_number} added successfully',
             'item_added': True,
             'validation_status': 'validated',
-            'item_data': item_data
+            'item_data': draft_item.to_dict(),
+            'count': InvoiceDraftItem.query.filter_by(user_id=current_user.id).count()
         })
 
     except Exception as e:
+        db.session.rollback()
         logging.error(f" Error adding serial item: {str(e)}")
         return jsonify({
             'success': False,
@@ -1161,27 +1288,18 @@ def add_serial_item():
 @invoice_bp.route('/remove-serial-item/<int:item_id>', methods=['POST'])
 @login_required
 def remove_serial_item(item_id):
-    """Remove serial item from session (like Serial Item Transfer delete)"""
+    """Remove serial item from the invoice draft (like Serial Item Transfer delete)"""
     try:
-        if 'invoice_items' not in session:
-            return jsonify({
-                'success': False,
-                'error': 'No items to remove'
-            }), 400
-
-        # Find and remove item by ID
-        existing_items = session['invoice_items']
-        original_length = len(existing_items)
-
-        # Filter out the item with matching ID
-        session['invoice_items'] = [item for item in existing_items if item.get('id') != item_id]
-        session.modified = True
+        removed = InvoiceDraftItem.query.filter_by(id=item_id, user_id=current_user.id).delete()
+        db.session.commit()
 
-        if len(session['invoice_items']) < original_length:
+        if removed:
             logging.info(f" Removed serial item with ID: {item_id}")
             return jsonify({
                 'success': True,
-                'message': 'Serial item removed successfully'
+                'message': 'Serial item removed successfully',
+                'removed_id': item_id,
+                'count': InvoiceDraftItem.query.filter_by(user_id=current_user.id).count()
             })
         else:
             return jsonify({
@@ -1190,6 +1308,7 @@ def remove_serial_item(item_id):
             }), 404
 
     except Exception as e:
+        db.session.rollback()
         logging.error(f" Error removing serial item: {str(e)}")
         return jsonify({
             'success': False,
@@ -1200,18 +1319,20 @@ def remove_serial_item(item_id):
 @invoice_bp.route('/clear-session-items', methods=['POST'])
 @login_required
 def clear_session_items():
-    """Clear all session items (for Clear All button)"""
+    """Clear all draft items (for Clear All button)"""
     try:
+        InvoiceDraftItem.query.filter_by(user_id=current_user.id).delete()
+        db.session.commit()
         session.pop('invoice_items', None)
-        session.modified = True
 
-        logging.info("🧹 Cleared all session invoice items")
+        logging.info("🧹 Cleared all invoice draft items")
         return jsonify({
             'success': True,
             'message': 'All items cleared'
         })
 
     except Exception as e:
+        db.session.rollback()
         logging.error(f" Error clearing session items: {str(e)}")
         return jsonify({
             'success': False,
@@ -1219,6 +1340,35 @@ def clear_session_items():
         }), 500
 
 
+@invoice_bp.route('/draft-items', methods=['GET'])
+@login_required
+def get_draft_items():
+    """
+    Invoice draft items for the current user.
+    Pass after_id to receive only items added after the last one the client has.
+    """
+    try:
+        _expire_draft_items()
+        after_id = request.args.get('after_id', 0, type=int)
+        query = InvoiceDraftItem.query.filter(InvoiceDraftItem.user_id == current_user.id)
+        if after_id:
+            query = query.filter(InvoiceDraftItem.id > after_id)
+        items = query.order_by(InvoiceDraftItem.id).all()
+
+        return jsonify({
+            'success': True,
+            'items': [item.to_dict() for item in items],
+            'count': InvoiceDraftItem.query.filter_by(user_id=current_user.id).count()
+        })
+
+    except Exception as e:
+        logging.error(f" Error loading invoice draft items: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'Failed to load draft items: {str(e)}'
+        }), 500
+
+
 # New line-by-line endpoints for immediate database persistence
 @invoice_bp.route('/<int:invoice_id>/add_line_item', methods=['POST'])
 @login_required
@@ -1269,29 +1419,21 @@ def add_line_item(invoice_id):
         # Check SAP configuration and validate
         if sap.base_url and sap.username and sap.password and sap.ensure_logged_in():
             try:
-                # Use SAP SQL Query for Invoice Creation serial number validation
-                url = f"{sap.base_url}/b1s/v1/SQLQueries('Invoise_creation')/List"
-                payload = {
-                    "ParamList": f"serial_number='{serial_number}'"
-                }
-
-                response = sap.session.post(url, json=payload, timeout=30)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    results = data.get('value', [])
-
-                    if results:
-                        validation_result = results[0]
-
-                        validation_status = 'validated'
-                        logging.info(f" Serial {serial_number} validated successfully with SAP")
-                    else:
-                        validation_error = f'Serial number {serial_number} not found in SAP B1 inventory'
-                        logging.warning(f" Serial {serial_number} not found in SAP")
+                # Read-through SerialNumberLookup cache for Invoice Creation serial number validation
+                status, row, error, cached = lookup_serial_cached(serial_number, sap)
+
+                if status == 'found':
+                    validation_result = row
+
+                    validation_status = 'validated'
+                    logging.info(f" Serial {serial_number} validated successfully "
+                                 f"{'from cache' if cached else 'with SAP'}")
+                elif status == 'not_found':
+                    validation_error = f'Serial number {serial_number} not found in SAP B1 inventory'
+                    logging.warning(f" Serial {serial_number} not found in SAP")
                 else:
-                    validation_error = f'SAP API error: {response.status_code}'
-                    logging.error(f" SAP API error for {serial_number}: {response.status_code}")
+                    validation_error = error
+                    logging.error(f" SAP API error for {serial_number}: {error}")
             except Exception as e:
                 validation_error = f'SAP connection error: {str(e)}'
                 logging.error(f" SAP validation error for {serial_number}: {str(e)}")
@@ -1448,17 +1590,15 @@ def clear_all_items(invoice_id):
             return jsonify({'success': False, 'error': 'Cannot clear items from this invoice status'}), 400
 
         # Count items before deletion
-        item_count = len(invoice.lines)
+        line_ids = db.session.execute(
+            db.select(InvoiceLine.id).filter_by(invoice_id=invoice.id)).scalars().all()
+        item_count = len(line_ids)
         if item_count == 0:
             return jsonify({'success': False, 'error': 'No items to clear'}), 400
 
-        # Delete all invoice lines and their associated serial numbers
-        for line in invoice.lines:
-            # Delete all serial numbers for this line
-            for serial in line.serial_numbers:
-                db.session.delete(serial)
-            # Delete the line itself
-            db.session.delete(line)
+        # Delete all invoice lines and their associated serial numbers with set-based statements
+        delete_serials(InvoiceSerialNumber, 'invoice_line_id', line_ids)
+        InvoiceLine.query.filter_by(invoice_id=invoice.id).delete(synchronize_session=False)
 
         # Reset customer information when clearing all items
         invoice.customer_code = None
@@ -1583,6 +1723,8 @@ def submit_for_qc(invoice_id):
             invoice.customer_name = data.get('customer_name', '')
 
         invoice.status = 'pending_qc'
+        if invoice.user_id == current_user.id:
+            _delete_draft_items([serial.serial_number for line in invoice.lines for serial in line.serial_numbers])
         db.session.commit()
 
         logging.info(f" Invoice {invoice.id} submitted for QC approval")
@@ -1630,15 +1772,17 @@ def qc_approve_invoice(invoice_id):
         # sap_invoice_data['BPLName'] = 'ORD-CHENNAI'
 
         # Post to SAP B1
-        sap_result = post_invoice_to_sap_b1(sap_invoice_data)
+        sap_result = post_invoice_to_sap_b1(sap_invoice_data, invoice.id)
 
         if sap_result['success']:
             # Update invoice with SAP details
             invoice.status = 'posted'
             invoice.sap_doc_entry = sap_result.get('sap_doc_entry')
             invoice.sap_doc_num = sap_result.get('sap_doc_num')
-            invoice.sap_response = json.dumps(sap_result.get('sap_response', {}))
-            invoice.json_payload = json.dumps(sap_invoice_data)
+            invoice.sap_response = fast_json.dumps(sap_result.get('sap_response', {}))
+            invoice.json_payload = fast_json.dumps(sap_invoice_data)
+            invalidate_serial_lookups([serial.serial_number for line in invoice.lines
+                                       for serial in line.serial_numbers])
 
             db.session.commit()
 
@@ -1707,53 +1851,31 @@ def qc_reject_invoice(invoice_id):
         }), 500
 
 
+def invoice_serial_rows(invoice_id):
+    """Serial rows of an invoice, in line order, as mappings for invoice_payload.build_document_lines"""
+    return db.session.execute(
+        db.select(InvoiceSerialNumber.item_code.label('ItemCode'),
+                  InvoiceSerialNumber.item_description.label('ItemDescription'),
+                  InvoiceSerialNumber.warehouse_code.label('WarehouseCode'),
+                  InvoiceSerialNumber.bpl_id.label('BPL_ID'),
+                  InvoiceSerialNumber.bpl_name.label('BPLName'),
+                  InvoiceSerialNumber.serial_number.label('SerialNumber'),
+                  InvoiceSerialNumber.quantity.label('Quantity'))
+        .join(InvoiceLine, InvoiceSerialNumber.invoice_line_id == InvoiceLine.id)
+        .where(InvoiceLine.invoice_id == invoice_id)
+        .order_by(InvoiceLine.id, InvoiceSerialNumber.id)
+    ).mappings().all()
+
+
 def generate_sap_invoice_json(invoice):
     """Generate SAP B1 Invoice JSON based on invoice line items"""
     try:
-        # Group serial numbers by ItemCode and WarehouseCode for proper line grouping
-        grouped_items = {}
-
-        for line in invoice.lines:
-            for serial_item in line.serial_numbers:
-                # Create a unique key for grouping: ItemCode + WarehouseCode
-                group_key = f"{serial_item.item_code}_{serial_item.warehouse_code}"
-
-                if group_key not in grouped_items:
-                    grouped_items[group_key] = {
-                        'ItemCode': serial_item.item_code,
-                        'ItemDescription': serial_item.item_description,
-                        'WarehouseCode': serial_item.warehouse_code,
-                        'SerialNumbers': []
-                    }
-
-                # Just store serials, we'll assign BaseLineNumber later
-                grouped_items[group_key]['SerialNumbers'].append({
-                    'InternalSerialNumber': serial_item.serial_number,
-                    'Quantity': float(serial_item.quantity)
-                })
-
-        # Convert grouped items to DocumentLines
-        document_lines = []
-        base_line_number = 0  # counter for items
-
-        for group_key, item_data in grouped_items.items():
-            # Assign same BaseLineNumber for all serials of this item
-            for serial in item_data['SerialNumbers']:
-                serial['BaseLineNumber'] = base_line_number
-
-            document_lines.append({
-                'ItemCode': item_data['ItemCode'],
-                'ItemDescription': item_data['ItemDescription'],
-                'Quantity': float(len(item_data['SerialNumbers'])),  # Total quantity = number of serials
-                'WarehouseCode': item_data['WarehouseCode'],
-                # 'TaxCode': item_data['TaxCode'],
-                'SerialNumbers': item_data['SerialNumbers']
-            })
-
-            base_line_number += 1  # move to next item line
+        # One line per ItemCode + WarehouseCode + BPL, built from a single serial query
+        rows = invoice_serial_rows(invoice.id)
+        document_lines = build_document_lines(rows)
 
         # Get BPL info from first serial item if available
-        first_serial = invoice.lines[0].serial_numbers[0] if invoice.lines and invoice.lines[0].serial_numbers else None
+        first_serial = rows[0] if rows else {}
 
         # Generate SAP B1 Invoice JSON
         sap_invoice = {
@@ -1761,9 +1883,9 @@ def generate_sap_invoice_json(invoice):
             "U_EA_CREATEDBy": invoice.user.username,
             "U_EA_Approved": current_user.username,
             'DocDueDate': (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'BPL_IDAssignedToInvoice': getattr(first_serial, 'bpl_id', 5) if first_serial else 5,
+            'BPL_IDAssignedToInvoice': first_serial.get('BPL_ID', 5),
             # Default to 5 if not set
-            'BPLName': getattr(first_serial, 'bpl_name', 'ORD-CHENNAI') if first_serial else 'ORD-CHENNAI',
+            'BPLName': first_serial.get('BPLName', 'ORD-CHENNAI'),
             'CardCode': invoice.customer_code,
             'DocumentLines': document_lines
         }
@@ -1776,7 +1898,7 @@ def generate_sap_invoice_json(invoice):
         raise
 
 
-def post_invoice_to_sap_b1(invoice_data):
+def post_invoice_to_sap_b1(invoice_data, invoice_id):
     """Post invoice to SAP B1 and return result"""
     try:
         sap = SAPIntegration()
@@ -1796,19 +1918,16 @@ def post_invoice_to_sap_b1(invoice_data):
                 'error': 'SAP B1 login failed'
             }
 
-        # Post to SAP B1 Invoices endpoint
-        url = f"{sap.base_url}/b1s/v1/Invoices"
-
-        logging.info(f"Posting invoice to SAP B1: {url}")
-        logging.info(f"Invoice data: {json.dumps(invoice_data, indent=2)}")
+        # Post to SAP B1 Invoices endpoint (retries of the same invoice content are no-ops)
+        logging.info(f"Posting invoice {invoice_id} to SAP B1: {sap.base_url}/b1s/v1/Invoices")
+        payload_log.info("Invoice data: %s", LazyJson(invoice_data))
 
-        response = sap.session.post(url, json=invoice_data, timeout=30)
+        result = post_document(sap, 'Invoices', 'invoice', invoice_id, invoice_data, timeout=30)
 
-        if response.status_code == 201:
+        if result['success']:
             # Success - extract DocEntry and DocNum from response
-            sap_response = response.json()
-            doc_entry = sap_response.get('DocEntry')
-            doc_num = sap_response.get('DocNum')
+            doc_entry = result['doc_entry']
+            doc_num = result['doc_num']
 
             logging.info(f" Invoice posted successfully to SAP B1 (DocEntry: {doc_entry}, DocNum: {doc_num})")
 
@@ -1816,10 +1935,11 @@ def post_invoice_to_sap_b1(invoice_data):
                 'success': True,
                 'sap_doc_entry': doc_entry,
                 'sap_doc_num': doc_num,
-                'sap_response': sap_response
+                'sap_response': result['data'],
+                'duplicate': result['duplicate']
             }
         else:
-            error_msg = f"HTTP {response.status_code}: {response.text}"
+            error_msg = result['error']
             logging.error(f" SAP B1 invoice posting failed: {error_msg}")
 
             return {
@@ -4,10 +4,13 @@ from datetime import datetime
 import logging
 import json
 import re
+import requests
 
 from app import db
-from models import SerialItemTransfer, SerialItemTransferItem, DocumentNumberSeries
+from models import SerialItemTransfer, SerialItemTransferItem, DocumentNumberSeries, SerialItemTransferPostingChunk
 from sap_integration import SAPIntegration
+from sap_async_client import AsyncSAPClient
+from sap_idempotency import post_document
 from sqlalchemy import or_
 
 # Create blueprint for Serial Item Transfer module
@@ -750,6 +753,75 @@ def validate_serial_only(transfer_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# Most serials validate_serials accepts in one paste
+MAX_BULK_VALIDATION_SERIALS = 2000
+
+
+@serial_item_bp.route('/<int:transfer_id>/validate_serials', methods=['POST'])
+@login_required
+def validate_serials(transfer_id):
+    """Validate many pasted serial numbers at once (SAP calls run concurrently) without adding them"""
+    try:
+        transfer = SerialItemTransfer.query.get_or_404(transfer_id)
+
+        # Check permissions
+        if transfer.user_id != current_user.id and current_user.role not in ['admin', 'manager']:
+            return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+        if transfer.status != 'draft':
+            return jsonify({'success': False, 'error': 'Cannot validate items for non-draft transfer'}), 400
+
+        # One serial per line (or comma separated), duplicates collapsed
+        serial_numbers = list(dict.fromkeys(
+            serial.strip() for serial in re.split(r'[\r\n,]+', request.form.get('serial_numbers', '')) if serial.strip()))
+
+        if not serial_numbers:
+            return jsonify({'success': False, 'error': 'Serial numbers are required'}), 400
+        if len(serial_numbers) > MAX_BULK_VALIDATION_SERIALS:
+            return jsonify({'success': False,
+                            'error': f'At most {MAX_BULK_VALIDATION_SERIALS} serial numbers can be validated at once'}), 400
+
+        existing = {serial for (serial,) in db.session.query(SerialItemTransferItem.serial_number).filter(
+            SerialItemTransferItem.serial_item_transfer_id == transfer.id,
+            SerialItemTransferItem.serial_number.in_(serial_numbers))}
+
+        # Validate serial numbers with SAP B1
+        client = AsyncSAPClient()
+        if not client.ensure_logged_in():
+            return jsonify({'success': False, 'error': 'SAP B1 connection failed'}), 503
+        validation_results = client.run(client.validate_serials(
+            [serial for serial in serial_numbers if serial not in existing], transfer.from_warehouse))
+
+        results = []
+        for serial_number in serial_numbers:
+            if serial_number in existing:
+                results.append({'serial_number': serial_number, 'valid': False,
+                                'error': f'Serial number {serial_number} already exists in this transfer'})
+                continue
+            validation_result = validation_results[serial_number]
+            results.append({
+                'serial_number': serial_number,
+                'valid': validation_result.get('valid', False),
+                'item_code': validation_result.get('item_code'),
+                'item_description': validation_result.get('item_description'),
+                'warehouse_code': validation_result.get('warehouse_code'),
+                'error': validation_result.get('error')
+            })
+
+        valid_count = sum(1 for result in results if result['valid'])
+        logging.info(f"Bulk validated {len(serial_numbers)} serials for transfer {transfer_id}: {valid_count} valid")
+        return jsonify({
+            'success': True,
+            'results': results,
+            'valid_count': valid_count,
+            'invalid_count': len(results) - valid_count
+        })
+
+    except Exception as e:
+        logging.error(f"Error bulk validating serial items: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @serial_item_bp.route('/<int:transfer_id>/add_multiple_serials', methods=['POST'])
 @login_required
 def add_multiple_serials(transfer_id):
@@ -885,11 +957,160 @@ def get_warehouse_items(transfer_id):
         logging.error(f"Error fetching warehouse items: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Serial lines per SAP Stock Transfer document when posting large transfers
+POSTING_CHUNK_SIZE = 500
+
+
+def _plan_posting_chunks(transfer):
+    """Return the posting chunks for a transfer, creating pending ones on first post"""
+    chunks = SerialItemTransferPostingChunk.query.filter_by(
+        serial_item_transfer_id=transfer.id
+    ).order_by(SerialItemTransferPostingChunk.chunk_index).all()
+    if chunks:
+        return chunks
+
+    eligible_ids = sorted(item.id for item in transfer.items
+                          if item.qc_status == 'approved' and item.validation_status == 'validated')
+    for index, start in enumerate(range(0, len(eligible_ids), POSTING_CHUNK_SIZE), start=1):
+        chunk = SerialItemTransferPostingChunk()
+        chunk.serial_item_transfer_id = transfer.id
+        chunk.chunk_index = index
+        chunk.item_ids = json.dumps(eligible_ids[start:start + POSTING_CHUNK_SIZE])
+        chunk.status = 'pending'
+        db.session.add(chunk)
+        chunks.append(chunk)
+
+    db.session.commit()
+    return chunks
+
+
+def _build_chunk_transfer_data(sap, transfer, items, bpl_id, chunk_index, chunk_count):
+    """Build SAP B1 Stock Transfer JSON for one chunk of transfer items"""
+    part_suffix = f" (Part {chunk_index}/{chunk_count})" if chunk_count > 1 else ""
+    sap_transfer_data = {
+        "DocDate": datetime.now().strftime('%Y-%m-%d'),
+        "DueDate": datetime.now().strftime('%Y-%m-%d'),
+        "CardCode": "",
+        "CardName": "",
+        "Address": "",
+        "BPLID": bpl_id,
+        "U_EA_CREATEDBy": transfer.user.username,
+        "U_EA_Approved": current_user.username,
+        "Comments": f"Serial Number Item Transfer from WMS - {current_user.username}",
+        "JournalMemo": f"Serial Number Item Transfer - {transfer.transfer_number}{part_suffix}",
+        #"PriceList": -1,
+        #"SalesPersonCode": -1,
+        "FromWarehouse": transfer.from_warehouse,
+        "ToWarehouse": transfer.to_warehouse,
+        "AuthorizationStatus": "",
+        "StockTransferLines": []
+    }
+
+    # Resolve the chunk's SystemNumbers concurrently instead of one blocking lookup per serial
+    client = AsyncSAPClient(sap)
+    system_numbers = client.run(client.get_system_numbers(
+        item.serial_number for item in items if item.item_type != 'non_serial'))
+
+    item_groups = {}
+    for item in items:
+        if item.item_code not in item_groups:
+            item_groups[item.item_code] = {
+                'item_code': item.item_code,
+                'item_description': item.item_description,
+                'serials': [],
+                'quantity': 0
+            }
+
+        # Handle serial vs non-serial items differently for quantity and serial numbers
+        if item.item_type == 'non_serial':
+            # For non-serial items, use the actual quantity from database record
+            item_groups[item.item_code]['quantity'] += item.quantity
+            # Do not add any serial number entries for non-serial items - keep SerialNumbers array empty
+        else:
+            # For serial items, add actual serial number and increment quantity by 1
+            item_groups[item.item_code]['serials'].append({
+                "SystemSerialNumber": system_numbers.get(item.serial_number, 0),
+                "InternalSerialNumber": item.serial_number,
+                "ManufacturerSerialNumber": item.serial_number,
+                "Location": None,
+                "Notes": None
+            })
+            item_groups[item.item_code]['quantity'] += 1
+
+    # Create stock transfer lines
+    for line_num, (item_code, group_data) in enumerate(item_groups.items()):
+        sap_transfer_data["StockTransferLines"].append({
+            "LineNum": line_num,
+            "ItemCode": item_code,
+            "Quantity": group_data['quantity'],
+            "WarehouseCode": transfer.to_warehouse,
+            "FromWarehouseCode": transfer.from_warehouse,
+            "UoMCode": "",
+            "SerialNumbers": group_data['serials']
+        })
+
+    return sap_transfer_data
+
+
+def _post_chunk(sap, transfer, chunk, items_by_id, bpl_id, chunk_count):
+    """
+    Post one chunk as a Stock Transfer and checkpoint the result.
+    Returns (success, transient) - transient failures (timeouts, connection
+    errors, SAP 5xx) leave the transfer resumable.
+    """
+    items = [items_by_id[item_id] for item_id in chunk.get_item_ids() if item_id in items_by_id]
+    sap_transfer_data = _build_chunk_transfer_data(sap, transfer, items, bpl_id, chunk.chunk_index, chunk_count)
+
+    # Determine timeout based on chunk size (chunks never exceed POSTING_CHUNK_SIZE items)
+    if len(items) > 100:
+        timeout = 120  # 2 minutes for medium and full chunks
+    else:
+        timeout = 60   # 1 minute for small chunks
+
+    logging.info(f"Posting chunk {chunk.chunk_index}/{chunk_count} ({len(items)} items) "
+                 f"of {transfer.transfer_number} to SAP B1 with {timeout}s timeout")
+
+    chunk.attempts = (chunk.attempts or 0) + 1
+    transient = False
+    try:
+        # Idempotent per chunk, so resuming after a timeout that did reach SAP
+        # picks up the existing document instead of posting it twice. The payload is
+        # rebuilt on resume (approver, SystemSerialNumber lookups), so the attempt is
+        # keyed by the chunk rather than by the payload hash.
+        result = post_document(sap, 'StockTransfers', 'serial_item_chunk', chunk.id,
+                               sap_transfer_data, timeout=timeout, attempt_key='chunk')
+
+        if result['success']:
+            chunk.status = 'posted'
+            chunk.sap_doc_entry = result['doc_entry']
+            chunk.sap_document_number = result['doc_num']
+            chunk.error_message = None
+        else:
+            logging.error(f"SAP B1 API error: {result['error']}")
+            chunk.status = 'failed'
+            chunk.error_message = f"SAP B1 API error: {result['error']}"
+            transient = result.get('in_progress') or (result['response'] is not None
+                                                      and result['response'].status_code >= 500)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as api_error:
+        logging.error(f"SAP B1 connection error: {str(api_error)}")
+        chunk.status = 'failed'
+        chunk.error_message = f'SAP B1 connection error: {str(api_error)}'
+        transient = True
+
+    chunk.updated_at = datetime.utcnow()
+    db.session.commit()  # Checkpoint after every chunk
+    return chunk.status == 'posted', transient
+
+
 #SerialItemTransfer Post to Sap_B1
 @serial_item_bp.route('/<int:transfer_id>/post_to_sap', methods=['POST'])
 @login_required
 def post_to_sap(transfer_id):
-    """Post approved Serial Item Transfer to SAP B1 as Stock Transfer"""
+    """
+    Post approved Serial Item Transfer to SAP B1 as Stock Transfer(s).
+    Large transfers are split into chunks of POSTING_CHUNK_SIZE items, each
+    checkpointed; calling this again after a failure resumes the remaining chunks.
+    """
     sap = SAPIntegration()
     try:
         transfer = SerialItemTransfer.query.get_or_404(transfer_id)
@@ -909,166 +1130,132 @@ def post_to_sap(transfer_id):
         invalid_items = [item for item in transfer.items if item.validation_status != 'validated' or item.qc_status != 'approved']
         if invalid_items:
             return jsonify({'success': False, 'error': f'Cannot post transfer with {len(invalid_items)} invalid or unapproved items'}), 400
-        bplId=sap.get_warehouse_business_place_id(transfer.from_warehouse)
-
-        # Build SAP B1 Stock Transfer JSON
-        sap_transfer_data = {
-            "DocDate": datetime.now().strftime('%Y-%m-%d'),
-            "DueDate": datetime.now().strftime('%Y-%m-%d'),
-            "CardCode": "",
-            "CardName": "",
-            "Address": "",
-            "BPLID":bplId,
-            "U_EA_CREATEDBy": transfer.user.username,
-            "U_EA_Approved": current_user.username,
-            "Comments": f"Serial Number Item Transfer from WMS - {current_user.username}",
-            "JournalMemo": f"Serial Number Item Transfer - {transfer.transfer_number}",
-            #"PriceList": -1,
-            #"SalesPersonCode": -1,
-            "FromWarehouse": transfer.from_warehouse,
-            "ToWarehouse": transfer.to_warehouse,
-            "AuthorizationStatus": "",
-            "StockTransferLines": []
-        }
-
-        item_groups = {}
-        for item in transfer.items:
-            if item.qc_status == 'approved' and item.validation_status == 'validated':
-                if item.item_code not in item_groups:
-                    item_groups[item.item_code] = {
-                        'item_code': item.item_code,
-                        'item_description': item.item_description,
-                        'serials': [],
-                        'quantity': 0
-                    }
-
-                # 🔑 Fetch SystemNumber for *each serial individually*
-                system_number = get_system_number_from_sap(sap, item.serial_number)
-
-
-                # Handle serial vs non-serial items differently for quantity and serial numbers
-                if item.item_type == 'non_serial':
-                    # For non-serial items, use the actual quantity from database record
-                    item_groups[item.item_code]['quantity'] += item.quantity
-                    # Do not add any serial number entries for non-serial items - keep SerialNumbers array empty
-                else:
-                    # For serial items, add actual serial number and increment quantity by 1
-                    item_groups[item.item_code]['serials'].append({
-                        "SystemSerialNumber": system_number,
-                        "InternalSerialNumber": item.serial_number,
-                        "ManufacturerSerialNumber": item.serial_number,
-                        "Location": None,
-                        "Notes": None
-                    })
-                    item_groups[item.item_code]['quantity'] += 1
-
-        # Create stock transfer lines
-        line_num = 0
-        for item_code, group_data in item_groups.items():
-            sap_transfer_data["StockTransferLines"].append({
-                "LineNum": line_num,
-                "ItemCode": item_code,
-                "Quantity": group_data['quantity'],
-                "WarehouseCode": transfer.to_warehouse,
-                "FromWarehouseCode": transfer.from_warehouse,
-                "UoMCode": "",
-                "SerialNumbers": group_data['serials']
-            })
-            line_num += 1
 
         # Post to SAP B1 with optimized handling for large volumes
         if not sap.ensure_logged_in():
             return jsonify({'success': False, 'error': 'SAP B1 connection failed'}), 500
-        
-        item_count = len(transfer.items)
-        logging.info(f"Preparing to post {item_count} items to SAP B1")
-        
-        # For very large transfers (>800 items), use SAP integration method with batching
-        if item_count > 800:
-            logging.info(f"Large volume transfer detected ({item_count} items), using optimized SAP integration")
-            sap_result = sap.create_serial_item_stock_transfer(transfer)
-        else:
-            # For smaller transfers, use direct API call
-            try:
-                url = f"{sap.base_url}/b1s/v1/StockTransfers"
-                
-                # Determine timeout based on transfer size
-                if item_count > 500:
-                    timeout = 300  # 5 minutes for large transfers
-                elif item_count > 100:
-                    timeout = 120  # 2 minutes for medium transfers
-                else:
-                    timeout = 60   # 1 minute for small transfers
-                
-                logging.info(f"Posting {item_count} items to SAP B1 with {timeout}s timeout")
-
-                response = sap.session.post(url, json=sap_transfer_data, timeout=timeout)
-
-                if response.status_code == 201:
-                    sap_doc = response.json()
-                    sap_result = {
-                        'success': True,
-                        'document_number': sap_doc.get('DocNum'),
-                        'doc_entry': sap_doc.get('DocEntry')
-                    }
-                else:
-                    error_text = response.text
-                    logging.error(f"SAP B1 API error: {response.status_code} - {error_text}")
-                    sap_result = {
-                        'success': False,
-                        'error': f'SAP B1 API error: {response.status_code} - {error_text}'
-                    }
-            except Exception as api_error:
-                logging.error(f"SAP B1 connection error: {str(api_error)}")
-                sap_result = {
-                    'success': False,
-                    'error': f'SAP B1 connection error: {str(api_error)}'
-                }
-
-        if sap_result.get('success'):
+
+        bplId = sap.get_warehouse_business_place_id(transfer.from_warehouse)
+        chunks = _plan_posting_chunks(transfer)
+        items_by_id = {item.id: item for item in transfer.items}
+        chunk_count = len(chunks)
+        logging.info(f"Preparing to post {len(items_by_id)} items to SAP B1 in {chunk_count} chunk(s)")
+
+        failed_chunk = None
+        transient = False
+        for chunk in chunks:
+            if chunk.status == 'posted':
+                continue  # Already in SAP from a previous attempt
+            posted, transient = _post_chunk(sap, transfer, chunk, items_by_id, bplId, chunk_count)
+            if not posted:
+                failed_chunk = chunk
+                break
+
+        posted_chunks = [chunk for chunk in chunks if chunk.status == 'posted']
+
+        if failed_chunk is None:
             # Update transfer status and SAP document info
+            doc_numbers = [chunk.sap_document_number for chunk in posted_chunks]
+            document_number = ', '.join(doc_numbers)
+            if len(document_number) > 50:
+                document_number = f"{doc_numbers[0]}..{doc_numbers[-1]}"
+
             transfer.status = 'posted'
-            transfer.sap_document_number = sap_result.get('document_number')
+            transfer.sap_document_number = document_number
             transfer.updated_at = datetime.utcnow()
 
             db.session.commit()
 
-            logging.info(f"Serial Item Transfer {transfer_id} posted to SAP B1: {sap_result.get('document_number')}")
+            logging.info(f"Serial Item Transfer {transfer_id} posted to SAP B1: {document_number}")
             return jsonify({
                 'success': True,
-                'message': f'Transfer posted to SAP B1 successfully. Document Number: {sap_result.get("document_number")}',
-                'sap_document_number': sap_result.get('document_number'),
-                'doc_entry': sap_result.get('doc_entry'),
+                'message': f'Transfer posted to SAP B1 successfully. Document Number: {document_number}',
+                'sap_document_number': document_number,
+                'doc_entry': posted_chunks[0].sap_doc_entry if len(posted_chunks) == 1 else None,
+                'doc_entries': [chunk.sap_doc_entry for chunk in posted_chunks],
                 'status': 'posted'
             })
-        else:
-            # Reject document and send back for editing when SAP posting fails
-            transfer.status = 'rejected'
-            transfer.qc_notes = f"SAP B1 posting failed: {sap_result.get('error', 'Unknown error')}. Document rejected for editing."
-            transfer.updated_at = datetime.utcnow()
-
-            # Reset QC approval to allow re-editing
-            for item in transfer.items:
-                item.qc_status = 'pending'
-                item.updated_at = datetime.utcnow()
 
+        error = failed_chunk.error_message or 'Unknown error'
+        if transient or posted_chunks:
+            # Keep the document approved so the remaining chunks can be resumed;
+            # chunks already in SAP are never re-posted
+            transfer.qc_notes = (f"SAP B1 posting stopped at part {failed_chunk.chunk_index}/{chunk_count}: {error}. "
+                                 f"{len(posted_chunks)} part(s) posted - post again to resume.")
+            transfer.updated_at = datetime.utcnow()
             db.session.commit()
 
-            logging.error(
-                f"SAP B1 posting failed for transfer {transfer_id}: {sap_result.get('error')} - Document rejected for editing")
+            logging.error(f"SAP B1 posting for transfer {transfer_id} stopped at chunk "
+                          f"{failed_chunk.chunk_index}/{chunk_count}: {error} - resumable")
             return jsonify({
                 'success': False,
-                'error': f'SAP B1 posting failed: {sap_result.get("error", "Unknown error")}. Document has been rejected and sent back for editing.',
-                'status': 'rejected',
-                'redirect_to_edit': True
+                'error': f'SAP B1 posting failed at part {failed_chunk.chunk_index} of {chunk_count}: {error}. '
+                         f'{len(posted_chunks)} part(s) already posted; post again to resume.',
+                'status': transfer.status,
+                'resumable': True,
+                'posted_chunks': len(posted_chunks),
+                'total_chunks': chunk_count
             }), 500
 
+        # Nothing reached SAP and the error is not transient: reject document and
+        # send back for editing; chunks are re-planned after the edit
+        for chunk in chunks:
+            db.session.delete(chunk)
+
+        transfer.status = 'rejected'
+        transfer.qc_notes = f"SAP B1 posting failed: {error}. Document rejected for editing."
+        transfer.updated_at = datetime.utcnow()
+
+        # Reset QC approval to allow re-editing
+        for item in transfer.items:
+            item.qc_status = 'pending'
+            item.updated_at = datetime.utcnow()
+
+        db.session.commit()
+
+        logging.error(
+            f"SAP B1 posting failed for transfer {transfer_id}: {error} - Document rejected for editing")
+        return jsonify({
+            'success': False,
+            'error': f'SAP B1 posting failed: {error}. Document has been rejected and sent back for editing.',
+            'status': 'rejected',
+            'redirect_to_edit': True
+        }), 500
+
     except Exception as e:
         logging.error(f"Error posting serial item transfer to SAP: {str(e)}")
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@serial_item_bp.route('/<int:transfer_id>/posting_status', methods=['GET'])
+@login_required
+def posting_status(transfer_id):
+    """Get per-chunk SAP posting state for a Serial Item Transfer"""
+    transfer = SerialItemTransfer.query.get_or_404(transfer_id)
+
+    if transfer.user_id != current_user.id and current_user.role not in ['admin', 'manager', 'qc']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    chunks = SerialItemTransferPostingChunk.query.filter_by(
+        serial_item_transfer_id=transfer.id
+    ).order_by(SerialItemTransferPostingChunk.chunk_index).all()
+
+    return jsonify({
+        'success': True,
+        'status': transfer.status,
+        'chunks': [{
+            'chunk_index': chunk.chunk_index,
+            'item_count': len(chunk.get_item_ids()),
+            'status': chunk.status,
+            'doc_entry': chunk.sap_doc_entry,
+            'document_number': chunk.sap_document_number,
+            'error': chunk.error_message,
+            'attempts': chunk.attempts
+        } for chunk in chunks]
+    })
+
+
 @serial_item_bp.route('/api/check-item-quantity', methods=['POST'])
 @login_required
 def check_item_quantity():
@@ -1117,32 +1304,6 @@ def check_item_quantity():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-# Helper: get SystemNumber from SAP for a serial
-def get_system_number_from_sap(sap,serial_number):
-    try:
-        if not sap.ensure_logged_in():
-            return jsonify({'success': False, 'error': 'SAP B1 connection failed'}), 500
-        url = f"{sap.base_url}/b1s/v1/SerialNumberDetails"
-        params = {
-            "$select": "SystemNumber",
-            "$filter": f"SerialNumber eq '{serial_number}'"
-        }
-        response = sap.session.get(url, params=params, timeout=15)
-
-        if response.status_code == 200:
-            data = response.json()
-
-           # logging.info(f"SAP response for {serial_number}: {data}")  # 👈 log full JSON
-            if "value" in data and len(data["value"]) > 0:
-                return data["value"][0].get("SystemNumber", 0)   # 👈 safe get
-        else:
-            logging.error(f"SAP error {response.status_code}: {response.text}")
-        return 0
-    except Exception as e:
-        logging.error(f"Error fetching SystemNumber for {serial_number}: {str(e)}")
-        return 0
-
-
 @serial_item_bp.route('/cleanup_empty_drafts', methods=['POST'])
 @login_required
 def cleanup_empty_drafts():
@@ -0,0 +1,74 @@
+"""
+Set-based maintenance of per-line serial number rows (SOInvoiceSerial, InvoiceSerialNumber).
+Instead of deleting and re-adding one ORM object per serial, the wanted serials are diffed
+against the stored ones and applied with one DELETE ... IN, one multi-row INSERT and, when
+positions moved, one executemany UPDATE. Callers commit.
+"""
+from sqlalchemy import delete, insert, select, update
+
+from app import db
+
+# Values per IN (...) list, well below the bind parameter limits of SQLite and MySQL
+IN_CHUNK_SIZE = 1000
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), IN_CHUNK_SIZE):
+        yield values[i:i + IN_CHUNK_SIZE]
+
+
+def diff_serials(existing, wanted):
+    """(added, removed) serial numbers; added keeps the order of wanted, duplicates are dropped"""
+    existing = set(existing)
+    wanted = list(dict.fromkeys(wanted))
+    wanted_set = set(wanted)
+    return [s for s in wanted if s not in existing], [s for s in existing if s not in wanted_set]
+
+
+def replace_serials(model, parent_column, parent_id, serial_numbers, position_column=None, **row_values):
+    """
+    Make the serial rows of one parent (e.g. an SOInvoiceItem) match serial_numbers.
+    Rows of serials that stay are kept; position_column, if given, is renumbered 1..n in
+    the order of serial_numbers. row_values are column values for the inserted rows.
+    Returns (added, removed) counts.
+    """
+    parent = getattr(model, parent_column)
+    position = getattr(model, position_column) if position_column else None
+    columns = (model.serial_number, model.id) + ((position,) if position is not None else ())
+    existing = {row[0]: row[1:] for row in db.session.execute(select(*columns).where(parent == parent_id))}
+    added, removed = diff_serials(existing, serial_numbers)
+
+    for chunk in _chunks(removed):
+        db.session.execute(delete(model).where(parent == parent_id, model.serial_number.in_(chunk)),
+                           execution_options={'synchronize_session': False})
+
+    positions = {serial: i + 1 for i, serial in enumerate(dict.fromkeys(serial_numbers))}
+    if added:
+        rows = []
+        for serial in added:
+            row = dict(row_values, serial_number=serial)
+            row[parent_column] = parent_id
+            if position_column:
+                row[position_column] = positions[serial]
+            rows.append(row)
+        db.session.execute(insert(model), rows)
+
+    if position_column:
+        kept = [{'id': row_id, position_column: positions[serial]}
+                for serial, (row_id, stored) in existing.items()
+                if serial in positions and stored != positions[serial]]
+        if kept:
+            db.session.execute(update(model), kept)
+    return len(added), len(removed)
+
+
+def delete_serials(model, parent_column, parent_ids):
+    """Delete all serial rows of the given parents; returns the number of rows deleted"""
+    parent = getattr(model, parent_column)
+    deleted = 0
+    for chunk in _chunks(parent_ids):
+        result = db.session.execute(delete(model).where(parent.in_(chunk)),
+                                    execution_options={'synchronize_session': False})
+        deleted += result.rowcount or 0
+    return deleted
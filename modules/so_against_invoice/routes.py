@@ -14,10 +14,19 @@ from app import app, db
 from models import User, DocumentNumberSeries
 from .models import SOInvoiceDocument, SOInvoiceItem, SOInvoiceSerial, SOSeries
 from sap_integration import SAPIntegration
+from sap_idempotency import post_document
+from logging_config import payload_log, LazyJson
+from invoice_payload import build_document_lines
+from cache_utils import TTLCache
+from modules.shared.serials import replace_serials
 
 # Create blueprint for SO Against Invoice module
 so_invoice_bp = Blueprint('so_against_invoice', __name__, template_folder='templates', url_prefix='/so-against-invoice')
 
+# (document id, SO DocEntry) -> per-line stock from SO_Line_Stock, kept while the draft is
+# being worked on; a new SO on the document changes the key, refresh=true re-reads SAP
+_line_stock_cache = TTLCache(ttl=8 * 3600, maxsize=1024)
+
 
 def generate_so_invoice_number():
     """Generate unique document number for SO Against Invoice"""
@@ -35,6 +44,53 @@ def validate_json_csrf():
     return True
 
 
+def open_sales_order(order):
+    """Copy of a (possibly cached) SAP Sales Order with only its open lines"""
+    order = dict(order)
+    order['DocumentLines'] = [
+        line for line in order.get('DocumentLines') or []
+        if line.get('LineStatus') == 'bost_Open'
+    ]
+    return order
+
+
+def get_document_line_stock(document, refresh=False):
+    """LineNum -> stock row for all lines of the document's Sales Order, or None if SAP is unavailable"""
+    key = (document.id, document.so_doc_entry)
+    if not refresh:
+        lines = _line_stock_cache.get(key)
+        if lines is not None:
+            return lines
+    lines = SAPIntegration().get_sales_order_line_stock(document.so_doc_entry)
+    if lines is not None:
+        _line_stock_cache.set(key, lines)
+    return lines
+
+
+def get_item_line_stock(data, refresh=False):
+    """Line stock for the doc_id/item_id in a request body, if it names a document line (cached unless refresh)"""
+    if not data.get('doc_id') or not data.get('item_id'):
+        return None
+    item = SOInvoiceItem.query.filter_by(id=data['item_id'], so_invoice_id=data['doc_id']).first()
+    if item is None or not item.so_invoice.so_doc_entry:
+        return None
+    lines = get_document_line_stock(item.so_invoice, refresh=refresh)
+    return (lines or {}).get(item.line_num)
+
+
+def cache_so_series(series_list):
+    """Upsert SAP SO series into SOSeries with one SELECT instead of one query per row"""
+    names = {row['Series']: row['SeriesName'] for row in series_list}
+    existing = {s.series: s for s in SOSeries.query.filter(SOSeries.series.in_(names)).all()} if names else {}
+    for series, series_name in names.items():
+        cached = existing.get(series)
+        if cached is None:
+            db.session.add(SOSeries(series=series, series_name=series_name))
+        elif cached.series_name != series_name:
+            cached.series_name = series_name
+    db.session.commit()
+
+
 @so_invoice_bp.route('/', methods=['GET'])
 @login_required
 def index():
@@ -228,16 +284,7 @@ def get_so_series():
                     series_list = data.get('value', [])
                     
                     # Cache series in database for faster lookup
-                    for series_data in series_list:
-                        existing_series = SOSeries.query.filter_by(series=series_data['Series']).first()
-                        if not existing_series:
-                            new_series = SOSeries(
-                                series=series_data['Series'],
-                                series_name=series_data['SeriesName']
-                            )
-                            db.session.add(new_series)
-                    
-                    db.session.commit()
+                    cache_so_series(series_list)
                     logging.info(f"Retrieved {len(series_list)} SO series from SAP B1")
                     
                     return jsonify({
@@ -309,36 +356,20 @@ def validate_so_number():
                 'error': 'SO Number and Series are required'
             }), 400
         
-        sap = SAPIntegration()
-        
-        # Try to validate with SAP B1
-        if sap.ensure_logged_in():
-            try:
-                url = f"{sap.base_url}/b1s/v1/SQLQueries('Get_SO_Details')/List"
-                request_body = {
-                    "ParamList": f"SONumber='{so_number}'&Series='{series}'"
-                }
-                response = sap.session.post(url, json=request_body, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    so_details = data.get('value', [])
-                    
-                    if so_details:
-                        doc_entry = so_details[0].get('DocEntry')
-                        return jsonify({
-                            'success': True,
-                            'doc_entry': doc_entry,
-                            'message': f'SO {so_number} validated successfully'
-                        })
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'error': f'SO Number {so_number} not found in Series {series}'
-                        }), 404
-                        
-            except Exception as e:
-                logging.error(f"Error validating SO with SAP: {str(e)}")
+        # Also caches the order, so the fetch-so-details call that follows needs no SAP call
+        result = SAPIntegration().resolve_sales_order(series, so_number)
+        if result['success']:
+            return jsonify({
+                'success': True,
+                'doc_entry': result['order'].get('DocEntry'),
+                'message': f'SO {so_number} validated successfully'
+            })
+        if result.get('not_found'):
+            return jsonify({
+                'success': False,
+                'error': result['error']
+            }), 404
+        logging.error(f"Error validating SO with SAP: {result['error']}")
         
         # Strict production check - never allow mock validation in production
         if is_production_environment():
@@ -474,46 +505,28 @@ def fetch_so_details():
                 'error': 'DocEntry is required'
             }), 400
 
-        sap = SAPIntegration()
-
-        if sap.ensure_logged_in():
-            try:
-                url = f"{sap.base_url}/b1s/v1/Orders?$filter=DocEntry eq {doc_entry}"
-                response = sap.session.get(url, timeout=10)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    orders = data.get('value', [])
-
-                    if orders:
-                        order = orders[0]
+        result = SAPIntegration().get_sales_order(doc_entry)
+        if result['success']:
+            order = result['order']
 
-                        # ✅ Check DocumentStatus
-                        if order.get("DocumentStatus") != "bost_Open":
-                            return jsonify({
-                                'success': False,
-                                'error': f"SO {doc_entry} is already closed"
-                            }), 400
-
-                        # ✅ Filter only open lines
-                        open_lines = [
-                            line for line in order.get("DocumentLines", [])
-                            if line.get("LineStatus") == "bost_Open"
-                        ]
-                        order["DocumentLines"] = open_lines
-
-                        return jsonify({
-                            'success': True,
-                            'order': order
-                        })
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'error': f'SO with DocEntry {doc_entry} not found'
-                        }), 404
+            # ✅ Check DocumentStatus
+            if order.get("DocumentStatus") != "bost_Open":
+                return jsonify({
+                    'success': False,
+                    'error': f"SO {doc_entry} is already closed"
+                }), 400
 
-            except Exception as e:
-                logging.error(f"Error fetching SO details from SAP: {str(e)}")
+            # ✅ Filter only open lines
+            return jsonify({
+                'success': True,
+                'order': open_sales_order(order)
+            })
+        if result.get('not_found'):
+            return jsonify({
+                'success': False,
+                'error': result['error']
+            }), 404
+        logging.error(f"Error fetching SO details from SAP: {result['error']}")
 
         if is_production_environment():
             return jsonify({
@@ -539,6 +552,62 @@ def fetch_so_details():
         }), 500
 
 
+# Steps 2 and 3 in one call: Series + SO Number -> open Sales Order
+@so_invoice_bp.route('/api/resolve-so', methods=['POST'])
+@login_required
+def resolve_so():
+    """Resolve SO Number with Series to the open Sales Order header and lines in one SAP call"""
+    if not current_user.has_permission('so_against_invoice'):
+        return jsonify({
+            'success': False,
+            'error': 'Access denied - SO Against Invoice permissions required'
+        }), 403
+
+    try:
+        data = request.get_json()
+        so_number = data.get('so_number')
+        series = data.get('series')
+
+        if not so_number or not series:
+            return jsonify({
+                'success': False,
+                'error': 'SO Number and Series are required'
+            }), 400
+
+        result = SAPIntegration().resolve_sales_order(series, so_number)
+        if result['success']:
+            order = result['order']
+            if order.get('DocumentStatus') != 'bost_Open':
+                return jsonify({
+                    'success': False,
+                    'error': f"SO {so_number} is already closed"
+                }), 400
+            return jsonify({
+                'success': True,
+                'doc_entry': order.get('DocEntry'),
+                'order': open_sales_order(order),
+                'message': f'SO {so_number} validated successfully'
+            })
+        if result.get('not_found'):
+            return jsonify({
+                'success': False,
+                'error': result['error']
+            }), 404
+
+        logging.error(f"Error resolving SO with SAP: {result['error']}")
+        return jsonify({
+            'success': False,
+            'error': 'SAP B1 service unavailable - cannot validate SO numbers without live connection'
+        }), 503
+
+    except Exception as e:
+        logging.error(f"Error in resolve_so API: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 # Step 4: Validation Rules for Serial and Non-Serial Items
 @so_invoice_bp.route('/api/validate-item', methods=['POST'])
 @login_required
@@ -628,7 +697,31 @@ def validate_item():
             })
         
         elif item_type == 'non_serial':
-            # Scenario 2: Non-Serial Items - validate quantity against available stock
+            # Scenario 2: Non-Serial Items - validate quantity against available stock, re-read
+            # from SAP (the document stock cache may be hours old)
+            line_stock = get_item_line_stock(data, refresh=True)
+            if line_stock is not None and line_stock['on_hand'] <= 0:
+                # Quantity_Check only returns rows with stock
+                return jsonify({
+                    'success': False,
+                    'error': f'No stock information found for item {item_code}'
+                }), 404
+            if line_stock is not None:
+                available_qty = line_stock['on_hand']
+                if quantity <= available_qty:
+                    return jsonify({
+                        'success': True,
+                        'validated': True,
+                        'item_type': 'non_serial',
+                        'quantity': quantity,
+                        'available_qty': available_qty,
+                        'message': f'Quantity {quantity} validated for item {item_code}'
+                    })
+                return jsonify({
+                    'success': False,
+                    'error': f'Insufficient stock. Available: {available_qty}, Requested: {quantity}'
+                }), 400
+
             if sap.ensure_logged_in():
                 try:
                     # Use proper Quantity_Check SAP API
@@ -965,6 +1058,22 @@ def check_item_stock():
                 'error': 'ItemCode and WarehouseCode are required'
             }), 400
         
+        # Lines of an SO Against Invoice document come from one bulk SO_Line_Stock call
+        line_stock = get_item_line_stock(data)
+        if line_stock is not None and line_stock['on_hand'] <= 0:
+            # Same answer as Quantity_Check, which only returns rows with stock
+            return jsonify({
+                'success': False,
+                'error': f'No stock information found for item {item_code} in warehouse {warehouse_code}'
+            })
+        if line_stock is not None:
+            return jsonify({
+                'success': True,
+                'item_code': line_stock['item_code'],
+                'man_ser_num': line_stock['man_ser_num'],
+                'on_hand': line_stock['on_hand']
+            })
+        
         sap = SAPIntegration()
         
         # Try to get stock info from SAP B1
@@ -1023,6 +1132,77 @@ def check_item_stock():
         }), 500
 
 
+@so_invoice_bp.route('/api/check-document-stock', methods=['POST'])
+@login_required
+def check_document_stock():
+    """Check warehouse stock for every line of an SO Against Invoice document in one SAP call"""
+    if not current_user.has_permission('so_against_invoice'):
+        return jsonify({
+            'success': False,
+            'error': 'Access denied - SO Against Invoice permissions required'
+        }), 403
+    
+    try:
+        data = request.get_json()
+        doc_id = data.get('doc_id')
+        
+        if not doc_id:
+            return jsonify({
+                'success': False,
+                'error': 'Document ID is required'
+            }), 400
+        
+        document = SOInvoiceDocument.query.get_or_404(doc_id)
+        
+        if current_user.role not in ['admin', 'manager'] and document.user_id != current_user.id:
+            return jsonify({
+                'success': False,
+                'error': 'Access denied - You can only check your own documents'
+            }), 403
+        
+        if not document.so_doc_entry:
+            return jsonify({
+                'success': False,
+                'error': 'No Sales Order assigned to this document'
+            }), 400
+        
+        stock = get_document_line_stock(document, refresh=bool(data.get('refresh')))
+        if stock is None:
+            return jsonify({
+                'success': False,
+                'error': 'SAP B1 service unavailable - cannot check stock without live connection'
+            }), 503
+        
+        lines = []
+        for item in document.items:
+            line_stock = stock.get(item.line_num)
+            on_hand = line_stock['on_hand'] if line_stock else 0
+            lines.append({
+                'item_id': item.id,
+                'line_num': item.line_num,
+                'item_code': item.item_code,
+                'warehouse_code': item.warehouse_code,
+                'so_quantity': item.so_quantity,
+                'on_hand': on_hand,
+                'man_ser_num': line_stock['man_ser_num'] if line_stock else None,
+                'available': on_hand >= (item.so_quantity or 0),
+                'shortfall': max(0, (item.so_quantity or 0) - on_hand)
+            })
+        
+        return jsonify({
+            'success': True,
+            'lines': lines,
+            'short_lines': sum(1 for line in lines if not line['available'])
+        })
+    
+    except Exception as e:
+        logging.error(f"Error in check_document_stock API: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @so_invoice_bp.route('/api/validate-serial', methods=['POST'])
 @login_required
 def validate_serial():
@@ -1174,22 +1354,13 @@ def add_validated_item():
         item.validation_status = 'validated'
         item.validation_error = None
         
-        # Clear existing serial numbers for this item
-        SOInvoiceSerial.query.filter_by(so_invoice_item_id=item_id).delete()
-        
-        # Add serial numbers if provided
-        if serial_numbers:
-            for i, serial_number in enumerate(serial_numbers):
-                serial_entry = SOInvoiceSerial(
-                    so_invoice_item_id=item_id,
-                    serial_number=serial_number,
-                    quantity=1,
-                    base_line_number=i + 1,
-                    validation_status='validated'
-                )
-                db.session.add(serial_entry)
+        # Apply only the serials that changed (one DELETE, one multi-row INSERT)
+        added, removed = replace_serials(SOInvoiceSerial, 'so_invoice_item_id', item.id, serial_numbers,
+                                         position_column='base_line_number',
+                                         quantity=1, validation_status='validated')
         
         db.session.commit()
+        logging.info(f"Item {item.item_code} serials updated: {added} added, {removed} removed")
         
         return jsonify({
             'success': True,
@@ -1301,13 +1472,26 @@ def post_invoice_to_sap():
                 'error': 'Document must be validated before posting'
             }), 400
 
-        # Get validated items
-        validated_items = SOInvoiceItem.query.filter(
-            SOInvoiceItem.so_invoice_id == doc_id,
-            SOInvoiceItem.validated_quantity > 0
-        ).all()
-
-        if not validated_items:
+        # Validated items and their validated serials in one query; an item without
+        # serials is a single row carrying its validated quantity
+        rows = db.session.execute(
+            db.select(SOInvoiceItem.id.label('ItemId'),
+                      SOInvoiceItem.validated_quantity.label('ValidatedQuantity'),
+                      SOInvoiceItem.item_code.label('ItemCode'),
+                      SOInvoiceItem.item_description.label('ItemDescription'),
+                      SOInvoiceItem.warehouse_code.label('WarehouseCode'),
+                      db.literal(document.bplid).label('BPL_ID'),
+                      SOInvoiceItem.line_num.label('BaseLine'),
+                      SOInvoiceSerial.serial_number.label('SerialNumber'),
+                      db.case((SOInvoiceSerial.id.is_(None), SOInvoiceItem.validated_quantity),
+                              else_=1.0).label('Quantity'))
+            .outerjoin(SOInvoiceSerial, db.and_(SOInvoiceSerial.so_invoice_item_id == SOInvoiceItem.id,
+                                                SOInvoiceSerial.validation_status == 'validated'))
+            .where(SOInvoiceItem.so_invoice_id == doc_id, SOInvoiceItem.validated_quantity > 0)
+            .order_by(SOInvoiceItem.id, SOInvoiceSerial.id)
+        ).mappings().all()
+
+        if not rows:
             return jsonify({
                 'success': False,
                 'error': 'No validated items found for posting'
@@ -1322,38 +1506,25 @@ def post_invoice_to_sap():
                 'error': 'Failed to connect to SAP B1'
             }), 503
 
-        # Prepare document lines for SAP B1 Draft
-        document_lines = []
-        
-        for idx, item in enumerate(validated_items):
-            # Get serial numbers for this item
-            serial_numbers = SOInvoiceSerial.query.filter_by(
-                so_invoice_item_id=item.id,
-                validation_status='validated'
-            ).all()
-
-            # Prepare line data
-            line_data = {
-                "LineNum": idx,
-                "ItemCode": item.item_code,
-                "ItemDescription": item.item_description,
-                "Quantity": float(item.validated_quantity),
-                "WarehouseCode": item.warehouse_code,
-                "BaseType": 17,  # Sales Order
-                "BaseEntry": document.so_doc_entry,
-                "BaseLine": item.line_num
-            }
-
-            # Add serial numbers if item is serial managed
-            if serial_numbers:
-                line_data["SerialNumbers"] = [
-                    {
-                        "InternalSerialNumber": serial.serial_number,
-                        "Quantity": 1.0
-                    } for serial in serial_numbers
-                ]
-            
-            document_lines.append(line_data)
+        # Prepare document lines for SAP B1 Draft - one line per SO base line. The line
+        # quantity stays the validated quantity; the rows only contribute the serials.
+        validated_quantities = {}
+        for row in rows:
+            key = (row['ItemCode'], row['WarehouseCode'], row['BaseLine'])
+            validated_quantities.setdefault(key, {})[row['ItemId']] = float(row['ValidatedQuantity'])
+
+        document_lines = build_document_lines(rows, extra_fields=('BaseLine',), serial_base_line=False)
+        for idx, line_data in enumerate(document_lines):
+            key = (line_data['ItemCode'], line_data['WarehouseCode'], line_data['BaseLine'])
+            quantity = sum(validated_quantities[key].values())
+            serial_count = len(line_data.get('SerialNumbers', ()))
+            if serial_count and serial_count != quantity:
+                logging.warning(f"⚠️ SO line {line_data['BaseLine']} ({line_data['ItemCode']}): validated quantity "
+                                f"{quantity:g} differs from {serial_count} validated serials")
+            line_data["Quantity"] = quantity
+            line_data["LineNum"] = idx
+            line_data["BaseType"] = 17  # Sales Order
+            line_data["BaseEntry"] = document.so_doc_entry
 
         # Prepare the complete request body for SAP B1 Drafts
         request_body = {
@@ -1371,17 +1542,18 @@ def post_invoice_to_sap():
             "AuthorizationStatus": "dasPending",
             "DocumentLines": document_lines
         }
-        print(request_body)
         # Post to SAP B1 Drafts endpoint
         try:
             draft_url = f"{sap.base_url}/b1s/v1/Drafts"
             logging.info(f"Posting to SAP B1 Drafts endpoint: {draft_url}")
-            logging.debug(f"Request body: {request_body}")
+            payload_log.debug("Request body: %s", LazyJson(request_body))
             
-            response = sap.session.post(draft_url, json=request_body, timeout=30)
+            # Retries of the same document content return the existing draft
+            result = post_document(sap, 'Drafts', 'so_invoice', document.id, request_body, timeout=30)
+            response = result['response']
             
-            if response.status_code in [200, 201]:
-                response_data = response.json()
+            if result['success']:
+                response_data = result['data']
                 draft_doc_entry = response_data.get('DocEntry')
                 draft_doc_num = response_data.get('DocNum', draft_doc_entry)
                 
@@ -1401,6 +1573,11 @@ def post_invoice_to_sap():
                     'draft_doc_entry': draft_doc_entry,
                     'sap_draft_number': f"DRAFT-{draft_doc_num}"
                 })
+            elif result.get('in_progress') or result.get('verify_in_sap'):
+                return jsonify({
+                    'success': False,
+                    'error': result['error']
+                }), 409
             else:
                 # Handle SAP B1 API error - sanitize error message
                 error_message = f"SAP B1 API returned status {response.status_code}"
@@ -1501,147 +1678,123 @@ def sync_so_data():
                 'error': 'No Sales Order assigned to this document'
             }), 400
         
-        sap = SAPIntegration()
-        
-        # Try to fetch latest SO details from SAP B1
-        if sap.ensure_logged_in():
-            try:
-                url = f"{sap.base_url}/b1s/v1/Orders?$filter=DocEntry eq {document.so_doc_entry}"
-                response = sap.session.get(url, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    orders = data.get('value', [])
-                    
-                    if orders:
-                        order = orders[0]
-                        
-                        # Check if SO is still open
-                        if order.get("DocumentStatus") != "bost_Open":
-                            return jsonify({
-                                'success': False,
-                                'error': f"Sales Order {document.so_number} is already closed and cannot be synced"
-                            }), 400
-                        
-                        # Update document header information
-                        document.card_code = order.get('CardCode', document.card_code)
-                        document.card_name = order.get('CardName', document.card_name)
-                        document.customer_address = order.get('Address', document.customer_address)
-                        
-                        # Get open lines only
-                        open_lines = [
-                            line for line in order.get("DocumentLines", [])
-                            if line.get("LineStatus") == "bost_Open"
-                        ]
-                        
-                        # Track changes
-                        changes_made = {
-                            'lines_added': 0,
-                            'lines_updated': 0,
-                            'lines_removed': 0
-                        }
-                        
-                        # Get existing line numbers from database
-                        existing_items = {item.line_num: item for item in document.items}
-                        current_line_nums = set(existing_items.keys())
-                        new_line_nums = set(line.get('LineNum') for line in open_lines)
-                        
-                        # Add or update lines
-                        for line in open_lines:
-                            line_num = line.get('LineNum')
-                            item_code = line.get('ItemCode')
-                            description = line.get('ItemDescription', '')
-                            quantity = line.get('Quantity', 0)
-                            warehouse_code = line.get('WarehouseCode', '')
-                            
-                            if line_num in existing_items:
-                                # Update existing item
-                                existing_item = existing_items[line_num]
-                                original_qty = existing_item.so_quantity
-                                
-                                existing_item.item_code = item_code
-                                existing_item.item_description = description
-                                existing_item.so_quantity = quantity
-                                existing_item.warehouse_code = warehouse_code
-                                existing_item.updated_at = datetime.utcnow()
-                                
-                                if original_qty != quantity:
-                                    changes_made['lines_updated'] += 1
-                                    logging.info(f"Updated line {line_num}: quantity changed from {original_qty} to {quantity}")
-                            else:
-                                # Add new item
-                                new_item = SOInvoiceItem(
-                                    so_invoice_id=document.id,
-                                    line_num=line_num,
-                                    item_code=item_code,
-                                    item_description=description,
-                                    so_quantity=quantity,
-                                    warehouse_code=warehouse_code,
-                                    validation_status='pending'
-                                )
-                                db.session.add(new_item)
-                                changes_made['lines_added'] += 1
-                                logging.info(f"Added new line {line_num}: {item_code} - {quantity}")
-                        
-                        # Remove lines that are no longer open
-                        removed_lines = current_line_nums - new_line_nums
-                        for line_num in removed_lines:
-                            item_to_remove = existing_items[line_num]
-                            # Only remove if not validated yet
-                            if item_to_remove.validation_status == 'pending':
-                                db.session.delete(item_to_remove)
-                                changes_made['lines_removed'] += 1
-                                logging.info(f"Removed line {line_num}: {item_to_remove.item_code}")
-                        
-                        # Update document timestamp
-                        document.updated_at = datetime.utcnow()
-                        document.validation_notes = f"Data synced from SAP B1 at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}"
-                        
-                        db.session.commit()
-                        
-                        # Prepare response summary
-                        total_changes = sum(changes_made.values())
-                        if total_changes > 0:
-                            change_summary = []
-                            if changes_made['lines_added']:
-                                change_summary.append(f"{changes_made['lines_added']} lines added")
-                            if changes_made['lines_updated']:
-                                change_summary.append(f"{changes_made['lines_updated']} lines updated")
-                            if changes_made['lines_removed']:
-                                change_summary.append(f"{changes_made['lines_removed']} lines removed")
-                            
-                            message = f"Data sync completed: {', '.join(change_summary)}"
-                        else:
-                            message = "Data sync completed: No changes detected"
-                        
-                        logging.info(f"SO data sync successful for document {document.document_number}: {message}")
-                        
-                        return jsonify({
-                            'success': True,
-                            'message': message,
-                            'changes': changes_made,
-                            'total_lines': len(open_lines)
-                        })
-                        
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'error': f'Sales Order DocEntry {document.so_doc_entry} not found in SAP B1'
-                        }), 404
-                        
-                else:
-                    logging.error(f"Error fetching SO details from SAP: {response.status_code} - {response.text}")
-                    return jsonify({
-                        'success': False,
-                        'error': f'Failed to fetch SO details from SAP B1: HTTP {response.status_code}'
-                    }), 502
-                    
-            except Exception as e:
-                logging.error(f"Error syncing SO data from SAP: {str(e)}")
+        # The auto-sync on page load reuses the order cached when the SO was resolved;
+        # the Sync button sends refresh=true to read the latest order from SAP B1
+        result = SAPIntegration().get_sales_order(document.so_doc_entry, use_cache=not data.get('refresh'))
+        if result.get('not_found'):
+            return jsonify({
+                'success': False,
+                'error': f'Sales Order DocEntry {document.so_doc_entry} not found in SAP B1'
+            }), 404
+
+        if result['success']:
+            order = result['order']
+
+            # Check if SO is still open
+            if order.get("DocumentStatus") != "bost_Open":
                 return jsonify({
                     'success': False,
-                    'error': 'Failed to connect to SAP B1 for data sync'
-                }), 503
+                    'error': f"Sales Order {document.so_number} is already closed and cannot be synced"
+                }), 400
+
+            # Update document header information
+            document.card_code = order.get('CardCode', document.card_code)
+            document.card_name = order.get('CardName', document.card_name)
+            document.customer_address = order.get('Address', document.customer_address)
+
+            # Get open lines only
+            open_lines = open_sales_order(order)['DocumentLines']
+
+            # Track changes
+            changes_made = {
+                'lines_added': 0,
+                'lines_updated': 0,
+                'lines_removed': 0
+            }
+
+            # Get existing line numbers from database
+            existing_items = {item.line_num: item for item in document.items}
+            current_line_nums = set(existing_items.keys())
+            new_line_nums = set(line.get('LineNum') for line in open_lines)
+
+            # Add or update lines
+            for line in open_lines:
+                line_num = line.get('LineNum')
+                item_code = line.get('ItemCode')
+                description = line.get('ItemDescription', '')
+                quantity = line.get('Quantity', 0)
+                warehouse_code = line.get('WarehouseCode', '')
+
+                if line_num in existing_items:
+                    # Update existing item
+                    existing_item = existing_items[line_num]
+                    original_qty = existing_item.so_quantity
+
+                    existing_item.item_code = item_code
+                    existing_item.item_description = description
+                    existing_item.so_quantity = quantity
+                    existing_item.warehouse_code = warehouse_code
+                    existing_item.updated_at = datetime.utcnow()
+
+                    if original_qty != quantity:
+                        changes_made['lines_updated'] += 1
+                        logging.info(f"Updated line {line_num}: quantity changed from {original_qty} to {quantity}")
+                else:
+                    # Add new item
+                    new_item = SOInvoiceItem(
+                        so_invoice_id=document.id,
+                        line_num=line_num,
+                        item_code=item_code,
+                        item_description=description,
+                        so_quantity=quantity,
+                        warehouse_code=warehouse_code,
+                        validation_status='pending'
+                    )
+                    db.session.add(new_item)
+                    changes_made['lines_added'] += 1
+                    logging.info(f"Added new line {line_num}: {item_code} - {quantity}")
+
+            # Remove lines that are no longer open
+            removed_lines = current_line_nums - new_line_nums
+            for line_num in removed_lines:
+                item_to_remove = existing_items[line_num]
+                # Only remove if not validated yet
+                if item_to_remove.validation_status == 'pending':
+                    db.session.delete(item_to_remove)
+                    changes_made['lines_removed'] += 1
+                    logging.info(f"Removed line {line_num}: {item_to_remove.item_code}")
+
+            # Update document timestamp
+            document.updated_at = datetime.utcnow()
+            document.validation_notes = f"Data synced from SAP B1 at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}"
+
+            db.session.commit()
+
+            # Prepare response summary
+            total_changes = sum(changes_made.values())
+            if total_changes > 0:
+                change_summary = []
+                if changes_made['lines_added']:
+                    change_summary.append(f"{changes_made['lines_added']} lines added")
+                if changes_made['lines_updated']:
+                    change_summary.append(f"{changes_made['lines_updated']} lines updated")
+                if changes_made['lines_removed']:
+                    change_summary.append(f"{changes_made['lines_removed']} lines removed")
+
+                message = f"Data sync completed: {', '.join(change_summary)}"
+            else:
+                message = "Data sync completed: No changes detected"
+
+            logging.info(f"SO data sync successful for document {document.document_number}: {message}")
+
+            return jsonify({
+                'success': True,
+                'message': message,
+                'changes': changes_made,
+                'total_lines': len(open_lines)
+            })
+
+        logging.error(f"Error syncing SO data from SAP: {result['error']}")
         
         # Strict production check - never allow mock sync in production
         if is_production_environment():
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+QR Rendering Micro-Benchmark
+Compares the previous QR path (box_size=10 render + LANCZOS resize) with the
+native-resolution 1-bit renderer and the SVG/ZPL vector outputs in barcode_generator.
+
+Usage:
+    python qr_benchmark.py
+    python qr_benchmark.py --size 300 --iterations 200
+"""
+
+import argparse
+import io
+import time
+
+from barcode_generator import render_qr_image, render_qr_svg, render_qr_zpl
+
+SAMPLES = [
+    "SO123456 | ItemCode: 98765",
+    "SO4500012345 | ItemCode: LAPTOP-DELL-5420 | Batch: B2025-08-04-001",
+    "INV100245 | ItemCode: MI-PHONE-12 | Serial: 864215047812345",
+]
+
+
+def legacy_png(data, size, margin=1):
+    """The previous renderer: 10 px modules, then LANCZOS resize to the requested size"""
+    import qrcode
+    from PIL import Image
+
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=margin)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    img = img.resize((size, size), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def native_png(data, size, margin=1):
+    buffer = io.BytesIO()
+    render_qr_image(data, size, margin).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def svg(data, size, margin=1):
+    return render_qr_svg(data, size, margin).encode('utf-8')
+
+
+def zpl(data, size, margin=1):
+    return render_qr_zpl(data, size).encode('utf-8')
+
+
+def module_width_spread(png_bytes):
+    """
+    Spread of black/white run lengths along the middle row, normalised to the
+    narrowest run. 0 means every module is the same whole number of pixels;
+    resampled images have uneven module widths that handheld scanners misread.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(png_bytes)).convert('L')
+    width, height = image.size
+    row = [image.getpixel((x, height // 2)) < 128 for x in range(width)]
+    runs = []
+    length = 1
+    for previous, current in zip(row, row[1:]):
+        if current == previous:
+            length += 1
+        else:
+            runs.append(length)
+            length = 1
+    # Drop the quiet zones at both ends
+    runs = runs[1:-1] or runs
+    unit = min(runs)
+    return max(abs(run / unit - round(run / unit)) for run in runs)
+
+
+def bench(render, size, iterations):
+    outputs = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        outputs.append(render(SAMPLES[i % len(SAMPLES)], size))
+    elapsed = time.perf_counter() - started
+    return iterations / elapsed, sum(len(o) for o in outputs) / len(outputs), outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark QR rendering paths')
+    parser.add_argument('--size', type=int, default=300, help='Requested QR size in pixels (default: 300)')
+    parser.add_argument('--iterations', type=int, default=100, help='Renders per path (default: 100)')
+    args = parser.parse_args()
+
+    # Warm up imports so the first path is not charged for them
+    legacy_png(SAMPLES[0], args.size)
+    native_png(SAMPLES[0], args.size)
+
+    print("🔳 QR Rendering Benchmark")
+    print("=" * 64)
+    print(f"Size: {args.size}px   Iterations per path: {args.iterations}")
+    print(f"{'path':<22}{'renders/s':>12}{'avg bytes':>12}{'module spread':>15}")
+
+    for name, render, raster in [
+        ('legacy PNG (LANCZOS)', legacy_png, True),
+        ('native PNG (mode 1)', native_png, True),
+        ('SVG', svg, False),
+        ('ZPL (^BQ)', zpl, False),
+    ]:
+        rate, avg_bytes, outputs = bench(render, args.size, args.iterations)
+        spread = f"{module_width_spread(outputs[0]):.2f}" if raster else '-'
+        print(f"{name:<22}{rate:>12.0f}{avg_bytes:>12.0f}{spread:>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when its view is decorated with @profile_route, its endpoint
+or path prefix is listed in PROFILE_ROUTES, or an admin sends an `X-Profile: 1`
+header (`X-Profile: cprofile` also captures a cProfile of the request thread).
+Profiled requests record wall time, SQL query count/time (SQLAlchemy cursor
+events), SAP call count/time (sap_metrics listener) and get a Server-Timing
+response header. The slowest PROFILE_TOP_N and the most recent profiles are kept
+per worker process and listed at /admin/request-profiles.
+"""
+import cProfile
+import heapq
+import io
+import itertools
+import logging
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '25'))
+PROFILE_RECENT = int(os.environ.get('PROFILE_RECENT', '100'))
+PROFILE_ROUTES = [route.strip() for route in os.environ.get('PROFILE_ROUTES', '').split(',') if route.strip()]
+
+# Statements kept per profile, slowest first
+SLOW_QUERY_LIMIT = 5
+CPROFILE_LINES = 40
+
+_current = ContextVar('request_profile', default=None)
+
+_lock = threading.Lock()
+_slowest = []  # min-heap of (wall_ms, seq, profile)
+_recent = deque(maxlen=PROFILE_RECENT)
+_by_id = {}
+_seq = itertools.count()
+
+
+def profile_route(cprofile=False):
+    """Always profile the decorated view; cprofile=True also captures a cProfile"""
+    def decorator(view):
+        view._profile_request = 'cprofile' if cprofile else 'timing'
+        return view
+    return decorator
+
+
+class RequestProfile:
+    __slots__ = ('id', 'method', 'path', 'endpoint', 'user', 'status', 'started_at', 'started',
+                 'wall_ms', 'db_queries', 'db_ms', 'slow_queries', 'sap_calls', 'sap_ms',
+                 'sap_endpoints', 'profiler', 'cprofile')
+
+    def __init__(self, request, user):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = request.method
+        self.path = request.full_path.rstrip('?')
+        self.endpoint = request.endpoint
+        self.user = user
+        self.status = None
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.wall_ms = 0.0
+        self.db_queries = 0
+        self.db_ms = 0.0
+        self.slow_queries = []
+        self.sap_calls = 0
+        self.sap_ms = 0.0
+        self.sap_endpoints = Counter()
+        self.profiler = None
+        self.cprofile = None
+
+    def add_query(self, statement, duration_ms):
+        self.db_queries += 1
+        self.db_ms += duration_ms
+        entry = (duration_ms, statement[:300])
+        if len(self.slow_queries) < SLOW_QUERY_LIMIT:
+            heapq.heappush(self.slow_queries, entry)
+        elif duration_ms > self.slow_queries[0][0]:
+            heapq.heapreplace(self.slow_queries, entry)
+
+    def add_sap_call(self, method, endpoint, query_name, duration_ms):
+        self.sap_calls += 1
+        self.sap_ms += duration_ms
+        self.sap_endpoints[f"{method} {endpoint}" + (f" [{query_name}]" if query_name else '')] += 1
+
+    def to_dict(self, detail=False):
+        data = {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'endpoint': self.endpoint,
+            'user': self.user,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(),
+            'wall_ms': round(self.wall_ms, 1),
+            'db_queries': self.db_queries,
+            'db_ms': round(self.db_ms, 1),
+            'sap_calls': self.sap_calls,
+            'sap_ms': round(self.sap_ms, 1),
+            'has_cprofile': self.cprofile is not None,
+        }
+        if detail:
+            data['slow_queries'] = [{'ms': round(ms, 1), 'statement': statement}
+                                    for ms, statement in sorted(self.slow_queries, reverse=True)]
+            data['sap_endpoints'] = self.sap_endpoints.most_common()
+            data['cprofile'] = self.cprofile
+        return data
+
+
+def _requested_mode(app, request):
+    """'timing', 'cprofile' or None for the current request"""
+    view = app.view_functions.get(request.endpoint)
+    mode = getattr(view, '_profile_request', None)
+    if mode is None and PROFILE_ROUTES:
+        if request.endpoint in PROFILE_ROUTES or any(
+                route.startswith('/') and request.path.startswith(route) for route in PROFILE_ROUTES):
+            mode = 'timing'
+
+    header = request.headers.get(PROFILE_HEADER, '').strip().lower()
+    if header and header not in ('0', 'false'):
+        from flask_login import current_user
+        # The header is only honoured for admins
+        if current_user.is_authenticated and current_user.role == 'admin':
+            mode = 'cprofile' if header == 'cprofile' else (mode or 'timing')
+    return mode
+
+
+def _store(profile):
+    with _lock:
+        _recent.append(profile)
+        _by_id[profile.id] = profile
+        heapq.heappush(_slowest, (profile.wall_ms, next(_seq), profile))
+        if len(_slowest) > PROFILE_TOP_N:
+            heapq.heappop(_slowest)
+        # Forget profiles that are in neither buffer
+        kept = {p.id for p in _recent} | {entry[2].id for entry in _slowest}
+        for profile_id in [pid for pid in _by_id if pid not in kept]:
+            del _by_id[profile_id]
+
+
+def slowest_profiles():
+    with _lock:
+        return [entry[2].to_dict() for entry in sorted(_slowest, key=lambda e: e[0], reverse=True)]
+
+
+def recent_profiles():
+    with _lock:
+        return [profile.to_dict() for profile in reversed(_recent)]
+
+
+def get_profile(profile_id):
+    with _lock:
+        profile = _by_id.get(profile_id)
+        return profile.to_dict(detail=True) if profile else None
+
+
+def clear_profiles():
+    with _lock:
+        _slowest.clear()
+        _recent.clear()
+        _by_id.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('_profile_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    started = conn.info.get('_profile_query_started')
+    if profile is not None and started:
+        profile.add_query(statement, (time.perf_counter() - started.pop()) * 1000)
+
+
+def _on_sap_call(method, endpoint, query_name, status, duration):
+    profile = _current.get()
+    if profile is not None:
+        profile.add_sap_call(method, endpoint, query_name, duration * 1000)
+
+
+def init_profiler(app):
+    """Register the request hooks, SQLAlchemy cursor events and SAP call listener"""
+    from flask import request
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    import sap_metrics
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    sap_metrics.add_call_listener(_on_sap_call)
+
+    @app.before_request
+    def start_request_profile():
+        mode = _requested_mode(app, request)
+        if mode is None:
+            return
+        from flask_login import current_user
+        user = current_user.username if current_user.is_authenticated else None
+        profile = RequestProfile(request, user)
+        if mode == 'cprofile':
+            profile.profiler = cProfile.Profile()
+            try:
+                profile.profiler.enable()
+            except ValueError:
+                # Another profiler is already active in this thread
+                profile.profiler = None
+        request.environ['wms.profile_token'] = _current.set(profile)
+
+    @app.after_request
+    def add_server_timing(response):
+        profile = _current.get()
+        if profile is not None:
+            profile.status = response.status_code
+            wall_ms = (time.perf_counter() - profile.started) * 1000
+            response.headers['Server-Timing'] = (f"app;dur={wall_ms:.1f}, db;dur={profile.db_ms:.1f};desc=\"{profile.db_queries} queries\", "
+                                                 f"sap;dur={profile.sap_ms:.1f};desc=\"{profile.sap_calls} calls\"")
+            response.headers['X-Profile-Id'] = profile.id
+        return response
+
+    @app.teardown_request
+    def finish_request_profile(exc):
+        token = request.environ.pop('wms.profile_token', None)
+        if token is None:
+            return
+        profile = _current.get()
+        _current.reset(token)
+
+        profile.wall_ms = (time.perf_counter() - profile.started) * 1000
+        if profile.status is None:
+            profile.status = 500 if exc else None
+        if profile.profiler is not None:
+            profile.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profile.profiler, stream=out).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+            profile.cprofile = out.getvalue()
+            profile.profiler = None
+
+        _store(profile)
+        logging.info(f"⏱️ Profiled {profile.method} {profile.path}: {profile.wall_ms:.0f} ms, "
+                     f"{profile.db_queries} queries ({profile.db_ms:.0f} ms), "
+                     f"{profile.sap_calls} SAP calls ({profile.sap_ms:.0f} ms)")
@@ -1,10 +1,11 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, session
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, Response, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import logging
 import json
 from barcode_generator import BarcodeGenerator
+from label_cache import load_label, MIME_TYPES
 
 from app import app, db, login_manager
 from models import User, GRPODocument, GRPOItem, InventoryTransfer, InventoryTransferItem, PickList, PickListItem, \
@@ -13,8 +14,15 @@ from models import User, GRPODocument, GRPOItem, InventoryTransfer, InventoryTra
 from modules.invoice_creation.models import InvoiceDocument
 
 from sap_integration import SAPIntegration
+from cache_utils import TTLCache
 from sqlalchemy import or_
+import os
 import re
+import hmac
+import sap_metrics
+import sap_circuit
+import sap_idempotency
+import request_profiler
 
 
 def validate_password(password):
@@ -3167,6 +3175,10 @@ def generate_qr_code():
             size = data.get('size', 300)
             result = generator.generate_qr_code(qr_text, size=size)
 
+        # Image is fetched from result['url']; base64 only when explicitly requested
+        if result.get('success') and not data.get('inline'):
+            result.pop('data', None)
+
         return jsonify(result)
 
     except Exception as e:
@@ -3174,6 +3186,69 @@ def generate_qr_code():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/labels/<label_hash>.<ext>')
+@login_required
+def serve_label_image(label_hash, ext):
+    """Serve a rendered label image by content hash - immutable, so cacheable for a year"""
+    if request.if_none_match.contains(label_hash):
+        return Response(status=304)
+
+    image_bytes = load_label(label_hash, ext)
+    if image_bytes is None:
+        abort(404)
+
+    response = Response(image_bytes, mimetype=MIME_TYPES[ext])
+    response.set_etag(label_hash)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/api/labels/batch', methods=['POST'])
+@login_required
+def render_label_batch():
+    """Render every label of a document (grpo, serial_transfer, invoice) as one PDF or ZPL file"""
+    from label_batch import DOCUMENT_TYPES, MAX_BATCH_LABELS, collect_document_labels, render_pdf, render_zpl
+
+    try:
+        data = request.get_json() or {}
+        document_type = data.get('document_type')
+        document_id = data.get('document_id')
+        output_format = (data.get('format') or 'pdf').lower()
+
+        if document_type not in DOCUMENT_TYPES:
+            return jsonify({'success': False, 'error': f'document_type must be one of {", ".join(DOCUMENT_TYPES)}'}), 400
+        if not document_id:
+            return jsonify({'success': False, 'error': 'document_id is required'}), 400
+        if output_format not in ('pdf', 'zpl'):
+            return jsonify({'success': False, 'error': 'format must be pdf or zpl'}), 400
+
+        collected = collect_document_labels(document_type, document_id)
+        if collected is None:
+            return jsonify({'success': False, 'error': 'Document not found'}), 404
+        title, labels = collected
+
+        if not labels:
+            return jsonify({'success': False, 'error': 'Document has no items to label'}), 400
+        if len(labels) > MAX_BATCH_LABELS:
+            return jsonify({'success': False,
+                            'error': f'{len(labels)} labels exceeds the batch limit of {MAX_BATCH_LABELS}'}), 400
+
+        if output_format == 'zpl':
+            body, mimetype = render_zpl(labels), 'text/plain'
+        else:
+            body, mimetype = render_pdf(labels), 'application/pdf'
+
+        filename = re.sub(r'[^A-Za-z0-9_.-]', '_', f"labels_{title}.{output_format}")
+        response = Response(body, mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['X-Label-Count'] = str(len(labels))
+        return response
+
+    except Exception as e:
+        logging.error(f"Batch label rendering failed: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/parse-qr', methods=['POST'])
 @login_required
 def parse_qr_code():
@@ -3385,16 +3460,19 @@ def generate_label_qr():
         db.session.add(qr_label)
         db.session.commit()
 
-        return jsonify({
+        response = {
             'success': True,
             'qr_content': qr_content,
-            'qr_image_data': qr_result['data'],
+            'qr_image_url': qr_result['url'],
             'qr_image_type': qr_result['mime_type'],
             'qr_filename': qr_result['filename'],
             'qr_label_id': qr_label.id,
             'format': format_type,
             'message': 'QR code generated successfully'
-        })
+        }
+        if data.get('inline'):
+            response['qr_image_data'] = qr_result['data']
+        return jsonify(response)
 
     except Exception as e:
         logging.error(f"QR code generation failed: {str(e)}")
@@ -3432,14 +3510,17 @@ def print_qr_label():
         qr_result = generator.generate_qr_code(qr_content, size=300, format='PNG')
 
         if qr_result['success']:
-            return jsonify({
+            response = {
                 'success': True,
                 'qr_content': qr_content,
-                'qr_image_data': qr_result['data'],
+                'qr_image_url': qr_result['url'],
                 'qr_image_type': qr_result['mime_type'],
                 'qr_filename': qr_result['filename'],
                 'message': 'QR code ready for printing'
-            })
+            }
+            if data.get('inline'):
+                response['qr_image_data'] = qr_result['data']
+            return jsonify(response)
         else:
             return jsonify({
                 'success': False,
@@ -4624,6 +4705,70 @@ def validate_serial_number():
 # Warehouse Assignment Admin Routes
 # ================================
 
+# Resolved per-user assignment views and the SAP warehouse master list are
+# cached so warehouse dropdowns render without DB or SAP round trips.
+_warehouse_master_cache = TTLCache(ttl=600, maxsize=1)
+_warehouse_assignment_cache = TTLCache(ttl=300, maxsize=2048)
+
+
+def _fetch_sap_warehouses():
+    """Fetch WarehouseCode/WarehouseName list from SAP B1, None on failure"""
+    sap = SAPIntegration()
+    if not sap.ensure_logged_in():
+        logging.error("❌ SAP B1 connection failed")
+        return None
+
+    url = f"{sap.base_url}/b1s/v1/Warehouses?$select=WarehouseCode,WarehouseName"
+    headers = {
+        'Content-Type': 'application/json',
+        'Prefer': 'odata.maxpagesize=0'
+    }
+    response = sap.session.get(url, headers=headers, timeout=10)
+    if response.status_code != 200:
+        logging.error(f"❌ Failed to fetch warehouses from SAP: {response.status_code}")
+        return None
+
+    warehouses = response.json().get('value', [])
+    logging.info(f"✅ Retrieved {len(warehouses)} warehouses from SAP B1")
+    return warehouses
+
+
+def get_cached_warehouse_master():
+    """Get all SAP warehouses, served from cache when available"""
+    return _warehouse_master_cache.get_or_set('all', _fetch_sap_warehouses)
+
+
+def get_resolved_warehouse_assignments(user_id):
+    """
+    Get a user's active warehouse assignments as {'from': [...], 'to': [...]}
+    in dropdown shape, with missing names filled from the cached warehouse master
+    """
+    resolved = _warehouse_assignment_cache.get(user_id)
+    if resolved is not None:
+        return resolved
+
+    # Only join names from the master list if it is already cached - never
+    # trigger an SAP call just to decorate assignment rows
+    master = _warehouse_master_cache.get('all') or []
+    names = {w.get('WarehouseCode'): w.get('WarehouseName') for w in master}
+
+    resolved = {'from': [], 'to': []}
+    assignments = UserWarehouseAssignment.query.filter_by(user_id=user_id, is_active=True).all()
+    for assignment in assignments:
+        resolved.setdefault(assignment.assignment_type, []).append({
+            'WarehouseCode': assignment.warehouse_code,
+            'WarehouseName': assignment.warehouse_name or names.get(assignment.warehouse_code) or assignment.warehouse_code
+        })
+
+    _warehouse_assignment_cache.set(user_id, resolved)
+    return resolved
+
+
+def invalidate_warehouse_assignments(user_id):
+    """Drop the cached assignment view for a user after assignments change"""
+    _warehouse_assignment_cache.invalidate(user_id)
+
+
 @app.route('/admin/warehouse-assignments', methods=['GET'])
 @login_required
 def warehouse_assignments():
@@ -4658,6 +4803,7 @@ def fetch_all_warehouses():
                 data = response.json()
                 warehouses = data.get('value', [])
                 logging.info(f"✅ Fetched {len(warehouses)} warehouses from SAP B1 for admin")
+                _warehouse_master_cache.set('all', warehouses)
                 return jsonify({
                     'success': True,
                     'warehouses': warehouses
@@ -4778,6 +4924,7 @@ def save_user_warehouse_assignments(user_id):
         
         # Commit all changes
         db.session.commit()
+        invalidate_warehouse_assignments(user_id)
         
         logging.info(f"✅ Warehouse assignments saved successfully for user {user.username}")
         
@@ -4805,52 +4952,22 @@ def get_assigned_warehouses():
         
         # Admin users can see all warehouses
         if current_user.role == 'admin':
-            sap = SAPIntegration()
-            if sap.ensure_logged_in():
-                url = f"{sap.base_url}/b1s/v1/Warehouses?$select=WarehouseCode,WarehouseName"
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Prefer': 'odata.maxpagesize=0'
-                }
-                response = sap.session.get(url, headers=headers, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    warehouses = data.get('value', [])
-                    logging.info(f"✅ Admin retrieved {len(warehouses)} warehouses from SAP B1")
-                    return jsonify({
-                        'success': True,
-                        'warehouses': warehouses,
-                        'is_admin': True
-                    })
-                else:
-                    logging.error(f"❌ Failed to fetch warehouses from SAP: {response.status_code}")
-                    return jsonify({
-                        'success': False,
-                        'error': 'Failed to fetch warehouses from SAP B1',
-                        'warehouses': []
-                    }), 500
-            else:
-                logging.error("❌ SAP B1 connection failed")
+            warehouses = get_cached_warehouse_master()
+            if warehouses is None:
                 return jsonify({
                     'success': False,
-                    'error': 'SAP B1 connection failed',
+                    'error': 'Failed to fetch warehouses from SAP B1',
                     'warehouses': []
                 }), 500
+
+            return jsonify({
+                'success': True,
+                'warehouses': warehouses,
+                'is_admin': True
+            })
         
         # Regular users: Get only their assigned warehouses
-        assignments = UserWarehouseAssignment.query.filter_by(
-            user_id=current_user.id,
-            assignment_type=assignment_type,
-            is_active=True
-        ).all()
-        
-        warehouses = []
-        for assignment in assignments:
-            warehouses.append({
-                'WarehouseCode': assignment.warehouse_code,
-                'WarehouseName': assignment.warehouse_name
-            })
+        warehouses = get_resolved_warehouse_assignments(current_user.id).get(assignment_type, [])
         
         # Provide helpful feedback if no warehouses are assigned
         if not warehouses:
@@ -4878,3 +4995,108 @@ def get_assigned_warehouses():
             'error': 'An error occurred while fetching warehouses. Please contact support.',
             'warehouses': []
         }), 500
+
+
+@app.route('/metrics')
+def sap_metrics_export():
+    """Prometheus scrape endpoint for SAP call metrics (this worker process only)"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied, token):
+            abort(401)
+    elif not (current_user.is_authenticated and current_user.role == 'admin'):
+        # Without a scrape token only admins may read the metrics
+        abort(403)
+
+    return Response(sap_metrics.render_prometheus() + sap_circuit.render_prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/sap-metrics', methods=['GET'])
+@login_required
+def sap_metrics_summary():
+    """Admin summary of SAP Service Layer calls per endpoint in this worker"""
+    if current_user.role != 'admin':
+        flash('Access denied - Admin permissions required', 'error')
+        return redirect(url_for('dashboard'))
+
+    rows = sap_metrics.snapshot()
+    totals = {
+        'calls': sum(row['calls'] for row in rows),
+        'errors': sum(row['errors'] for row in rows),
+        'retries': sum(row['retries'] for row in rows),
+        'seconds': sum(row['total_seconds'] for row in rows),
+    }
+    return render_template('admin/sap_metrics.html', rows=rows, totals=totals, worker_pid=os.getpid(),
+                           breakers=sap_circuit.breaker_states())
+
+
+@app.route('/admin/sap-metrics/reset', methods=['POST'])
+@login_required
+def reset_sap_metrics():
+    """Clear the SAP call metrics of this worker"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+
+    sap_metrics.reset()
+    logging.info(f"📊 SAP call metrics reset by {current_user.username}")
+    return jsonify({'success': True})
+
+
+@app.route('/admin/sap-posting-attempts/<reference>/resolve', methods=['POST'])
+@login_required
+def resolve_sap_posting_attempt(reference):
+    """Record the outcome of a posting that could not be verified in SAP, after checking it by hand"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+
+    data = request.get_json(silent=True) or {}
+    posted = bool(data.get('posted'))
+    if posted and not data.get('doc_entry'):
+        return jsonify({'success': False, 'error': 'doc_entry is required for a posted document'}), 400
+
+    if not sap_idempotency.resolve_attempt(reference, posted, data.get('doc_entry'), data.get('doc_num')):
+        return jsonify({'success': False, 'error': 'No unresolved posting attempt with this reference'}), 404
+    logging.info(f"🔧 Posting attempt {reference} resolved by {current_user.username}")
+    return jsonify({'success': True})
+
+
+@app.route('/admin/request-profiles', methods=['GET'])
+@login_required
+def list_request_profiles():
+    """Slowest and most recent profiled requests in this worker"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        'slowest': request_profiler.slowest_profiles(),
+        'recent': request_profiler.recent_profiles()
+    })
+
+
+@app.route('/admin/request-profiles/<profile_id>', methods=['GET'])
+@login_required
+def get_request_profile(profile_id):
+    """Full profile: slowest SQL statements, SAP endpoints and cProfile output when captured"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+
+    profile = request_profiler.get_profile(profile_id)
+    if profile is None:
+        return jsonify({'success': False, 'error': 'Profile not found (it may have been evicted)'}), 404
+    if request.args.get('format') == 'text' and profile['cprofile']:
+        return Response(profile['cprofile'], mimetype='text/plain')
+    return jsonify({'success': True, 'profile': profile})
+
+
+@app.route('/admin/request-profiles/clear', methods=['POST'])
+@login_required
+def clear_request_profiles():
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+
+    request_profiler.clear_profiles()
+    return jsonify({'success': True})
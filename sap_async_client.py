@@ -0,0 +1,202 @@
+"""
+Concurrent SAP B1 Service Layer calls for fan-out workloads.
+
+AsyncSAPClient wraps an SAPIntegration and shares its base URL, login and
+instrumented requests session (B1SESSION cookie, keep-alive connection pool
+sized to the concurrency limit). Its coroutines run the blocking calls on a
+thread pool, at most max_concurrency at a time, and log in again once when
+the session has expired. Flask views stay synchronous and use run()/run_all():
+
+    client = AsyncSAPClient(sap)
+    system_numbers = client.run(client.get_system_numbers(serials))
+
+The transport stays on requests (httpx is not a dependency of this project);
+only the orchestration is asynchronous.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sap_circuit import prepare_session
+
+SAP_MAX_CONCURRENCY = int(os.environ.get('SAP_MAX_CONCURRENCY', '8'))
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) seconds; the connect part is capped by sap_circuit
+
+ITEMS_CHUNK_SIZE = 40  # ItemCodes per Items $filter, as in SAPIntegration._get_items_metadata
+
+
+class AsyncSAPClient:
+    """asyncio front end for an SAPIntegration session; see module docstring"""
+
+    def __init__(self, sap=None, max_concurrency=None):
+        if sap is None:
+            from sap_integration import SAPIntegration
+            sap = SAPIntegration()
+        self.sap = sap
+        self.max_concurrency = max_concurrency or SAP_MAX_CONCURRENCY
+        # Enough pooled keep-alive connections that concurrent calls never open throwaway ones
+        prepare_session(sap.session, pool_maxsize=self.max_concurrency)
+        self._login_lock = threading.Lock()
+        self._semaphores = {}
+
+    # -- plumbing -------------------------------------------------------
+
+    def ensure_logged_in(self):
+        """Log in once, before concurrent calls would each race to do it"""
+        if self.sap.session_id:
+            return True
+        with self._login_lock:
+            return self.sap.ensure_logged_in()
+
+    def _relogin(self, stale_session_id):
+        """Log in again after a 401, once for all calls that saw the same expired session"""
+        with self._login_lock:
+            if self.sap.session_id != stale_session_id:
+                return bool(self.sap.session_id)
+            self.sap.session_id = None
+            return self.sap.login()
+
+    def _send(self, method, path, params=None, json_body=None, headers=None, timeout=DEFAULT_TIMEOUT):
+        url = f"{self.sap.base_url}/b1s/v1/{path}"
+        self.ensure_logged_in()
+        session_id = self.sap.session_id
+        response = self.sap.session.request(method, url, params=params, json=json_body, headers=headers,
+                                            timeout=timeout)
+        if response.status_code == 401 and self._relogin(session_id):
+            response = self.sap.session.request(method, url, params=params, json=json_body, headers=headers,
+                                                timeout=timeout)
+        return response
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def request(self, method, path, **kwargs):
+        """Send one Service Layer request (path relative to /b1s/v1/) and return the response"""
+        loop = asyncio.get_running_loop()
+        # Worker threads see the caller's Flask request and profiler context
+        call = functools.partial(contextvars.copy_context().run, self._send, method, path, **kwargs)
+        async with self._semaphore():
+            return await loop.run_in_executor(None, call)
+
+    def run(self, coro):
+        """Run a coroutine to completion from synchronous code, e.g. a Flask view"""
+        async def main():
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='sap-async'))
+            try:
+                return await coro
+            finally:
+                self._semaphores.pop(asyncio.get_running_loop(), None)
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(main())
+        # Already inside an event loop (async view): use a helper thread with its own loop
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(contextvars.copy_context().run, asyncio.run, main()).result()
+
+    def run_all(self, coros):
+        """Run coroutines concurrently and return their results in order (exceptions are returned, not raised)"""
+        async def gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.run(gather())
+
+    # -- generic calls --------------------------------------------------
+
+    async def get_json(self, path, params=None, headers=None):
+        """GET returning the decoded body, or None on a non-200 answer or transport error"""
+        try:
+            response = await self.request('GET', path, params=params, headers=headers)
+        except Exception as e:
+            logging.warning(f"⚠️ SAP GET {path} failed: {str(e)}")
+            return None
+        if response.status_code != 200:
+            logging.warning(f"⚠️ SAP GET {path} returned {response.status_code}")
+            return None
+        return response.json()
+
+    async def sql_query(self, name, param_list):
+        """Rows of SQLQueries('<name>')/List, or None when the call failed"""
+        try:
+            response = await self.request('POST', f"SQLQueries('{name}')/List",
+                                          json_body={'ParamList': param_list})
+        except Exception as e:
+            logging.warning(f"⚠️ SAP SQL query {name} failed: {str(e)}")
+            return None
+        if response.status_code != 200:
+            logging.warning(f"⚠️ SAP SQL query {name} returned {response.status_code}")
+            return None
+        return response.json().get('value', [])
+
+    # -- fan-out workloads ----------------------------------------------
+
+    async def get_system_numbers(self, serial_numbers):
+        """SerialNumber -> SystemNumber (0 when SAP does not know the serial), one lookup per distinct serial"""
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+
+        async def lookup(serial_number):
+            data = await self.get_json('SerialNumberDetails', params={
+                '$select': 'SystemNumber',
+                '$filter': "SerialNumber eq '{}'".format(serial_number.replace("'", "''")),
+            })
+            rows = (data or {}).get('value', [])
+            return rows[0].get('SystemNumber', 0) if rows else 0
+
+        results = await asyncio.gather(*(lookup(serial) for serial in serial_numbers))
+        return dict(zip(serial_numbers, results))
+
+    async def get_items(self, item_codes, select='ItemCode,ItemName,InventoryUOM,ManageSerialNumbers,'
+                                                 'ManageBatchNumbers,ItemType,StandardPrice'):
+        """ItemCode -> Items master row for the codes SAP returned, fetched in concurrent chunks"""
+        codes = list(dict.fromkeys(code for code in item_codes if code))
+        chunks = [codes[i:i + ITEMS_CHUNK_SIZE] for i in range(0, len(codes), ITEMS_CHUNK_SIZE)]
+
+        async def fetch(chunk):
+            item_filter = ' or '.join("ItemCode eq '{}'".format(code.replace("'", "''")) for code in chunk)
+            data = await self.get_json('Items', params={'$filter': item_filter, '$select': select},
+                                       headers={'Prefer': 'odata.maxpagesize=0'})
+            return (data or {}).get('value', [])
+
+        items = {}
+        for rows in await asyncio.gather(*(fetch(chunk) for chunk in chunks)):
+            for row in rows:
+                items[row.get('ItemCode')] = row
+        return items
+
+    async def validate_serials(self, serial_numbers, warehouse_code):
+        """
+        Validate serials for a Serial Item Transfer concurrently.
+        Returns SerialNumber -> result in the shape of SAPIntegration.validate_serial_item_for_transfer;
+        item descriptions come from one chunked Items lookup instead of one call per serial.
+        """
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+
+        async def validate(serial_number):
+            rows = await self.sql_query('Item_Validation',
+                                        f"seriel_number='{serial_number}'&whcode='{warehouse_code}'")
+            if rows is None:
+                return {'valid': False, 'error': 'SAP B1 API call failed', 'source': 'sap_b1_error'}
+            if not rows:
+                return {'valid': False, 'source': 'sap_b1',
+                        'error': f'Serial number {serial_number} not found in warehouse {warehouse_code} or quantity is 0'}
+            row = rows[0]
+            return {'valid': True, 'item_code': row.get('ItemCode', ''), 'warehouse_code': row.get('WhsCode', ''),
+                    'dist_number': row.get('DistNumber', ''), 'source': 'sap_b1'}
+
+        results = dict(zip(serial_numbers, await asyncio.gather(*(validate(serial) for serial in serial_numbers))))
+        items = await self.get_items({result['item_code'] for result in results.values() if result['valid']},
+                                     select='ItemCode,ItemName')
+        for result in results.values():
+            if result['valid']:
+                item = items.get(result['item_code'])
+                result['item_description'] = (item or {}).get('ItemName') or f"Item {result['item_code']}"
+        return results
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+SAP Integration Benchmark
+Drives WMS flows through SAPIntegration against the local Service Layer simulator
+(sap_simulator.py) and reports throughput, latency percentiles and SAP calls per flow.
+
+Flows:
+    serial_paste   - validate pasted serials one by one, as /validate_serial_only does
+    serial_paste_async - validate the same paste concurrently with AsyncSAPClient, as /validate_serials does
+    bin_scan       - enhanced bin scan (BinLocations, Warehouses, $crossjoin, batches per item)
+    post_transfer  - post a serial stock transfer (SystemNumber lookups + streamed $batch)
+
+Usage:
+    python sap_benchmark.py
+    python sap_benchmark.py --serials 2000 --workers 8 --latency-ms 40 --jitter-ms 10
+    python sap_benchmark.py --flows bin_scan --bins 20 --error-rate 0.02
+    python sap_benchmark.py --url http://127.0.0.1:50000   # use an already running simulator
+
+Each operation creates its own SAPIntegration (and therefore logs in), as the WMS routes do.
+Nothing here reads SAP settings from credentials - every client is pointed at the simulator.
+"""
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import sap_metrics
+from sap_simulator import Dataset, ServiceLayerSimulator, start_background_server
+
+FLOWS = ('serial_paste', 'serial_paste_async', 'bin_scan', 'post_transfer')
+
+# Serials per /validate_serials request (MAX_BULK_VALIDATION_SERIALS in the serial item transfer routes)
+BULK_PASTE_SIZE = 2000
+
+
+def make_client(base_url):
+    """SAPIntegration bound to the simulator regardless of configured credentials"""
+    from sap_integration import SAPIntegration
+
+    sap = SAPIntegration()
+    sap.base_url = base_url
+    sap.username = 'benchmark'
+    sap.password = 'benchmark'
+    sap.company_db = 'SIMULATOR'
+    return sap
+
+
+def run_operations(operations, workers):
+    """Run callables concurrently; returns (wall_seconds, latencies_ms, failures)"""
+    def timed(operation):
+        started = time.perf_counter()
+        try:
+            ok = operation()
+        except Exception as e:
+            logging.warning(f"⚠️ Benchmark operation failed: {str(e)}")
+            ok = False
+        return (time.perf_counter() - started) * 1000, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(timed, operations))
+    wall = time.perf_counter() - started
+    return wall, [ms for ms, _ in results], sum(1 for _, ok in results if not ok)
+
+
+def pasted_serials(dataset, args, rng):
+    warehouse = dataset.warehouses[0]['WarehouseCode']
+    in_stock = [number for number, _ in dataset.serial_rows(warehouse=warehouse)]
+    serials = rng.sample(in_stock, min(args.serials, len(in_stock)))
+    # A share of pasted serials are typos that SAP does not know
+    for i in range(int(len(serials) * args.invalid_share)):
+        serials[i] = f"BAD{rng.randrange(10 ** 9):09d}"
+    rng.shuffle(serials)
+    return warehouse, serials
+
+
+def serial_paste_operations(base_url, dataset, args, rng):
+    warehouse, serials = pasted_serials(dataset, args, rng)
+
+    def validate(serial):
+        def operation():
+            result = make_client(base_url).validate_serial_item_for_transfer(serial, warehouse)
+            return result.get('source') == 'sap_b1'
+        return operation
+
+    return [validate(serial) for serial in serials], f"{len(serials)} serials from {warehouse}"
+
+
+def serial_paste_async_operations(base_url, dataset, args, rng):
+    from sap_async_client import AsyncSAPClient
+
+    warehouse, serials = pasted_serials(dataset, args, rng)
+    pastes = [serials[i:i + BULK_PASTE_SIZE] for i in range(0, len(serials), BULK_PASTE_SIZE)]
+
+    def validate(paste):
+        def operation():
+            client = AsyncSAPClient(make_client(base_url), max_concurrency=args.async_concurrency)
+            results = client.run(client.validate_serials(paste, warehouse))
+            return all(result.get('source') == 'sap_b1' for result in results.values())
+        return operation
+
+    return [validate(paste) for paste in pastes], \
+        f"{len(serials)} serials from {warehouse}, {args.async_concurrency} concurrent calls per paste"
+
+
+def bin_scan_operations(base_url, dataset, args, rng):
+    bins = [rng.choice(dataset.bins)['BinCode'] for _ in range(args.bins)]
+
+    def scan(bin_code):
+        def operation():
+            return bool(make_client(base_url).get_bin_items(bin_code))
+        return operation
+
+    return [scan(bin_code) for bin_code in bins], f"{len(bins)} bin scans"
+
+
+def post_transfer_operations(base_url, dataset, args, rng):
+    source, target = dataset.warehouses[0]['WarehouseCode'], dataset.warehouses[1]['WarehouseCode']
+    rows = dataset.serial_rows(warehouse=source)
+    chosen = rng.sample(rows, min(args.serials, len(rows)))
+
+    by_item = {}
+    for number, row in chosen:
+        by_item.setdefault(row['ItemCode'], []).append(SimpleNamespace(
+            serial_number=number, is_validated=True, admission_date=None))
+
+    def transfer_document(index, from_warehouse, to_warehouse):
+        items = [SimpleNamespace(item_code=item_code, serial_numbers=serials, unit_of_measure='EA',
+                                 from_warehouse_code=from_warehouse, to_warehouse_code=to_warehouse)
+                 for item_code, serials in by_item.items()]
+        return SimpleNamespace(transfer_number=f"BENCH-{index:03d}", items=items, created_at=datetime.utcnow(),
+                               user=None, qc_approver=None, from_warehouse=from_warehouse, to_warehouse=to_warehouse)
+
+    def post(index):
+        def operation():
+            # Alternate direction so the same serials can be posted again
+            from_warehouse, to_warehouse = (source, target) if index % 2 == 0 else (target, source)
+            result = make_client(base_url).create_serial_number_stock_transferss(
+                transfer_document(index, from_warehouse, to_warehouse), chunk_size=args.chunk_size)
+            return result.get('success')
+        return operation
+
+    # Posts of the same serials must not overlap, so they run one after another
+    return [post(index) for index in range(args.transfers)], \
+        f"{args.transfers} transfers of {len(chosen)} serials ({len(by_item)} lines)"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WMS SAP flows against the Service Layer simulator')
+    parser.add_argument('--flows', default=','.join(FLOWS), help=f"Comma-separated flows (default: {','.join(FLOWS)})")
+    parser.add_argument('--url', help='Base URL of a running simulator (default: start one in-process)')
+    parser.add_argument('--serials', type=int, default=2000, help='Serials per paste / transfer (default: 2000)')
+    parser.add_argument('--invalid-share', type=float, default=0.05, help='Share of unknown pasted serials')
+    parser.add_argument('--bins', type=int, default=10, help='Bin scans (default: 10)')
+    parser.add_argument('--transfers', type=int, default=2, help='Transfers to post (default: 2)')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Lines per StockTransfer document')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent operations (default: 4)')
+    parser.add_argument('--async-concurrency', type=int, default=8,
+                        help='SAP calls in flight per serial_paste_async paste (default: 8)')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Simulated latency per SAP request')
+    parser.add_argument('--jitter-ms', type=float, default=5.0, help='Uniform +/- jitter on the latency')
+    parser.add_argument('--write-latency-ms', type=float, default=200.0, help='Extra latency per created document')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of SAP requests answered with 503')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help='Keep the application logging')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # Per-operation warnings (unknown serials, missing credential file) would drown the report
+        logging.getLogger().setLevel(logging.ERROR)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    flows = [flow.strip() for flow in args.flows.split(',') if flow.strip()]
+    unknown = [flow for flow in flows if flow not in FLOWS]
+    if unknown:
+        parser.error(f"unknown flow(s): {', '.join(unknown)}")
+
+    # The benchmark uses the simulator's dataset to choose serials and bins, so an external
+    # simulator must have been started with the same --seed
+    dataset = Dataset(seed=args.seed)
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        simulator = ServiceLayerSimulator(dataset, args.latency_ms, args.jitter_ms, args.error_rate,
+                                          args.write_latency_ms, seed=args.seed)
+        _, base_url = start_background_server(simulator)
+    # Keep credential lookups quiet; make_client overrides these values anyway
+    for key, value in (('SAP_B1_SERVER', base_url), ('SAP_B1_USERNAME', 'benchmark'),
+                       ('SAP_B1_PASSWORD', 'benchmark'), ('SAP_B1_COMPANY_DB', 'SIMULATOR')):
+        os.environ.setdefault(key, value)
+
+    print("📈 WMS SAP Integration Benchmark")
+    print("=" * 100)
+    print(f"Simulator: {base_url}   latency {args.latency_ms:.0f}±{args.jitter_ms:.0f} ms, "
+          f"write +{args.write_latency_ms:.0f} ms, error rate {args.error_rate:.1%}, workers {args.workers}")
+    print(f"{'flow':<20}{'ops':>6}{'wall s':>9}{'ops/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+          f"{'failed':>8}{'SAP calls':>11}  detail")
+
+    builders = {
+        'serial_paste': serial_paste_operations,
+        'serial_paste_async': serial_paste_async_operations,
+        'bin_scan': bin_scan_operations,
+        'post_transfer': post_transfer_operations,
+    }
+    rng = random.Random(args.seed)
+    failed_total = 0
+    for flow in flows:
+        operations, detail = builders[flow](base_url, dataset, args, rng)
+        sap_metrics.reset()
+        # Transfers must not overlap; async pastes bring their own concurrency
+        workers = 1 if flow in ('post_transfer', 'serial_paste_async') else args.workers
+        wall, latencies, failed = run_operations(operations, workers)
+        failed_total += failed
+        sap_calls = sum(row['calls'] for row in sap_metrics.snapshot())
+        print(f"{flow:<20}{len(latencies):>6}{wall:>9.2f}{len(latencies) / wall:>9.1f}"
+              f"{statistics.median(latencies):>10.1f}{percentile(latencies, 0.95):>10.1f}{max(latencies):>10.1f}"
+              f"{failed:>8}{sap_calls:>11}  {detail}")
+        for row in sap_metrics.snapshot()[:4]:
+            name = f"{row['method']} {row['endpoint']}" + (f" [{row['query_name']}]" if row['query_name'] else '')
+            print(f"{'':<20}  {row['calls']:>6} x {name} ({row['total_seconds']:.2f} s)")
+
+    # Unknown pasted serials validate as 'not found', so failures here are SAP or transport errors
+    if failed_total and not args.error_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
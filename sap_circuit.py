@@ -0,0 +1,210 @@
+"""
+Circuit breaker and default timeouts for SAP B1 Service Layer calls.
+
+Every SAP requests session mounts SAPTransportAdapter (see prepare_session):
+
+- Calls without a timeout get (SAP_CONNECT_TIMEOUT, SAP_READ_TIMEOUT), and no call
+  waits longer than SAP_CONNECT_TIMEOUT to connect; explicit read timeouts are kept.
+- One CircuitBreaker per Service Layer base URL, shared by all sessions of the worker
+  process, counts transport errors and 502/503/504 answers. After SAP_BREAKER_FAILURES
+  consecutive failures it opens: calls fail at once with SAPUnavailableError (a requests
+  ConnectionError, so the existing offline/cached fallbacks take over) until
+  SAP_BREAKER_COOLDOWN seconds have passed. Then a single probe call is let through
+  (half-open) and its outcome closes or re-opens the circuit.
+
+Breaker state is listed on /admin/sap-metrics and exported on /metrics.
+"""
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
+from sap_metrics import InstrumentedAdapter, normalize_endpoint, record_call
+
+SAP_CONNECT_TIMEOUT = float(os.environ.get('SAP_CONNECT_TIMEOUT', '5'))
+SAP_READ_TIMEOUT = float(os.environ.get('SAP_READ_TIMEOUT', '60'))
+SAP_BREAKER_FAILURES = int(os.environ.get('SAP_BREAKER_FAILURES', '5'))
+SAP_BREAKER_COOLDOWN = float(os.environ.get('SAP_BREAKER_COOLDOWN', '30'))
+
+# Answers that mean the Service Layer (or the proxy in front of it) is unavailable
+UNAVAILABLE_STATUSES = (502, 503, 504)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+_lock = threading.Lock()
+_breakers = {}
+
+
+class SAPUnavailableError(RequestsConnectionError):
+    """Raised instead of calling SAP while its circuit is open"""
+
+
+class CircuitBreaker:
+    """Closed / open / half-open state machine for one Service Layer"""
+
+    def __init__(self, base_url, failure_threshold=None, cooldown=None):
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold or SAP_BREAKER_FAILURES
+        self.cooldown = cooldown or SAP_BREAKER_COOLDOWN
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.open_count = 0
+        self.rejected = 0
+        self.last_error = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """True when a call may go to SAP; in half-open state only one probe at a time"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logging.info(f"✅ SAP B1 circuit closed for {self.base_url}")
+            self.state = CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)[:200]
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.open_count += 1
+                logging.warning(f"⚠️ SAP B1 circuit opened for {self.base_url} after {self.failures} failure(s) "
+                                f"({self.last_error}); failing fast for {self.cooldown:.0f} s")
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed (0 unless open)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'base_url': self.base_url,
+                'state': self.state,
+                'failures': self.failures,
+                'open_count': self.open_count,
+                'rejected': self.rejected,
+                'retry_in': round(self.retry_in(), 1),
+                'last_error': self.last_error,
+            }
+
+
+def _base_url(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def breaker_for(url):
+    """The shared breaker for the Service Layer serving url"""
+    base_url = _base_url(url)
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(base_url, CircuitBreaker(base_url))
+    return breaker
+
+
+def is_available(url):
+    """False while the circuit for url is open (a half-open probe counts as available)"""
+    breaker = _breakers.get(_base_url(url))
+    return breaker is None or breaker.state != OPEN or breaker.retry_in() == 0
+
+
+def breaker_states():
+    with _lock:
+        breakers = list(_breakers.values())
+    return [breaker.to_dict() for breaker in breakers]
+
+
+def reset_breakers():
+    with _lock:
+        _breakers.clear()
+
+
+def render_prometheus():
+    """Prometheus text for the breaker states, appended to the SAP call metrics on /metrics"""
+    out = ['# HELP sap_circuit_state SAP Service Layer circuit state (0 closed, 1 half-open, 2 open)',
+           '# TYPE sap_circuit_state gauge']
+    states = breaker_states()
+    for state in states:
+        value = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[state['state']]
+        out.append(f'sap_circuit_state{{base_url="{state["base_url"]}"}} {value}')
+    out += ['# HELP sap_circuit_rejected_total Calls refused while the circuit was open',
+            '# TYPE sap_circuit_rejected_total counter']
+    for state in states:
+        out.append(f'sap_circuit_rejected_total{{base_url="{state["base_url"]}"}} {state["rejected"]}')
+    return '\n'.join(out) + '\n'
+
+
+def apply_default_timeout(timeout):
+    """(connect, read) for a call: fill in defaults and cap the connect timeout"""
+    if timeout is None:
+        return SAP_CONNECT_TIMEOUT, SAP_READ_TIMEOUT
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    connect = SAP_CONNECT_TIMEOUT if connect is None else min(connect, SAP_CONNECT_TIMEOUT)
+    return connect, SAP_READ_TIMEOUT if read is None else read
+
+
+class SAPTransportAdapter(InstrumentedAdapter):
+    """InstrumentedAdapter plus default timeouts and the per-Service-Layer circuit breaker"""
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        breaker = breaker_for(request.url)
+        if not breaker.allow_request():
+            endpoint, query_name = normalize_endpoint(request.path_url)
+            record_call(request.method, endpoint, query_name, 'circuit_open', 0.0)
+            raise SAPUnavailableError(f"SAP B1 unavailable (circuit open for {breaker.base_url}, "
+                                      f"retry in {breaker.retry_in():.0f} s)", request=request)
+        try:
+            response = super().send(request, stream=stream, timeout=apply_default_timeout(timeout), **kwargs)
+        except Exception as e:
+            breaker.record_failure(e)
+            raise
+        if response.status_code in UNAVAILABLE_STATUSES:
+            breaker.record_failure(f"HTTP {response.status_code}")
+        else:
+            breaker.record_success()
+        return response
+
+
+def prepare_session(session, pool_maxsize=None):
+    """
+    Mount the SAP transport adapter (metrics, timeouts, circuit breaker) on a requests session.
+    An adapter that is already mounted is kept unless pool_maxsize asks for a bigger connection
+    pool; a replaced adapter hands over its retry state and its connections are closed.
+    """
+    current = session.adapters.get('https://')
+    if (isinstance(current, SAPTransportAdapter) and session.adapters.get('http://') is current
+            and (not pool_maxsize or current._pool_maxsize >= pool_maxsize)):
+        return session
+
+    adapter = SAPTransportAdapter(pool_maxsize=pool_maxsize) if pool_maxsize else SAPTransportAdapter()
+    if isinstance(current, InstrumentedAdapter):
+        adapter._failed.update(current._failed)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if current is not None:
+        current.close()
+    return session
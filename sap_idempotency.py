@@ -0,0 +1,263 @@
+"""
+Idempotent SAP B1 document posting.
+
+Every post is recorded in SAPPostingAttempt keyed by WMS document type, document
+id and a hash of the payload content, and the document is tagged in SAP with a
+reference user-defined field. A double-click or proxy retry then returns the
+original SAP document instead of creating a duplicate. Attempts are recorded in
+their own session, so they never commit the caller's unit of work.
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import fast_json
+from credential_loader import load_credentials_from_json, get_credential
+
+# Payload fields regenerated on every build (timestamps) - ignored when hashing
+VOLATILE_FIELDS = {'DocDate', 'DocDueDate', 'DueDate', 'TaxDate'}
+
+# An in-progress attempt younger than this is treated as a concurrent post
+IN_PROGRESS_GRACE = timedelta(minutes=5)
+
+# Attempts that may or may not have reached SAP: 'unknown' after a timeout or a
+# dropped connection, 'in_progress' once older than IN_PROGRESS_GRACE
+UNRESOLVED_STATUSES = ('in_progress', 'unknown')
+
+LOOKUP_TIMEOUT = (5, 15)
+
+_reference_field = None
+_reference_field_disabled = False
+
+
+def get_reference_field():
+    """Name of the SAP UDF holding the posting reference ('' when disabled)"""
+    global _reference_field
+    if _reference_field is None:
+        credentials = load_credentials_from_json()
+        _reference_field = get_credential(credentials, 'SAP_POSTING_REFERENCE_FIELD', 'U_WMS_PostRef') or ''
+    return '' if _reference_field_disabled else _reference_field
+
+
+def content_hash(payload, volatile_fields=()):
+    """SHA-256 of the payload with volatile fields removed"""
+    skip = VOLATILE_FIELDS | set(volatile_fields) | {get_reference_field()}
+    stable = {key: value for key, value in payload.items() if key not in skip}
+    encoded = json.dumps(stable, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class ReferenceLookupError(Exception):
+    """SAP could not be asked whether a posting reference exists"""
+
+
+def _lookup_sap_document(sap, entity, reference):
+    """Like find_sap_document, but raises ReferenceLookupError instead of returning None when the lookup fails"""
+    field = get_reference_field()
+    if not field:
+        raise ReferenceLookupError('SAP posting reference field is not available')
+
+    url = f"{sap.base_url}/b1s/v1/{entity}?$filter={field} eq '{reference}'&$select=DocEntry,DocNum"
+    try:
+        response = sap.session.get(url, timeout=LOOKUP_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise ReferenceLookupError(str(e)) from e
+    if response.status_code != 200:
+        raise ReferenceLookupError(f"HTTP {response.status_code}")
+    documents = response.json().get('value', [])
+    return documents[0] if documents else None
+
+
+def find_sap_document(sap, entity, reference):
+    """Look up a document in SAP by posting reference, returning {'DocEntry', 'DocNum'} or None"""
+    try:
+        return _lookup_sap_document(sap, entity, reference)
+    except ReferenceLookupError as e:
+        if get_reference_field():
+            logging.warning(f"⚠️ Posting reference lookup failed for {reference}: {str(e)}")
+        return None
+
+
+def _posted_result(attempt, data=None, duplicate=False):
+    return {
+        'success': True,
+        'duplicate': duplicate,
+        'reference': attempt.reference,
+        'doc_entry': attempt.sap_doc_entry,
+        'doc_num': attempt.sap_doc_num,
+        'data': data if data is not None else {'DocEntry': attempt.sap_doc_entry, 'DocNum': attempt.sap_doc_num},
+        'response': None
+    }
+
+
+def _mark_posted(attempt, data):
+    attempt.status = 'posted'
+    attempt.sap_doc_entry = data.get('DocEntry')
+    attempt.sap_doc_num = str(data.get('DocNum')) if data.get('DocNum') is not None else None
+    attempt.error_message = None
+    attempt.updated_at = datetime.utcnow()
+
+
+def _post_json(sap, url, body, timeout):
+    """POST body as compact JSON (large invoice payloads are encoded once, without padding)"""
+    return sap.session.post(url, data=fast_json.dumps_bytes(body),
+                            headers={'Content-Type': 'application/json'}, timeout=timeout)
+
+
+def _attempt_session():
+    """Session for SAPPostingAttempt rows, separate from db.session so that recording
+    an attempt never commits (or rolls back) the caller's pending changes"""
+    from app import db
+    return Session(db.engine, expire_on_commit=False)
+
+
+def _verify_result(attempt, reason):
+    return {
+        'success': False,
+        'verify_in_sap': True,
+        'reference': attempt.reference,
+        'error': (f"An earlier posting of this document (ref {attempt.reference}) may have reached SAP B1 "
+                  f"and could not be verified ({reason}). Check SAP B1 for this reference and resolve "
+                  f"the posting attempt before posting again."),
+        'response': None
+    }
+
+
+def post_document(sap, entity, document_type, document_id, payload, timeout=60, volatile_fields=(),
+                  attempt_key=None):
+    """
+    POST payload to a Service Layer entity set at most once per document content.
+    attempt_key, when given, identifies the attempt instead of the content hash - for
+    documents whose payload is rebuilt with different values on a retry but must
+    still be posted only once (e.g. a Serial Item Transfer chunk).
+
+    Returns a dict with 'success'. On success it also has 'doc_entry', 'doc_num',
+    'data' (SAP response JSON) and 'duplicate' (True when an earlier post was
+    reused). On failure it has 'error' and, for HTTP errors, the raw 'response';
+    'verify_in_sap' is set when an earlier attempt with an unknown outcome could
+    not be checked in SAP, and nothing is posted until it is resolved.
+    Connection errors and timeouts are recorded and re-raised.
+    """
+    from models import SAPPostingAttempt
+
+    digest = attempt_key or content_hash(payload, volatile_fields)
+    with _attempt_session() as session:
+        attempts = session.query(SAPPostingAttempt).filter_by(document_type=document_type,
+                                                               document_id=document_id).all()
+        attempt = next((a for a in attempts if a.content_hash == digest), None)
+
+        if attempt and attempt.status == 'posted':
+            logging.info(f"♻️ {document_type} {document_id} already posted to SAP B1 as "
+                         f"{entity} {attempt.sap_doc_num} (ref {attempt.reference}) - skipping duplicate post")
+            return _posted_result(attempt, duplicate=True)
+
+        now = datetime.utcnow()
+        if any(a.status == 'in_progress' and a.updated_at > now - IN_PROGRESS_GRACE for a in attempts):
+            return {'success': False, 'in_progress': True,
+                    'error': 'A posting for this document is already in progress', 'response': None}
+
+        # An abandoned or timed-out attempt may still have reached SAP, whatever content
+        # it carried - settle every one of them before posting anything
+        for unresolved in [a for a in attempts if a.status in UNRESOLVED_STATUSES]:
+            try:
+                existing = _lookup_sap_document(sap, unresolved.sap_entity, unresolved.reference)
+            except ReferenceLookupError as e:
+                logging.warning(f"⚠️ Cannot verify earlier posting {unresolved.reference} of "
+                                f"{document_type} {document_id}: {str(e)} - not re-posting")
+                return _verify_result(unresolved, str(e))
+            if existing:
+                _mark_posted(unresolved, existing)
+                session.commit()
+                logging.info(f"♻️ Found earlier SAP B1 {unresolved.sap_entity} {unresolved.sap_doc_num} "
+                             f"for ref {unresolved.reference}")
+                return _posted_result(unresolved, duplicate=True)
+            unresolved.status = 'failed'
+            unresolved.error_message = f"Not found in SAP B1 by reference ({unresolved.error_message})"
+            unresolved.updated_at = now
+
+        if attempt is None:
+            attempt = SAPPostingAttempt()
+            attempt.document_type = document_type
+            attempt.document_id = document_id
+            attempt.content_hash = digest
+            attempt.reference = f"WMS-{document_type[:12]}-{document_id}-{digest[:10]}"
+            attempt.sap_entity = entity
+            attempt.attempts = 0
+            session.add(attempt)
+
+        attempt.status = 'in_progress'
+        attempt.attempts = (attempt.attempts or 0) + 1
+        attempt.error_message = None
+        attempt.updated_at = now
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another request inserted the same attempt between our read and commit
+            session.rollback()
+            return {'success': False, 'in_progress': True,
+                    'error': 'A posting for this document is already in progress', 'response': None}
+
+        url = f"{sap.base_url}/b1s/v1/{entity}"
+        body = dict(payload)
+        field = get_reference_field()
+        if field:
+            body[field] = attempt.reference
+
+        try:
+            response = _post_json(sap, url, body, timeout)
+
+            if field and response.status_code == 400 and field in response.text:
+                # The UDF does not exist in this company DB - stop writing it and
+                # rely on the local attempt table alone
+                global _reference_field_disabled
+                _reference_field_disabled = True
+                logging.warning(f"⚠️ SAP B1 rejected posting reference field {field}; "
+                                f"create it to enable SAP-side duplicate checks")
+                body.pop(field, None)
+                response = _post_json(sap, url, body, timeout)
+        except requests.exceptions.RequestException as e:
+            # Only a failed connect proves SAP never saw the request
+            attempt.status = 'failed' if isinstance(e, requests.exceptions.ConnectTimeout) else 'unknown'
+            attempt.error_message = str(e)
+            attempt.updated_at = datetime.utcnow()
+            session.commit()
+            raise
+
+        if response.status_code in (200, 201):
+            data = response.json()
+            _mark_posted(attempt, data)
+            session.commit()
+            return _posted_result(attempt, data=data)
+
+        attempt.status = 'failed'
+        attempt.error_message = f"HTTP {response.status_code}: {response.text[:2000]}"
+        attempt.updated_at = datetime.utcnow()
+        session.commit()
+        return {'success': False, 'error': attempt.error_message, 'response': response}
+
+
+def resolve_attempt(reference, posted, doc_entry=None, doc_num=None):
+    """
+    Settle an attempt whose outcome is unknown after it was checked in SAP by hand:
+    posted=True records the SAP document, posted=False allows the document to be
+    posted again. Returns False when no unresolved attempt has this reference.
+    """
+    from models import SAPPostingAttempt
+
+    with _attempt_session() as session:
+        attempt = session.query(SAPPostingAttempt).filter_by(reference=reference).first()
+        if attempt is None or attempt.status not in UNRESOLVED_STATUSES:
+            return False
+        if posted:
+            _mark_posted(attempt, {'DocEntry': doc_entry, 'DocNum': doc_num})
+        else:
+            attempt.status = 'failed'
+            attempt.error_message = f"Verified as not posted in SAP B1 ({attempt.error_message})"
+            attempt.updated_at = datetime.utcnow()
+        session.commit()
+    return True
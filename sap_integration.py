@@ -1,11 +1,20 @@
+import contextvars
 import requests
 import json
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import urllib.parse
 import urllib3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import jsonify
+from sqlalchemy.exc import IntegrityError
+
+from cache_utils import TTLCache
+from logging_config import payload_log, LazyJson
+from sap_async_client import AsyncSAPClient
+from sap_circuit import is_available, prepare_session
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -22,7 +31,7 @@ class SAPIntegration:
         self.password = get_credential(credentials, 'SAP_B1_PASSWORD', '')
         self.company_db = get_credential(credentials, 'SAP_B1_COMPANY_DB', '')
         self.session_id = None
-        self.session = requests.Session()
+        self.session = prepare_session(requests.Session())
         self.session.verify = False  # For development, in production use proper SSL
         self.is_offline = False
 
@@ -42,6 +51,12 @@ class SAPIntegration:
                 "SAP B1 configuration not complete. Running in offline mode.")
             return False
 
+        if not is_available(self.base_url):
+            # Circuit open after repeated failures: go offline now instead of waiting on SAP
+            logging.warning("SAP B1 circuit open. Running in offline mode.")
+            self.is_offline = True
+            return False
+
         login_url = f"{self.base_url}/b1s/v1/Login"
         login_data = {
             "UserName": self.username,
@@ -56,6 +71,9 @@ class SAPIntegration:
             if response.status_code == 200:
                 self.session_id = response.json().get('SessionId')
                 logging.info("Successfully logged in to SAP B1")
+                # First login in this worker verifies the required SQL queries in the background
+                from bootstrap import ensure_sap_queries_provisioned
+                ensure_sap_queries_provisioned()
                 return True
             else:
                 logging.warning(
@@ -91,7 +109,7 @@ class SAPIntegration:
 
             url = f"{self.base_url}/b1s/v1/BusinessPartners?$select=CardCode,CardName"
 
-            response = requests.get(url, headers=headers, verify=False, timeout=30)
+            response = self.session.get(url, headers=headers, timeout=30)
             response.raise_for_status()
 
             data = response.json()
@@ -104,8 +122,73 @@ class SAPIntegration:
             logging.error(f"Failed to get business partners: {e}")
             return None
 
+    # Candidate lookups for get_inventory_transfer_request, in priority order
+    TRANSFER_REQUEST_CANDIDATES = [
+        ('InventoryTransferRequests', "DocNum eq {doc_num}"),
+        ('InventoryTransferRequests', "DocNum eq '{doc_num}'"),
+        ('StockTransfers', "DocNum eq {doc_num}"),
+        ('StockTransfers', "DocNum eq '{doc_num}'"),
+    ]
+    TRANSFER_REQUEST_TIMEOUT = (5, 15)  # (connect, read) seconds per candidate
+
+    # Shared across instances: index of the candidate that last matched, and
+    # DocNum -> (entity, DocEntry) so repeat lookups are a single keyed GET
+    _transfer_request_hint = None
+    _transfer_request_doc_entries = TTLCache(ttl=3600, maxsize=4096)
+
+    def _normalize_transfer_request(self, transfer_data):
+        """Normalize transfer request/stock transfer payloads for consistent access"""
+        if 'StockTransferLines' not in transfer_data and 'DocumentLines' in transfer_data:
+            transfer_data['StockTransferLines'] = transfer_data['DocumentLines']
+
+        # Ensure consistent status field
+        if 'DocumentStatus' in transfer_data and 'DocStatus' not in transfer_data:
+            transfer_data['DocStatus'] = transfer_data['DocumentStatus']
+
+        doc_status = transfer_data.get('DocStatus', '')
+        logging.info(
+            f"Transfer Data: DocNum={transfer_data.get('DocNum')}, Status={doc_status}, "
+            f"FromWarehouse={transfer_data.get('FromWarehouse')}, ToWarehouse={transfer_data.get('ToWarehouse')}"
+        )
+        return transfer_data
+
+    def _query_transfer_request_candidate(self, index, doc_num):
+        """Run one candidate lookup, returning the first matching document or None"""
+        entity, filter_template = self.TRANSFER_REQUEST_CANDIDATES[index]
+        url = f"{self.base_url}/b1s/v1/{entity}?$filter={filter_template.format(doc_num=doc_num)}"
+        logging.info(f"Trying SAP B1 API: {url}")
+
+        try:
+            response = self.session.get(url, timeout=self.TRANSFER_REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"API call failed for {url}: {str(e)}")
+            return None
+
+        if response.status_code != 200:
+            logging.warning(f"API call failed for {url}: {response.status_code}")
+            return None
+
+        transfers = response.json().get('value', [])
+        if not transfers:
+            logging.info(f"No results from endpoint: {entity}")
+            return None
+        return transfers[0]
+
+    def _remember_transfer_request(self, index, doc_num, transfer_data):
+        entity = self.TRANSFER_REQUEST_CANDIDATES[index][0]
+        SAPIntegration._transfer_request_hint = index
+        if transfer_data.get('DocEntry') is not None:
+            self._transfer_request_doc_entries.set(str(doc_num), (entity, transfer_data['DocEntry']))
+        logging.info(f"Transfer request found via {entity}: {transfer_data.get('DocNum')}")
+        return self._normalize_transfer_request(transfer_data)
+
     def get_inventory_transfer_request(self, doc_num):
-        """Get specific inventory transfer request from SAP B1"""
+        """
+        Get specific inventory transfer request from SAP B1.
+        Uses the cached DocEntry when known. Otherwise the highest-priority endpoint
+        is tried alone when it matched last time; the remaining candidates are
+        queried concurrently and the highest-priority hit wins.
+        """
         if not self.ensure_logged_in():
             logging.warning(
                 "SAP B1 not available, returning mock transfer request for validation"
@@ -116,62 +199,42 @@ class SAPIntegration:
             }
 
         try:
-            # Try multiple endpoints to find the transfer request
-            endpoints_to_try = [
-                f"InventoryTransferRequests?$filter=DocNum eq {doc_num}",
-                f"InventoryTransferRequests?$filter=DocNum eq '{doc_num}'",
-                f"StockTransfers?$filter=DocNum eq {doc_num}",
-                f"StockTransfers?$filter=DocNum eq '{doc_num}'"
-            ]
-
-            for endpoint in endpoints_to_try:
-                url = f"{self.base_url}/b1s/v1/{endpoint}"
-                logging.info(f"Trying SAP B1 API: {url}")
-
-                response = self.session.get(url)
-                #logging.info(f"Response status: {response.status_code}")
-
-                if response.status_code == 200:
-                    data = response.json()
-                    transfers = data.get('value', [])
-                    logging.info(
-                        f"Found {len(transfers)} transfer requests for DocNum {doc_num}"
-                    )
-
-                    if transfers:
-                        transfer_data = transfers[0]
-                        doc_status = transfer_data.get(
-                            'DocumentStatus',
-                            transfer_data.get('DocStatus', ''))
-                        logging.info(
-                            f"Transfer request found: {transfer_data.get('DocNum')} - Status: {doc_status}"
-                        )
-
-                        # Normalize the response structure for consistent access
-                        if 'StockTransferLines' not in transfer_data and 'DocumentLines' in transfer_data:
-                            transfer_data[
-                                'StockTransferLines'] = transfer_data[
-                                    'DocumentLines']
-
-                        # Ensure consistent status field
-                        if 'DocumentStatus' in transfer_data and 'DocStatus' not in transfer_data:
-                            transfer_data['DocStatus'] = transfer_data[
-                                'DocumentStatus']
-
-                        # Log the full structure for debugging
-                        logging.info(
-                            f"Transfer Data: DocNum={transfer_data.get('DocNum')}, FromWarehouse={transfer_data.get('FromWarehouse')}, ToWarehouse={transfer_data.get('ToWarehouse')}"
-                        )
-
-                        return transfer_data
-                    else:
-                        logging.info(f"No results from endpoint: {endpoint}")
-                        continue
-                else:
-                    logging.warning(
-                        f"API call failed for {endpoint}: {response.status_code}"
-                    )
-                    continue
+            cached = self._transfer_request_doc_entries.get(str(doc_num))
+            if cached:
+                entity, doc_entry = cached
+                url = f"{self.base_url}/b1s/v1/{entity}({doc_entry})"
+                try:
+                    response = self.session.get(url, timeout=self.TRANSFER_REQUEST_TIMEOUT)
+                    if response.status_code == 200:
+                        return self._normalize_transfer_request(response.json())
+                except requests.exceptions.RequestException as e:
+                    logging.warning(f"Cached DocEntry lookup failed for DocNum {doc_num}: {str(e)}")
+                self._transfer_request_doc_entries.invalidate(str(doc_num))
+
+            candidates = list(range(len(self.TRANSFER_REQUEST_CANDIDATES)))
+            # A hit is only final without asking the other endpoints when it comes from
+            # the highest-priority candidate - DocNum series overlap across object types
+            if SAPIntegration._transfer_request_hint == 0:
+                transfer_data = self._query_transfer_request_candidate(0, doc_num)
+                if transfer_data:
+                    return self._remember_transfer_request(0, doc_num, transfer_data)
+                candidates.remove(0)
+
+            pool = ThreadPoolExecutor(max_workers=len(candidates))
+            try:
+                # Each call runs in a copy of this context so it shows up in the request's
+                # profile and route attribution
+                futures = [(index, pool.submit(contextvars.copy_context().run,
+                                               self._query_transfer_request_candidate, index, doc_num))
+                           for index in candidates]
+                # Collect in priority order so an InventoryTransferRequest always
+                # wins over a StockTransfer with the same DocNum
+                for index, future in futures:
+                    transfer_data = future.result()
+                    if transfer_data:
+                        return self._remember_transfer_request(index, doc_num, transfer_data)
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
 
             # If no endpoint worked, return None
             logging.warning(
@@ -348,7 +411,7 @@ class SAPIntegration:
             headers = {"Prefer": "odata.maxpagesize=300"}
             crossjoin_response = self.session.get(crossjoin_url, headers=headers)
             logging.debug(f"[DEBUG] Status code: {crossjoin_response.status_code}")
-            logging.debug(f"[DEBUG] Response text: {crossjoin_response.text[:300]}")
+            payload_log.debug("[DEBUG] Response text: %s", crossjoin_response.text[:300])
 
             if crossjoin_response.status_code != 200:
                 logging.error(f"❌ Failed to get warehouse items: {crossjoin_response.status_code}")
@@ -627,7 +690,7 @@ class SAPIntegration:
             }
 
             logging.info(f"Fetching batch details for item {item_code} from SAP B1")
-            response = requests.get(url, headers=headers, params=params, verify=False, timeout=30)
+            response = self.session.get(url, headers=headers, params=params, timeout=30)
 
             if response.status_code == 200:
                 data = response.json()
@@ -875,8 +938,6 @@ class SAPIntegration:
                 'document_number': f'ST-{transfer_document.id}'
             }
 
-        url = f"{self.base_url}/b1s/v1/StockTransfers"
-
         # Get transfer request data for BaseEntry reference
         transfer_request_data = self.get_inventory_transfer_request(
             transfer_document.transfer_request_number)
@@ -972,14 +1033,15 @@ class SAPIntegration:
 
         # Log the JSON payload for debugging
         logging.info(f"Sending stock transfer to SAP B1:")
-        logging.info(f"JSON payload: {json.dumps(transfer_data, indent=2)}")
+        payload_log.info("JSON payload: %s", LazyJson(transfer_data))
 
         try:
-            response = self.session.post(url, json=transfer_data)
-            #logging.info(f"SAP B1 response status: {response.status_code}")
+            from sap_idempotency import post_document
+            posting = post_document(self, 'StockTransfers', 'inventory_transfer', transfer_document.id,
+                                    transfer_data, timeout=120)
 
-            if response.status_code == 201:
-                result = response.json()
+            if posting['success']:
+                result = posting['data']
                 logging.info(
                     f"✅ Stock transfer created successfully: {result.get('DocNum')}"
                 )
@@ -988,7 +1050,7 @@ class SAPIntegration:
                     'document_number': result.get('DocNum')
                 }
             else:
-                error_msg = f"SAP B1 error: {response.text}"
+                error_msg = f"SAP B1 error: {posting['error']}"
                 logging.error(
                     f"❌ Failed to create stock transfer: {error_msg}")
                 return {'success': False, 'error': error_msg}
@@ -1052,7 +1114,7 @@ class SAPIntegration:
 
         # Log the JSON payload for debugging
         logging.info(f"Sending serial item stock transfer to SAP B1:")
-        logging.info(f"JSON payload: {json.dumps(transfer_data, indent=2)}")
+        payload_log.info("JSON payload: %s", LazyJson(transfer_data))
 
         try:
             # Determine timeout based on transfer size - large volumes need more time
@@ -1832,7 +1894,7 @@ class SAPIntegration:
 
             # Execute PATCH request to SAP B1
             logging.info(f"Sending PATCH request to {url}")
-            logging.info(f"Payload: {json.dumps(payload, indent=2)}")
+            payload_log.info("Payload: %s", LazyJson(payload))
 
             response = self.session.patch(url, json=payload, timeout=30)
 
@@ -1942,7 +2004,7 @@ class SAPIntegration:
 
             # Execute PATCH request to SAP B1
             logging.info(f"Sending PATCH request to {url} for line {target_line_number}")
-            logging.info(f"Payload: {json.dumps(payload, indent=2)}")
+            payload_log.info("Payload: %s", LazyJson(payload))
 
             response = self.session.patch(url, json=payload, timeout=30)
 
@@ -2216,21 +2278,21 @@ class SAPIntegration:
             "DocumentLines": document_lines
         }
 
-        # Submit to SAP B1
-        url = f"{self.base_url}/b1s/v1/PurchaseDeliveryNotes"
-
         # Log the payload for debugging - Enhanced JSON logging
         import json
         logging.info("=" * 80)
         logging.info("PURCHASE DELIVERY NOTE - JSON PAYLOAD")
         logging.info("=" * 80)
-        logging.info(json.dumps(pdn_data, indent=2, default=str))
+        payload_log.info("%s", LazyJson(pdn_data))
         logging.info("=" * 80)
 
         try:
-            response = self.session.post(url, json=pdn_data)
-            if response.status_code == 201:
-                result = response.json()
+            # NumAtCard is regenerated per call, so it is excluded from the content hash
+            from sap_idempotency import post_document
+            posting = post_document(self, 'PurchaseDeliveryNotes', 'grpo', grpo_document.id, pdn_data,
+                                    timeout=120, volatile_fields=('NumAtCard',))
+            if posting['success']:
+                result = posting['data']
                 logging.info(
                     f"Successfully created Purchase Delivery Note {result.get('DocNum')} for GRPO {grpo_document.id}"
                 )
@@ -2247,7 +2309,7 @@ class SAPIntegration:
                         f'Purchase Delivery Note {result.get("DocNum")} created successfully with reference {external_ref}'
                 }
             else:
-                error_msg = f"SAP B1 error creating Purchase Delivery Note: {response.text}"
+                error_msg = f"SAP B1 error creating Purchase Delivery Note: {posting['error']}"
                 logging.error(error_msg)
                 return {'success': False, 'error': error_msg}
         except Exception as e:
@@ -2294,6 +2356,157 @@ class SAPIntegration:
             logging.error(f"Error posting GRPO to SAP: {str(e)}")
             return {'success': False, 'error': str(e)}
 
+    def sync_item_master(self, updated_since=None, page_size=500, stock_since=None):
+        """Sync SAP B1 Items (and per-warehouse OnHand) into the local item master replica
+
+        Args:
+            updated_since: Only fetch items with UpdateDate on/after this date (incremental);
+                None fetches everything.
+            page_size: Service Layer page size, follows odata.nextLink until exhausted
+            stock_since: Stock movements do not touch UpdateDate, so when given, OnHand is
+                also refreshed for the item/warehouse rows moved on/after this date
+                (SQLQueries('Item_Stock_Changes') over OITW)
+
+        Returns:
+            Dict with counts of fetched/created/updated items, or None if SAP is unavailable
+        """
+        if not self.ensure_logged_in():
+            logging.warning("Cannot sync item master - SAP B1 not available")
+            return None
+
+        select = ("ItemCode,ItemName,InventoryUOM,ManageSerialNumbers,ManageBatchNumbers,"
+                  "ItemType,Valid,UpdateDate,ItemWarehouseInfoCollection")
+        url = f"{self.base_url}/b1s/v1/Items?$select={select}&$orderby=ItemCode"
+        if updated_since:
+            url += f"&$filter=UpdateDate ge '{updated_since.strftime('%Y-%m-%d')}'"
+
+        stats = {'fetched': 0, 'created': 0, 'updated': 0}
+        if not self._sync_item_pages(url, page_size, stats, stock_only=False):
+            return None
+
+        if stock_since:
+            stats['stock_refreshed'] = 0
+            if not self._sync_item_stock_changes(stock_since, page_size, stats):
+                return None
+
+        logging.info(f"Item master sync complete: {stats}")
+        return stats
+
+    def _sync_item_pages(self, url, page_size, stats, stock_only):
+        """Apply every page of an Items query to the replica; False when SAP returned an error"""
+        from app import db
+
+        headers = {'Prefer': f'odata.maxpagesize={page_size}'}
+        while url:
+            response = self.session.get(url, headers=headers, timeout=60)
+            if response.status_code != 200:
+                logging.error(f"Item master sync failed: {response.status_code} - {response.text[:500]}")
+                db.session.rollback()
+                return False
+
+            data = response.json()
+            self._commit_item_page([item for item in data.get('value', []) if item.get('ItemCode')],
+                                   stats, stock_only)
+
+            next_link = data.get('odata.nextLink') or data.get('@odata.nextLink')
+            url = f"{self.base_url}/b1s/v1/{next_link}" if next_link else None
+        return True
+
+    def _sync_item_stock_changes(self, since, page_size, stats):
+        """Refresh OnHand of the item/warehouse rows with stock movements on/after since; False on error"""
+        from app import db
+
+        # OINM CreateDate is a date in the company's time zone - step back a day to cover the offset
+        since = (since - timedelta(days=1)).strftime('%Y-%m-%d')
+        url = f"{self.base_url}/b1s/v1/SQLQueries('Item_Stock_Changes')/List"
+        try:
+            response = self.session.post(url, json={"ParamList": f"since='{since}'"},
+                                         headers={'Prefer': 'odata.maxpagesize=0'}, timeout=60)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error calling SAP B1 Item_Stock_Changes: {str(e)}")
+            return False
+        if response.status_code != 200:
+            logging.error(f"SAP B1 Item_Stock_Changes failed: {response.status_code} - {response.text[:200]}")
+            db.session.rollback()
+            return False
+
+        # Reshape the OITW rows into Items with their ItemWarehouseInfoCollection
+        items = {}
+        for row in response.json().get('value', []):
+            if row.get('ItemCode') and row.get('WhsCode'):
+                items.setdefault(row['ItemCode'], []).append(
+                    {'WarehouseCode': row['WhsCode'], 'InStock': row.get('OnHand')})
+        items = [{'ItemCode': code, 'ItemWarehouseInfoCollection': stock} for code, stock in items.items()]
+        for start in range(0, len(items), page_size):
+            self._commit_item_page(items[start:start + page_size], stats, stock_only=True)
+        return True
+
+    def _commit_item_page(self, items, stats, stock_only):
+        """Apply and commit one page - one commit per page keeps transactions small"""
+        from app import db
+
+        try:
+            self._apply_item_page(items, stats, stock_only)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker or a manual sync inserted some of these rows first - re-read and apply again
+            db.session.rollback()
+            logging.info("Item master page changed concurrently, re-applying")
+            self._apply_item_page(items, stats, stock_only, counted=False)
+            db.session.commit()
+
+    def _apply_item_page(self, items, stats, stock_only, counted=True):
+        """Upsert one page of Items (and their warehouse stock) into the session"""
+        from app import db
+        from models import ItemMasterRecord, ItemWarehouseStock
+
+        codes = [item['ItemCode'] for item in items]
+        existing = {record.item_code: record
+                    for record in ItemMasterRecord.query.filter(ItemMasterRecord.item_code.in_(codes)).all()}
+        now = datetime.utcnow()
+
+        for item in items:
+            item_code = item['ItemCode']
+            record = existing.get(item_code)
+            if stock_only:
+                if record is None:
+                    continue  # Not in the replica yet - the next item pass brings it with its stock
+                if counted:
+                    stats['stock_refreshed'] += 1
+            else:
+                if counted:
+                    stats['fetched'] += 1
+                if record is None:
+                    record = ItemMasterRecord(item_code=item_code)
+                    db.session.add(record)
+                    existing[item_code] = record
+                    if counted:
+                        stats['created'] += 1
+                elif counted:
+                    stats['updated'] += 1
+
+                record.item_name = item.get('ItemName')
+                record.unit_of_measure = item.get('InventoryUOM')
+                record.is_serial_managed = item.get('ManageSerialNumbers') in ('tYES', 'Y')
+                record.is_batch_managed = item.get('ManageBatchNumbers') in ('tYES', 'Y')
+                record.item_type = item.get('ItemType')
+                record.is_active = item.get('Valid', 'tYES') in ('tYES', 'Y')
+                if item.get('UpdateDate'):
+                    record.sap_update_date = datetime.strptime(item['UpdateDate'][:10], '%Y-%m-%d').date()
+                record.synced_at = now
+
+            stock_by_whs = {stock.warehouse_code: stock for stock in record.warehouse_stock}
+            for whs in item.get('ItemWarehouseInfoCollection') or []:
+                warehouse_code = whs.get('WarehouseCode')
+                if not warehouse_code:
+                    continue
+                stock = stock_by_whs.get(warehouse_code)
+                if stock is None:
+                    stock = ItemWarehouseStock(warehouse_code=warehouse_code)
+                    record.warehouse_stock.append(stock)
+                stock.on_hand = float(whs.get('InStock') or 0.0)
+                stock.synced_at = now
+
     def sync_all_master_data(self):
         """Sync all master data from SAP B1"""
         logging.info("Starting full SAP B1 master data synchronization...")
@@ -2355,6 +2568,89 @@ class SAPIntegration:
             }
         }
 
+    # Fields the SO Against Invoice flow reads. DocumentLines is a collection property of
+    # Orders, not a navigation property, so it is selected rather than $expand-ed.
+    SALES_ORDER_SELECT = ('DocEntry,DocNum,Series,DocumentStatus,CardCode,CardName,Address,'
+                          'UserSign,BPL_IDAssignedToInvoice,DocumentLines')
+    SALES_ORDER_TIMEOUT = (5, 15)  # (connect, read) seconds
+
+    # Shared across instances: DocEntry -> order for the resolve/fetch/sync steps of one
+    # SO, and (Series, DocNum) -> DocEntry, which never changes once the order exists
+    _sales_orders = TTLCache(ttl=60, maxsize=512)
+    _sales_order_doc_entries = TTLCache(ttl=3600, maxsize=4096)
+
+    def _fetch_sales_orders(self, url, params):
+        """GET Orders and return (orders, error); error is None on success"""
+        if not self.ensure_logged_in():
+            return None, 'SAP B1 not available'
+        try:
+            response = self.session.get(url, params=params, timeout=self.SALES_ORDER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"⚠️ Sales Order lookup failed: {str(e)}")
+            return None, str(e)
+        if response.status_code == 404:
+            return [], None
+        if response.status_code != 200:
+            logging.error(f"❌ Error fetching Sales Order: {response.status_code} - {response.text[:200]}")
+            return None, f'HTTP {response.status_code}'
+        data = response.json()
+        return data.get('value', [data] if 'DocEntry' in data else []), None
+
+    def _remember_sales_order(self, order):
+        self._sales_orders.set(order.get('DocEntry'), order)
+        self._sales_order_doc_entries.set((str(order.get('Series')), str(order.get('DocNum'))),
+                                          order.get('DocEntry'))
+
+    def resolve_sales_order(self, series, doc_num):
+        """
+        Resolve (Series, DocNum) to the Sales Order header and lines with one Orders query.
+        Returns {'success': True, 'order': ...} or {'success': False, 'error': ...} with
+        'not_found' or 'offline' set when the order does not exist or SAP is unreachable.
+        """
+        try:
+            series, doc_num = int(series), int(doc_num)
+        except (TypeError, ValueError):
+            return {'success': False, 'not_found': True,
+                    'error': f'SO Number {doc_num} not found in Series {series}'}
+
+        doc_entry = self._sales_order_doc_entries.get((str(series), str(doc_num)))
+        if doc_entry is not None:
+            order = self._sales_orders.get(doc_entry)
+            if order is not None:
+                return {'success': True, 'order': order}
+
+        orders, error = self._fetch_sales_orders(f"{self.base_url}/b1s/v1/Orders", {
+            '$filter': f"Series eq {series} and DocNum eq {doc_num}",
+            '$select': self.SALES_ORDER_SELECT,
+        })
+        if error:
+            return {'success': False, 'offline': True, 'error': error}
+        if not orders:
+            return {'success': False, 'not_found': True,
+                    'error': f'SO Number {doc_num} not found in Series {series}'}
+        self._remember_sales_order(orders[0])
+        logging.info(f"✅ Resolved SO {series}/{doc_num} to DocEntry {orders[0].get('DocEntry')}")
+        return {'success': True, 'order': orders[0]}
+
+    def get_sales_order(self, doc_entry, use_cache=True):
+        """
+        Sales Order header and lines by DocEntry, served from the resolve cache when fresh.
+        Returns the same shape as resolve_sales_order.
+        """
+        if use_cache:
+            order = self._sales_orders.get(int(doc_entry))
+            if order is not None:
+                return {'success': True, 'order': order}
+
+        orders, error = self._fetch_sales_orders(f"{self.base_url}/b1s/v1/Orders({int(doc_entry)})",
+                                                 {'$select': self.SALES_ORDER_SELECT})
+        if error:
+            return {'success': False, 'offline': True, 'error': error}
+        if not orders:
+            return {'success': False, 'not_found': True, 'error': f'SO with DocEntry {doc_entry} not found'}
+        self._remember_sales_order(orders[0])
+        return {'success': True, 'order': orders[0]}
+
     def sync_sales_order_to_local_db(self, order_data):
         """Sync Sales Order data to local database"""
         try:
@@ -2683,8 +2979,95 @@ class SAPIntegration:
         return results
     #Batch wise transfer
 
-    def create_serial_number_stock_transferss(self, serial_transfer_document, chunk_size=5000):
-        """Create Stock Transfer in SAP B1 for Serial Number Transfer using batch split"""
+    def _iter_batch_body(self, boundary, requests_iter, changeset_boundary=None):
+        """Stream a multipart/mixed $batch body one request part at a time
+
+        Args:
+            boundary: Outer batch boundary
+            requests_iter: Iterable of (method, path, payload_dict) tuples, consumed lazily
+            changeset_boundary: When given, all requests are wrapped in one changeset
+                so SAP B1 applies them atomically
+        """
+        if changeset_boundary:
+            yield (f"--{boundary}\r\n"
+                   f"Content-Type: multipart/mixed; boundary={changeset_boundary}\r\n\r\n").encode("utf-8")
+            part_boundary = changeset_boundary
+        else:
+            part_boundary = boundary
+
+        for content_id, (method, path, payload) in enumerate(requests_iter, start=1):
+            yield (f"--{part_boundary}\r\n"
+                   "Content-Type: application/http\r\n"
+                   "Content-Transfer-Encoding: binary\r\n"
+                   f"Content-ID: {content_id}\r\n\r\n"
+                   f"{method} {path} HTTP/1.1\r\n"
+                   "Content-Type: application/json\r\n\r\n").encode("utf-8")
+            yield json.dumps(payload, separators=(',', ':')).encode("utf-8")
+            yield b"\r\n"
+
+        if changeset_boundary:
+            yield f"--{changeset_boundary}--\r\n".encode("utf-8")
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    def _parse_batch_response(self, body, content_type):
+        """Parse a multipart $batch response into a list of per-request results
+
+        Each result is a dict with 'status', 'data' (parsed JSON body or None)
+        and 'error' (SAP error message or None). Changesets are flattened.
+        """
+        boundary = None
+        for param in content_type.split(';'):
+            param = param.strip()
+            if param.lower().startswith('boundary='):
+                boundary = param.split('=', 1)[1].strip('"')
+        if not boundary:
+            return []
+
+        results = []
+        body = body.replace('\r\n', '\n')
+        for part in body.split(f"--{boundary}")[1:]:
+            if part.startswith('--'):
+                break
+            part_headers, _, part_body = part.strip('\n').partition('\n\n')
+            nested_type = next((line.split(':', 1)[1].strip() for line in part_headers.split('\n')
+                                if line.lower().startswith('content-type:')), '')
+            if nested_type.lower().startswith('multipart/mixed'):
+                results.extend(self._parse_batch_response(part_body, nested_type))
+                continue
+
+            # Embedded HTTP response: status line, headers, blank line, JSON body
+            http_head, _, http_body = part_body.partition('\n\n')
+            status_line = http_head.split('\n', 1)[0]
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                status = 0
+
+            data = None
+            if http_body.strip():
+                try:
+                    data = json.loads(http_body.strip())
+                except ValueError:
+                    data = None
+
+            error = None
+            if status >= 400:
+                message = (data or {}).get('error', {}).get('message') if isinstance(data, dict) else None
+                if isinstance(message, dict):
+                    message = message.get('value')
+                error = message or http_body.strip() or status_line
+            results.append({'status': status, 'data': data, 'error': error})
+        return results
+
+    def create_serial_number_stock_transferss(self, serial_transfer_document, chunk_size=5000,
+                                              use_changeset=True, timeout=(10, 600)):
+        """Create Stock Transfers in SAP B1 for a Serial Number Transfer via a streamed $batch
+
+        Lines are split into documents of at most ``chunk_size`` lines. The request
+        body is generated lazily so only one document is serialized at a time, and
+        with ``use_changeset`` all documents are posted atomically. Returns the
+        DocEntry/DocNum of every created document.
+        """
         if not self.ensure_logged_in():
             logging.warning("SAP B1 not available, simulating serial transfer creation")
             import random
@@ -2696,112 +3079,122 @@ class SAPIntegration:
 
         try:
             # --------------------------------------------------------
-            # STEP 1: Build StockTransferLines with Serial Numbers
+            # STEP 1: Resolve SystemNumbers up front (concurrently) so the
+            # body can be streamed without stalling on per-serial lookups
             # --------------------------------------------------------
-            all_lines = []
-
+            line_items = []
             for index, item in enumerate(serial_transfer_document.items):
-                serial_numbers = []
-                for serial in item.serial_numbers:
-                    if serial.is_validated:  # Only include validated serials
-                        system_number = self.get_system_number_from_sap_get(serial.serial_number)
-                        serial_info = {
-                            "SystemSerialNumber": system_number,
-                            "InternalSerialNumber": serial.serial_number,
-                            "ManufacturerSerialNumber": serial.serial_number,
-                            "ExpiryDate":  None,
-                            "ManufactureDate":  None,
-                            "ReceptionDate": serial.admission_date.isoformat() + "Z" if serial.admission_date else None,
-                            "WarrantyStart": None,
-                            "WarrantyEnd": None,
-                            "Location": None,
-                            "Notes": None
-                        }
-                        serial_numbers.append(serial_info)
+                validated = [serial for serial in item.serial_numbers if serial.is_validated]
+                if validated:
+                    line_items.append((index, item, validated))
 
-                if serial_numbers:
-                    line = {
-                        "LineNum": index,
-                        "ItemCode": item.item_code,
-                        "Quantity": len(serial_numbers),
-                        "WarehouseCode": item.to_warehouse_code,
-                        "FromWarehouseCode": item.from_warehouse_code,
-                        "UoMCode": item.unit_of_measure or "",
-                        "SerialNumbers": serial_numbers
-                    }
-                    all_lines.append(line)
+            if not line_items:
+                return {'success': False, 'error': 'No validated serial numbers to transfer'}
 
-            # --------------------------------------------------------
-            # STEP 2: Split into chunks (batch-wise)
-            # --------------------------------------------------------
-            def chunk_list(lst, size):
-                for i in range(0, len(lst), size):
-                    yield lst[i:i + size]
-
-            chunks = list(chunk_list(all_lines, chunk_size))
-            boundary = "batch_" + "123456"
-            batch_parts = []
-
-            for idx, lines_chunk in enumerate(chunks, start=1):
-                transfer_data = {
-                    "DocDate": serial_transfer_document.created_at.strftime('%Y-%m-%d'),
-                    "DueDate": serial_transfer_document.created_at.strftime('%Y-%m-%d'),
-                    "CardCode": "",
-                    "CardName": "",
-                    "Address": "",
-                    "U_EA_CREATEDBy": serial_transfer_document.user.username,
-                    "U_EA_Approved": (
-                        serial_transfer_document.qc_approver.username
-                        if serial_transfer_document.qc_approver
-                        else serial_transfer_document.user.username
-                    ),
-                    "Comments": f"Serial Number Transfer {serial_transfer_document.transfer_number} "
-                                f"(Part {idx}/{len(chunks)}) - "
-                                f"{serial_transfer_document.user.username if serial_transfer_document.user else 'System'}",
-                    "JournalMemo": f"Serial Number Transfer - {serial_transfer_document.transfer_number} (Part {idx})",
-                    "PriceList": -1,
-                    "SalesPersonCode": -1,
-                    "FromWarehouse": serial_transfer_document.from_warehouse,
-                    "ToWarehouse": serial_transfer_document.to_warehouse,
-                    "AuthorizationStatus": "sasWithout",
-                    "StockTransferLines": lines_chunk
-                }
+            client = AsyncSAPClient(self)
+            system_numbers = client.run(client.get_system_numbers(
+                serial.serial_number for _, _, validated in line_items for serial in validated))
 
-                import json
-                part = (
-                    f"--{boundary}\n"
-                    "Content-Type: application/http\n"
-                    "Content-Transfer-Encoding: binary\n\n"
-                    "POST /b1s/v1/StockTransfers HTTP/1.1\n"
-                    "Content-Type: application/json\n\n"
-                    f"{json.dumps(transfer_data)}\n"
-                )
-                batch_parts.append(part)
+            def build_line(index, item, validated):
+                return {
+                    "LineNum": index,
+                    "ItemCode": item.item_code,
+                    "Quantity": len(validated),
+                    "WarehouseCode": item.to_warehouse_code,
+                    "FromWarehouseCode": item.from_warehouse_code,
+                    "UoMCode": item.unit_of_measure or "",
+                    "SerialNumbers": [{
+                        "SystemSerialNumber": system_numbers.get(serial.serial_number, 0),
+                        "InternalSerialNumber": serial.serial_number,
+                        "ManufacturerSerialNumber": serial.serial_number,
+                        "ExpiryDate": None,
+                        "ManufactureDate": None,
+                        "ReceptionDate": serial.admission_date.isoformat() + "Z" if serial.admission_date else None,
+                        "WarrantyStart": None,
+                        "WarrantyEnd": None,
+                        "Location": None,
+                        "Notes": None
+                    } for serial in validated]
+                }
 
-            batch_parts.append(f"--{boundary}--")
-            batch_body = "\n".join(batch_parts)
+            # --------------------------------------------------------
+            # STEP 2: Lazily build one StockTransfer per chunk of lines
+            # --------------------------------------------------------
+            total_docs = (len(line_items) + chunk_size - 1) // chunk_size
+            doc_date = serial_transfer_document.created_at.strftime('%Y-%m-%d')
+            created_by = serial_transfer_document.user.username if serial_transfer_document.user else 'System'
+            approved_by = (serial_transfer_document.qc_approver.username
+                           if serial_transfer_document.qc_approver else created_by)
+
+            def iter_documents():
+                for idx, start in enumerate(range(0, len(line_items), chunk_size), start=1):
+                    yield ("POST", "/b1s/v1/StockTransfers", {
+                        "DocDate": doc_date,
+                        "DueDate": doc_date,
+                        "CardCode": "",
+                        "CardName": "",
+                        "Address": "",
+                        "U_EA_CREATEDBy": created_by,
+                        "U_EA_Approved": approved_by,
+                        "Comments": f"Serial Number Transfer {serial_transfer_document.transfer_number} "
+                                    f"(Part {idx}/{total_docs}) - {created_by}",
+                        "JournalMemo": f"Serial Number Transfer - {serial_transfer_document.transfer_number} (Part {idx})",
+                        "PriceList": -1,
+                        "SalesPersonCode": -1,
+                        "FromWarehouse": serial_transfer_document.from_warehouse,
+                        "ToWarehouse": serial_transfer_document.to_warehouse,
+                        "AuthorizationStatus": "sasWithout",
+                        "StockTransferLines": [build_line(*entry) for entry in line_items[start:start + chunk_size]]
+                    })
 
             # --------------------------------------------------------
-            # STEP 3: Submit $batch request
+            # STEP 3: Submit streamed $batch request
             # --------------------------------------------------------
+            boundary = f"batch_{uuid.uuid4().hex}"
+            changeset_boundary = f"changeset_{uuid.uuid4().hex}" if use_changeset else None
             url = f"{self.base_url}/b1s/v1/$batch"
             headers = {
                 "Content-Type": f"multipart/mixed; boundary={boundary}"
             }
 
-            response = self.session.post(url, data=batch_body.encode("utf-8"), headers=headers)
+            logging.info(f"Posting {total_docs} Stock Transfer document(s) for "
+                         f"{serial_transfer_document.transfer_number} via $batch")
+            response = self.session.post(url,
+                                         data=self._iter_batch_body(boundary, iter_documents(), changeset_boundary),
+                                         headers=headers,
+                                         timeout=timeout)
 
-            if response.status_code in (200, 202):
-                logging.info("Batch stock transfer request successful")
-                return {
-                    'success': True,
-                    'message': f"Created {len(chunks)} Stock Transfer documents via batch"
-                }
-            else:
+            if response.status_code not in (200, 202):
                 error_msg = f"SAP B1 error in batch Stock Transfer: {response.text}"
                 logging.error(error_msg)
                 return {'success': False, 'error': error_msg}
 
+            # --------------------------------------------------------
+            # STEP 4: Per-document results
+            # --------------------------------------------------------
+            parts = self._parse_batch_response(response.text, response.headers.get('Content-Type', ''))
+            documents = [{
+                'status': part['status'],
+                'doc_entry': (part['data'] or {}).get('DocEntry'),
+                'doc_num': (part['data'] or {}).get('DocNum'),
+                'error': part['error']
+            } for part in parts]
+            errors = [doc['error'] for doc in documents if doc['error']]
+
+            if errors or len(documents) < total_docs:
+                error_msg = f"SAP B1 error in batch Stock Transfer: {'; '.join(errors) or 'incomplete batch response'}"
+                logging.error(error_msg)
+                return {'success': False, 'error': error_msg, 'documents': documents}
+
+            doc_nums = [str(doc['doc_num']) for doc in documents if doc['doc_num'] is not None]
+            logging.info(f"Batch stock transfer request successful: DocNum(s) {', '.join(doc_nums)}")
+            return {
+                'success': True,
+                'document_number': ', '.join(doc_nums),
+                'documents': documents,
+                'message': f"Created {len(documents)} Stock Transfer documents via batch"
+            }
+
         except Exception as e:
             error_msg = f"Error creating Serial Number Stock Transfer in SAP B1: {str(e)}"
             logging.error(error_msg)
@@ -2827,6 +3220,12 @@ class SAPIntegration:
             # Build stock transfer document for serial numbers
             stock_transfer_lines = []
 
+            # Resolve all SystemNumbers concurrently instead of one blocking lookup per serial
+            client = AsyncSAPClient(self)
+            system_numbers = client.run(client.get_system_numbers(
+                serial.serial_number for item in serial_transfer_document.items
+                for serial in item.serial_numbers if serial.is_validated))
+
             for index, item in enumerate(serial_transfer_document.items):
                 # Create transfer line with serial numbers
                 line = {
@@ -2843,9 +3242,8 @@ class SAPIntegration:
 
                 for serial in item.serial_numbers:
                     if serial.is_validated:  # Only include validated serials
-                        system_number = self.get_system_number_from_sap_get(serial.serial_number)
                         serial_info = {
-                            "SystemSerialNumber": system_number,
+                            "SystemSerialNumber": system_numbers.get(serial.serial_number, 0),
                             "InternalSerialNumber": serial.serial_number,
                             "ManufacturerSerialNumber": serial.serial_number,
                             "ExpiryDate":  None,
@@ -3077,12 +3475,13 @@ class SAPIntegration:
                 # Check if we have results
                 values = data.get('value', [])
                 if values:
+                    # Get enhanced item metadata from Items master data in chunked, cached lookups
+                    metadata_by_code = self._get_items_metadata([item.get('ItemCode', '') for item in values])
+
                     items = []
                     for item in values:
                         item_code = item.get('ItemCode', '')
-                        
-                        # Get enhanced item metadata from Items master data
-                        item_metadata = self._get_item_metadata(item_code)
+                        item_metadata = metadata_by_code.get(item_code) or self._get_default_item_metadata()
                         
                         item_data = {
                             'item_code': item_code,
@@ -3153,28 +3552,54 @@ class SAPIntegration:
         # Fallback to item code if description not found
         return f'Item {item_code}'
 
+    ITEM_METADATA_CHUNK_SIZE = 40  # ItemCodes per Items $filter (keeps URLs well under SL limits)
+    _item_metadata_cache = TTLCache(ttl=1800, maxsize=20000)  # ItemCode -> metadata, shared across instances
+
     def _get_item_metadata(self, item_code):
         """
         Get enhanced item metadata from SAP B1 Items master data
         Includes serial management, batch management, and other critical metadata
         """
-        try:
-            if not item_code:
-                return self._get_default_item_metadata()
+        if not item_code:
+            return self._get_default_item_metadata()
+        return self._get_items_metadata([item_code]).get(item_code) or self._get_default_item_metadata()
 
-            # Get comprehensive item metadata from Items master data
-            url = f"{self.base_url}/b1s/v1/Items?$filter=ItemCode eq '{item_code}'&$select=ItemCode,ItemName,InventoryUOM,ManageSerialNumbers,ManageBatchNumbers,ItemType,StandardPrice"
-            response = self.session.get(url, timeout=10)
+    def _get_items_metadata(self, item_codes):
+        """
+        Get item metadata for many items at once.
+        Serves cached entries and fetches the rest with chunked
+        "ItemCode eq 'A' or ItemCode eq 'B' ..." filters, fanned out concurrently.
 
-            if response.status_code == 200:
-                data = response.json()
-                items = data.get('value', [])
-                if items and len(items) > 0:
-                    item = items[0]
+        Returns:
+            Dict of ItemCode -> metadata (items SAP did not return are omitted)
+        """
+        results = {}
+        missing = []
+        for item_code in dict.fromkeys(code for code in item_codes if code):
+            cached = self._item_metadata_cache.get(item_code)
+            if cached is not None:
+                results[item_code] = cached
+            else:
+                missing.append(item_code)
+
+        if not missing:
+            return results
+
+        chunks = [missing[i:i + self.ITEM_METADATA_CHUNK_SIZE]
+                  for i in range(0, len(missing), self.ITEM_METADATA_CHUNK_SIZE)]
+        logging.info(f"Fetching metadata for {len(missing)} items in {len(chunks)} SAP call(s) "
+                     f"({len(results)} served from cache)")
+
+        with ThreadPoolExecutor(max_workers=min(4, len(chunks))) as pool:
+            # One context copy per chunk (a context cannot be entered by two threads at once)
+            contexts = [contextvars.copy_context() for _ in chunks]
+            for chunk_items in pool.map(lambda context, chunk: context.run(self._fetch_items_metadata_chunk, chunk),
+                                        contexts, chunks):
+                for item in chunk_items:
+                    item_code = item.get('ItemCode')
                     manage_serial = item.get('ManageSerialNumbers', 'N')
                     manage_batch = item.get('ManageBatchNumbers', 'N')
-                    
-                    return {
+                    metadata = {
                         'item_name': item.get('ItemName', f'Item {item_code}'),
                         'unit_of_measure': item.get('InventoryUOM', ''),
                         'is_serial_managed': manage_serial == 'Y',
@@ -3182,14 +3607,28 @@ class SAPIntegration:
                         'manage_serial_numbers': manage_serial,
                         'manage_batch_numbers': manage_batch,
                         'item_type': item.get('ItemType', 'itItems'),
-                        'standard_price': float(item.get('StandardPrice', 0.0))
+                        'standard_price': float(item.get('StandardPrice') or 0.0)
                     }
+                    self._item_metadata_cache.set(item_code, metadata)
+                    results[item_code] = metadata
 
-        except Exception as e:
-            logging.warning(f"⚠️ Could not fetch item metadata for {item_code}: {str(e)}")
+        return results
+
+    def _fetch_items_metadata_chunk(self, item_codes):
+        """Fetch Items master rows for one chunk of item codes, [] on failure"""
+        try:
+            item_filter = ' or '.join("ItemCode eq '{}'".format(code.replace("'", "''")) for code in item_codes)
+            url = (f"{self.base_url}/b1s/v1/Items?$filter={item_filter}"
+                   f"&$select=ItemCode,ItemName,InventoryUOM,ManageSerialNumbers,ManageBatchNumbers,ItemType,StandardPrice")
+            headers = {'Prefer': 'odata.maxpagesize=0'}
+            response = self.session.get(url, headers=headers, timeout=30)
 
-        # Return default metadata if API call fails
-        return self._get_default_item_metadata()
+            if response.status_code == 200:
+                return response.json().get('value', [])
+            logging.warning(f"⚠️ Could not fetch item metadata chunk: {response.status_code}")
+        except Exception as e:
+            logging.warning(f"⚠️ Could not fetch item metadata for {len(item_codes)} items: {str(e)}")
+        return []
 
     def _get_default_item_metadata(self):
         """Get default item metadata when SAP API is unavailable"""
@@ -3399,6 +3838,39 @@ class SAPIntegration:
                 'error': str(e)
             }
 
+    def get_sales_order_line_stock(self, doc_entry):
+        """
+        Warehouse stock for every line of a Sales Order with one SQLQueries('SO_Line_Stock') call.
+        Returns LineNum -> {'item_code', 'warehouse_code', 'open_qty', 'on_hand', 'man_ser_num',
+        'man_btch_num'}, or None when SAP is unavailable or the query failed.
+        """
+        if not self.ensure_logged_in():
+            return None
+
+        url = f"{self.base_url}/b1s/v1/SQLQueries('SO_Line_Stock')/List"
+        try:
+            response = self.session.post(url, json={"ParamList": f"docEntry='{int(doc_entry)}'"},
+                                         headers={'Prefer': 'odata.maxpagesize=0'}, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error calling SAP B1 SO_Line_Stock: {str(e)}")
+            return None
+        if response.status_code != 200:
+            logging.error(f"SAP B1 SO_Line_Stock failed: {response.status_code} - {response.text[:200]}")
+            return None
+
+        lines = {}
+        for row in response.json().get('value', []):
+            lines[row.get('LineNum')] = {
+                'item_code': row.get('ItemCode'),
+                'warehouse_code': row.get('WhsCode'),
+                'open_qty': float(row.get('OpenQty') or 0),
+                'on_hand': float(row.get('OnHand') or 0),
+                'man_ser_num': row.get('ManSerNum'),
+                'man_btch_num': row.get('ManBtchNum'),
+            }
+        logging.info(f"SO_Line_Stock: {len(lines)} lines for Sales Order DocEntry {doc_entry}")
+        return lines
+
     def logout(self):
         """Logout from SAP B1"""
         if self.session_id:
@@ -0,0 +1,252 @@
+"""
+Per-endpoint metrics for SAP B1 Service Layer calls.
+
+InstrumentedAdapter is mounted on every SAP requests session (through
+sap_circuit.prepare_session) and records, per normalised endpoint (and SQLQuery
+name), call counts, a latency histogram, request/response sizes, HTTP status and
+retries. Metrics live per worker process and are exposed in Prometheus text
+format at /metrics and as a summary on /admin/sap-metrics.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+
+from requests.adapters import HTTPAdapter
+
+# Histogram bucket upper bounds in seconds (+Inf is implicit)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Failed calls remembered per session so an identical follow-up call counts as a retry
+RETRY_WINDOW_SECONDS = 120
+
+_SERVICE_PREFIX = re.compile(r'^.*?/b1s/v\d+/')
+_SQL_QUERY = re.compile(r"^SQLQueries\('([^']*)'\)")
+_ENTITY_KEY = re.compile(r"\((?:'[^']*'|[^)]*)\)")
+
+_lock = threading.Lock()
+_series = {}
+_started_at = time.time()
+_listeners = []
+
+
+def normalize_endpoint(path):
+    """
+    Return (endpoint, query_name) for a Service Layer path.
+    Entity keys are collapsed so e.g. Orders(123) and Orders(456) share one series;
+    SQLQueries('Series_Validation')/List keeps the query name as a separate label.
+    """
+    path = _SERVICE_PREFIX.sub('', path.split('?', 1)[0])
+    match = _SQL_QUERY.match(path)
+    if match:
+        return 'SQLQueries({name})' + _ENTITY_KEY.sub('({key})', path[match.end():]), match.group(1)
+    return _ENTITY_KEY.sub('({key})', path) or '/', ''
+
+
+class _Series:
+    __slots__ = ('calls', 'errors', 'retries', 'duration_sum', 'duration_max', 'buckets',
+                 'request_bytes', 'response_bytes', 'statuses', 'routes')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.duration_sum = 0.0
+        self.duration_max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.statuses = Counter()
+        self.routes = Counter()
+
+
+def _current_route():
+    """Flask endpoint that triggered the SAP call, if any"""
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            return request.endpoint or request.path
+    except Exception:
+        pass
+    return 'background'
+
+
+def add_call_listener(callback):
+    """Call callback(method, endpoint, query_name, status, duration) after every recorded call"""
+    _listeners.append(callback)
+
+
+def record_call(method, endpoint, query_name, status, duration, request_bytes=0, response_bytes=0,
+                retry=False, route=None):
+    """
+    Record one Service Layer call; status is the HTTP status code, 'error' for transport
+    failures or 'circuit_open' for calls the circuit breaker refused
+    """
+    for callback in _listeners:
+        callback(method, endpoint, query_name, status, duration)
+    key = (method, endpoint, query_name)
+    with _lock:
+        series = _series.get(key)
+        if series is None:
+            series = _series[key] = _Series()
+        series.calls += 1
+        series.duration_sum += duration
+        series.duration_max = max(series.duration_max, duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                series.buckets[i] += 1
+                break
+        series.request_bytes += request_bytes
+        series.response_bytes += response_bytes
+        series.statuses[str(status)] += 1
+        series.routes[route or _current_route()] += 1
+        if not isinstance(status, int) or status >= 400:
+            series.errors += 1
+        if retry:
+            series.retries += 1
+
+
+def reset():
+    with _lock:
+        _series.clear()
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter that times each call (including the response body) and records it in the registry"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._failed = {}
+
+    def _call_key(self, request):
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not isinstance(body, bytes):
+            # Streamed bodies (e.g. $batch generators) cannot be compared without consuming them
+            return None
+        return request.method, request.url, hashlib.sha1(body).hexdigest()
+
+    def _is_retry(self, call_key, now):
+        failed_at = self._failed.pop(call_key, None)
+        return failed_at is not None and now - failed_at <= RETRY_WINDOW_SECONDS
+
+    def send(self, request, stream=False, **kwargs):
+        endpoint, query_name = normalize_endpoint(request.path_url)
+        call_key = self._call_key(request)
+        body = request.body
+        request_bytes = len(body) if isinstance(body, (bytes, str)) else 0
+
+        started = time.perf_counter()
+        retry = self._is_retry(call_key, time.monotonic())
+        # urllib3-level retries (when max_retries is configured) happen inside send()
+        try:
+            response = super().send(request, stream=stream, **kwargs)
+            # Read the body here so latency covers the full transfer, as callers see it
+            response_bytes = len(response.content) if not stream else int(response.headers.get('Content-Length') or 0)
+        except Exception:
+            if call_key is not None:
+                self._failed[call_key] = time.monotonic()
+            record_call(request.method, endpoint, query_name, 'error', time.perf_counter() - started,
+                        request_bytes, 0, retry)
+            raise
+
+        history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        if call_key is not None and (response.status_code >= 500 or response.status_code == 401):
+            self._failed[call_key] = time.monotonic()
+        record_call(request.method, endpoint, query_name, response.status_code, time.perf_counter() - started,
+                    request_bytes, response_bytes, retry or bool(history))
+        return response
+
+
+def snapshot():
+    """Summary rows for the admin page, slowest endpoints (by total time) first"""
+    rows = []
+    with _lock:
+        for (method, endpoint, query_name), series in _series.items():
+            rows.append({
+                'method': method,
+                'endpoint': endpoint,
+                'query_name': query_name,
+                'calls': series.calls,
+                'errors': series.errors,
+                'retries': series.retries,
+                'total_seconds': series.duration_sum,
+                'avg_ms': series.duration_sum / series.calls * 1000,
+                'p50_ms': _quantile(series, 0.5) * 1000,
+                'p95_ms': _quantile(series, 0.95) * 1000,
+                'max_ms': series.duration_max * 1000,
+                'avg_request_bytes': series.request_bytes / series.calls,
+                'avg_response_bytes': series.response_bytes / series.calls,
+                'statuses': dict(series.statuses),
+                'routes': series.routes.most_common(5),
+            })
+    rows.sort(key=lambda row: row['total_seconds'], reverse=True)
+    return rows
+
+
+def _quantile(series, q):
+    """Histogram quantile estimate (upper bound of the bucket holding the q-th call)"""
+    target = q * series.calls
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, series.buckets):
+        seen += count
+        if seen >= target:
+            return min(bound, series.duration_max)
+    return series.duration_max
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label(value)}"' for name, value in labels.items()) + '}'
+
+
+def render_prometheus():
+    """Prometheus text exposition (format 0.0.4) of all SAP call metrics in this process"""
+    out = [
+        '# HELP sap_calls_total SAP Service Layer calls by endpoint and HTTP status',
+        '# TYPE sap_calls_total counter',
+    ]
+    with _lock:
+        items = sorted(_series.items())
+        for (method, endpoint, query_name), series in items:
+            for status, count in sorted(series.statuses.items()):
+                out.append(f"sap_calls_total{_labels(method=method, endpoint=endpoint, query=query_name, status=status)} {count}")
+
+        out += ['# HELP sap_route_calls_total SAP Service Layer calls by endpoint and the Flask route that made them',
+                '# TYPE sap_route_calls_total counter']
+        for (method, endpoint, query_name), series in items:
+            for route, count in sorted(series.routes.items()):
+                out.append(f"sap_route_calls_total{_labels(method=method, endpoint=endpoint, query=query_name, route=route)} {count}")
+
+        out += ['# HELP sap_call_duration_seconds SAP Service Layer call latency including the response body',
+                '# TYPE sap_call_duration_seconds histogram']
+        for (method, endpoint, query_name), series in items:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series.buckets):
+                cumulative += count
+                out.append(f"sap_call_duration_seconds_bucket"
+                           f"{_labels(method=method, endpoint=endpoint, query=query_name, le=bound)} {cumulative}")
+            labels = _labels(method=method, endpoint=endpoint, query=query_name)
+            out.append(f"sap_call_duration_seconds_bucket"
+                       f"{_labels(method=method, endpoint=endpoint, query=query_name, le='+Inf')} {series.calls}")
+            out.append(f"sap_call_duration_seconds_sum{labels} {series.duration_sum:.6f}")
+            out.append(f"sap_call_duration_seconds_count{labels} {series.calls}")
+
+        for name, attr, help_text in (
+            ('sap_request_bytes_total', 'request_bytes', 'Request body bytes sent to the Service Layer'),
+            ('sap_response_bytes_total', 'response_bytes', 'Response body bytes received from the Service Layer'),
+            ('sap_call_retries_total', 'retries', 'Calls repeating an identical call that failed (5xx, 401 or transport error)'),
+        ):
+            out += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (method, endpoint, query_name), series in items:
+                out.append(f"{name}{_labels(method=method, endpoint=endpoint, query=query_name)} {getattr(series, attr)}")
+
+    out += ['# HELP sap_metrics_start_time_seconds When this worker started collecting SAP metrics',
+            '# TYPE sap_metrics_start_time_seconds gauge',
+            f'sap_metrics_start_time_seconds {_started_at:.0f}']
+    return '\n'.join(out) + '\n'
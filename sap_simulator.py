@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+"""
+SAP B1 Service Layer Simulator
+A local stand-in for /b1s/v1 over a seeded in-memory dataset, for load and
+regression benchmarks without a live SAP B1 server (see sap_benchmark.py).
+
+Implements Login/Logout, SQLQueries('<name>')/List for the queries in
+sap_sql_queries.py, StockTransfers, Invoices, PickLists, Orders, BinLocations, Items,
+Warehouses, SerialNumberDetails, BatchNumberDetails, $crossjoin(Items,
+Items/ItemWarehouseInfoCollection) and $batch (including changesets).
+Every request pays a configurable latency, and a configurable share of
+requests fails with 503.
+
+Usage:
+    python sap_simulator.py                                  # http://127.0.0.1:50000
+    python sap_simulator.py --port 50001 --latency-ms 40 --jitter-ms 20 --error-rate 0.01
+    python sap_simulator.py --serials 50000 --seed 7
+
+Point the WMS at it with SAP_B1_SERVER=http://127.0.0.1:50000 (any user/password/company).
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+
+from flask import Flask, Response, request
+
+SERVICE_ROOT = '/b1s/v1'
+
+# Queries the simulator can answer (see SAPSQLQueryManager.REQUIRED_QUERIES)
+SQL_QUERIES = ('Series_Validation', 'Quantity_Check', 'SO_Line_Stock', 'ItemCode_Validation', 'Item_Validation',
+               'Get_SO_Details', 'Invoise_creation', 'Get_SO_Series', 'Get_Item', 'Checkseries',
+               'GetItemWarehouseSerialStatus_i', 'Item_Stock_Changes')
+
+_CONDITION = re.compile(r"\s*\(?\s*([\w/]+)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|[^\s)]+)\s*\)?\s*(?:(and|or)\b)?",
+                        re.IGNORECASE)
+_PARAM = re.compile(r"(\w+)='((?:[^']|'')*)'")
+_ENTITY_KEY = re.compile(r"^(\w+)\((?:'((?:[^']|'')*)'|(\d+))\)(?:/(\w+))?$")
+
+
+def sap_error(message, status=400, code=-1):
+    return status, {'error': {'code': code, 'message': {'lang': 'en-us', 'value': message}}}
+
+
+def parse_filter(expression):
+    """Parse an OData $filter of comparisons joined by and/or into OR-groups of AND-conditions"""
+    groups = [[]]
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _CONDITION.match(expression, position)
+        if not match:
+            raise ValueError(f"Unsupported $filter near: {expression[position:position + 40]}")
+        field, op, raw, joiner = match.groups()
+        if raw.startswith("'"):
+            value = raw[1:-1].replace("''", "'")
+        else:
+            try:
+                value = float(raw) if '.' in raw else int(raw)
+            except ValueError:
+                value = raw
+        groups[-1].append((field.split('/')[-1], op.lower(), value))
+        if joiner and joiner.lower() == 'or':
+            groups.append([])
+        position = match.end()
+    return [group for group in groups if group]
+
+
+def _compare(actual, op, expected):
+    if op == 'eq':
+        return actual == expected
+    if op == 'ne':
+        return actual != expected
+    if actual is None:
+        return False
+    try:
+        return {'gt': actual > expected, 'ge': actual >= expected,
+                'lt': actual < expected, 'le': actual <= expected}[op]
+    except TypeError:
+        return False
+
+
+def matches(row, groups):
+    return any(all(_compare(row.get(field), op, value) for field, op, value in group) for group in groups)
+
+
+def parse_param_list(param_list):
+    return {name.lower(): value.replace("''", "'") for name, value in _PARAM.findall(param_list or '')}
+
+
+class Dataset:
+    """Seeded master data and transactional documents, shared by all simulator threads"""
+
+    def __init__(self, seed=42, warehouses=5, bins_per_warehouse=20, items=200, serials=20000, pick_lists=50):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.doc_entries = itertools.count(1000)
+
+        self.warehouses = [{
+            'WarehouseCode': f"WH{n:02d}",
+            'WarehouseName': f"Warehouse {n:02d}",
+            'BusinessPlaceID': n,
+            'DefaultBin': n * 1000 + 1,
+            'EnableBinLocations': 'tYES',
+        } for n in range(1, warehouses + 1)]
+
+        self.bins = [{
+            'AbsEntry': w['BusinessPlaceID'] * 1000 + b,
+            'BinCode': f"{w['WarehouseCode']}-A{b:03d}",
+            'Warehouse': w['WarehouseCode'],
+            'Inactive': 'tNO',
+        } for w in self.warehouses for b in range(1, bins_per_warehouse + 1)]
+
+        self.items = []
+        for n in range(1, items + 1):
+            managed = 'tYES' if n % 2 else 'tNO'
+            self.items.append({
+                'ItemCode': f"ITM{n:05d}",
+                'ItemName': f"Simulated item {n:05d}",
+                'InventoryUOM': 'EA',
+                'ManageSerialNumbers': managed,
+                'ManageBatchNumbers': 'tNO',
+                'ItemType': 'itItems',
+                'StandardPrice': round(rng.uniform(5, 500), 2),
+                'QuantityOnStock': 0.0,
+                'UpdateDate': date.today().isoformat(),
+            })
+        self.items_by_code = {item['ItemCode']: item for item in self.items}
+
+        # Serial stock: (item, warehouse) per serial; system numbers are per item, as in OSRN
+        serial_items = [item for item in self.items if item['ManageSerialNumbers'] == 'tYES']
+        self.serials = {}
+        system_numbers = {}
+        for n in range(1, serials + 1):
+            item = serial_items[rng.randrange(len(serial_items))]
+            warehouse = self.warehouses[rng.randrange(len(self.warehouses))]['WarehouseCode']
+            system_numbers[item['ItemCode']] = system_numbers.get(item['ItemCode'], 0) + 1
+            serial = f"SN{seed:02d}{n:07d}"
+            self.serials[serial] = {
+                'ItemCode': item['ItemCode'],
+                'WhsCode': warehouse,
+                'SystemNumber': system_numbers[item['ItemCode']],
+                'Quantity': 1,
+            }
+
+        # Warehouse stock: serial counts for managed items, random quantities otherwise
+        self.stock = {}
+        for serial in self.serials.values():
+            key = (serial['ItemCode'], serial['WhsCode'])
+            self.stock[key] = self.stock.get(key, 0) + 1
+        for item in self.items:
+            if item['ManageSerialNumbers'] == 'tNO':
+                for warehouse in self.warehouses:
+                    if rng.random() < 0.6:
+                        self.stock[(item['ItemCode'], warehouse['WarehouseCode'])] = float(rng.randint(1, 500))
+        for (item_code, _), quantity in self.stock.items():
+            self.items_by_code[item_code]['QuantityOnStock'] += quantity
+        # (ItemCode, WhsCode) -> ISO date of its last stock movement (the OINM CreateDate)
+        self.stock_moved = {}
+
+        self.rng = rng
+        self.pick_lists = []
+        self.orders = []
+        for _ in range(pick_lists):
+            self.add_pick_list(rng.randint(1, 8))
+
+        self.documents = {'StockTransfers': [], 'Invoices': []}
+
+    def add_pick_list(self, line_count):
+        """Append a released pick list of line_count lines and the sales order it picks from"""
+        rng = self.rng
+        n = len(self.pick_lists) + 1
+        order_entry = 5000 + n
+        order_lines = []
+        lines = []
+        for line in range(line_count):
+            item = self.items[rng.randrange(len(self.items))]
+            quantity = float(rng.randint(1, 10))
+            order_lines.append({
+                'LineNum': line,
+                'ItemCode': item['ItemCode'],
+                'ItemDescription': item['ItemName'],
+                'Quantity': quantity,
+                'OpenQuantity': quantity,
+                'DeliveredQuantity': 0.0,
+                'UnitPrice': item['StandardPrice'],
+                'LineTotal': round(quantity * item['StandardPrice'], 2),
+                'WarehouseCode': self.warehouses[rng.randrange(len(self.warehouses))]['WarehouseCode'],
+                'UoMCode': 'EA',
+                'LineStatus': 'bost_Open',
+            })
+            lines.append({
+                'AbsoluteEntry': n,
+                'LineNumber': line,
+                'OrderEntry': order_entry,
+                'OrderRowID': line,
+                'PickStatus': 'ps_Released',
+                'ReleasedQuantity': quantity,
+                'PreviouslyReleasedQuantity': 0.0,
+                'PickedQuantity': 0.0,
+                'BaseObjectType': 17,
+                'DocumentLinesBinAllocations': [],
+            })
+        self.orders.append({
+            'DocEntry': order_entry,
+            'DocNum': order_entry,
+            'Series': 17,
+            'DocType': 'dDocument_Items',
+            'DocDate': (date.today() - timedelta(days=n % 30)).isoformat(),
+            'DocDueDate': date.today().isoformat(),
+            'CardCode': f"C{n % 20:05d}",
+            'CardName': f"Customer {n % 20:02d}",
+            'DocTotal': round(sum(line['LineTotal'] for line in order_lines), 2),
+            'DocCurrency': 'USD',
+            'DocumentStatus': 'bost_Open',
+            'DocumentLines': order_lines,
+        })
+        pick_list = {
+            'Absoluteentry': n,
+            'Name': f"Picker {n % 5}",
+            'OwnerCode': 1,
+            'PickDate': (date.today() - timedelta(days=n % 30)).isoformat(),
+            'Status': 'ps_Released',
+            'ObjectType': '156',
+            'UseBaseUnits': 'tNO',
+            'PickListsLines': lines,
+        }
+        self.pick_lists.append(pick_list)
+        return pick_list
+
+    def move_serial(self, row, to_warehouse):
+        """Move one serial between warehouses (to_warehouse=None issues it), keeping stock in step"""
+        key = (row['ItemCode'], row['WhsCode'])
+        if row['Quantity'] > 0:
+            self.stock[key] = self.stock.get(key, 0) - 1
+            self.stock_moved[key] = date.today().isoformat()
+        if to_warehouse is None:
+            row['Quantity'] = 0
+            return
+        row['WhsCode'] = to_warehouse
+        row['Quantity'] = 1
+        key = (row['ItemCode'], to_warehouse)
+        self.stock[key] = self.stock.get(key, 0) + 1
+        self.stock_moved[key] = date.today().isoformat()
+
+    def warehouse(self, code):
+        return next((w for w in self.warehouses if w['WarehouseCode'] == code), None)
+
+    def serial_rows(self, serial=None, item_code=None, warehouse=None, in_stock=True):
+        """OSRN/OSRQ-style rows for the serial SQL queries"""
+        candidates = [(serial, self.serials.get(serial))] if serial else self.serials.items()
+        rows = []
+        for number, row in candidates:
+            if row is None:
+                continue
+            if item_code and row['ItemCode'] != item_code:
+                continue
+            if warehouse and row['WhsCode'] != warehouse:
+                continue
+            if in_stock and row['Quantity'] <= 0:
+                continue
+            rows.append((number, row))
+        return rows
+
+
+class ServiceLayerSimulator:
+    """Request dispatcher: handle(method, resource, args, headers, body) -> (status, payload, headers)"""
+
+    def __init__(self, dataset, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, write_latency_ms=0.0,
+                 require_session=True, seed=None):
+        self.data = dataset
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.write_latency_ms = write_latency_ms
+        self.require_session = require_session
+        self.sessions = set()
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    # -- plumbing -------------------------------------------------------
+
+    def _delay(self, base_ms):
+        if base_ms or self.jitter_ms:
+            time.sleep(max(0.0, base_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def handle(self, method, resource, args, headers, body, session_id=None, nested=False):
+        if not nested:
+            self.requests += 1
+            self._delay(self.latency_ms)
+
+        if resource == 'Login':
+            return self._login(body)
+        if resource == 'Logout':
+            self.sessions.discard(session_id)
+            return 204, None, {}
+
+        if self.require_session and not nested and session_id not in self.sessions:
+            status, payload = sap_error('Invalid session or session already timeout.', 401, 301)
+            return status, payload, {}
+        if not nested and self.error_rate and self.rng.random() < self.error_rate:
+            status, payload = sap_error('Simulated Service Layer failure', 503)
+            return status, payload, {}
+
+        try:
+            if resource == '$batch':
+                return self._batch(headers.get('Content-Type', ''), body, session_id)
+            if resource.startswith('$crossjoin('):
+                status, payload = self._crossjoin(args)
+            elif resource.startswith('SQLQueries'):
+                status, payload = self._sql_query(method, resource, body)
+            else:
+                status, payload = self._entity(method, resource, args, body)
+        except ValueError as e:
+            status, payload = sap_error(str(e))
+        return status, payload, {}
+
+    def _login(self, body):
+        credentials = json.loads(body or b'{}')
+        if not credentials.get('UserName') or not credentials.get('CompanyDB'):
+            status, payload = sap_error('Fail to get DB Credentials', 401, 100000027)
+            return status, payload, {}
+        session_id = str(uuid.uuid4())
+        self.sessions.add(session_id)
+        return 200, {'SessionId': session_id, 'Version': '1000190', 'SessionTimeout': 30}, {
+            'Set-Cookie': f"B1SESSION={session_id}; path=/b1s; HttpOnly"
+        }
+
+    # -- entity sets ----------------------------------------------------
+
+    def _collection(self, name):
+        return {
+            'Warehouses': self.data.warehouses,
+            'BinLocations': self.data.bins,
+            'Items': self.data.items,
+            'PickLists': self.data.pick_lists,
+            'Orders': self.data.orders,
+            'StockTransfers': self.data.documents['StockTransfers'],
+            'Invoices': self.data.documents['Invoices'],
+            'SerialNumberDetails': self._serial_details(self.data.serials),
+            'BatchNumberDetails': [],
+        }.get(name)
+
+    @staticmethod
+    def _serial_details(serials):
+        return [{
+            'DocEntry': row['SystemNumber'], 'ItemCode': row['ItemCode'], 'SerialNumber': number,
+            'SystemNumber': row['SystemNumber'], 'Status': 0 if row['Quantity'] > 0 else 1,
+        } for number, row in serials.items()]
+
+    @staticmethod
+    def _key_field(name):
+        return {'Items': 'ItemCode', 'Warehouses': 'WarehouseCode', 'BinLocations': 'AbsEntry',
+                'PickLists': 'Absoluteentry'}.get(name, 'DocEntry')
+
+    def _entity(self, method, resource, args, body):
+        key_match = _ENTITY_KEY.match(resource)
+        name = key_match.group(1) if key_match else resource
+        groups = parse_filter(args['$filter']) if args.get('$filter') else None
+        if name == 'SerialNumberDetails' and groups and all(
+                any(field == 'SerialNumber' and op == 'eq' for field, op, _ in group) for group in groups):
+            # Lookups by serial number use the index instead of materialising every serial
+            numbers = {value for group in groups for field, op, value in group if field == 'SerialNumber'}
+            rows = self._serial_details({n: self.data.serials[n] for n in numbers if n in self.data.serials})
+        else:
+            rows = self._collection(name)
+        if rows is None:
+            return sap_error(f"Resource not found for the segment '{name}'", 404)
+
+        if key_match:
+            key = key_match.group(2).replace("''", "'") if key_match.group(2) is not None else int(key_match.group(3))
+            field = self._key_field(name)
+            with self.data.lock:
+                row = next((r for r in rows if r.get(field) == key), None)
+                if row is None:
+                    return sap_error('No matching records found (ODBC -2028)', 404, -2028)
+                if method == 'GET':
+                    return 200, row
+                if method == 'PATCH':
+                    row.update(json.loads(body or b'{}'))
+                    return 204, None
+            return sap_error(f"Method {method} not supported for {name}", 405)
+
+        if method == 'POST':
+            if name not in self.data.documents:
+                return sap_error(f"Method POST not supported for {name}", 405)
+            return self._create_document(name, json.loads(body or b'{}'))
+        if method != 'GET':
+            return sap_error(f"Method {method} not supported for {name}", 405)
+
+        with self.data.lock:
+            result = list(rows)
+        if groups:
+            result = [row for row in result if matches(row, groups)]
+        skip = int(args.get('$skip', 0))
+        top = args.get('$top')
+        result = result[skip:skip + int(top)] if top else result[skip:]
+        if args.get('$select'):
+            fields = [field.strip() for field in args['$select'].split(',')]
+            result = [{field: row.get(field) for field in fields} for row in result]
+        return 200, {'odata.metadata': f"$metadata#{name}", 'value': result}
+
+    def _create_document(self, name, payload):
+        self._delay(self.write_latency_ms)
+        lines = payload.get('StockTransferLines') or payload.get('DocumentLines') or []
+        with self.data.lock:
+            # Validate every serial before moving any, so a failed document changes nothing
+            moves = []
+            for line in lines:
+                source = line.get('FromWarehouseCode') or payload.get('FromWarehouse') or line.get('WarehouseCode')
+                for serial in line.get('SerialNumbers') or []:
+                    number = serial.get('InternalSerialNumber')
+                    row = self.data.serials.get(number)
+                    if row is None or row['ItemCode'] != line.get('ItemCode') or row['Quantity'] <= 0 \
+                            or (source and row['WhsCode'] != source):
+                        return sap_error(f"1470000341 - Fully processed serial number \"{number}\" "
+                                         f"cannot be selected for item {line.get('ItemCode')}", 400, -5002)
+                    moves.append((row, line))
+
+            for row, line in moves:
+                self.data.move_serial(row, (line.get('WarehouseCode') or payload.get('ToWarehouse'))
+                                      if name == 'StockTransfers' else None)
+
+            doc_entry = next(self.data.doc_entries)
+            document = dict(payload, DocEntry=doc_entry, DocNum=doc_entry, DocumentStatus='bost_Open')
+            self.data.documents[name].append(document)
+        return 201, document
+
+    # -- $crossjoin -----------------------------------------------------
+
+    def _crossjoin(self, args):
+        warehouse = None
+        for group in parse_filter(args.get('$filter', '')):
+            for field, op, value in group:
+                if field == 'WarehouseCode' and op == 'eq':
+                    warehouse = value
+        if warehouse is None:
+            return sap_error('Only Items/ItemWarehouseInfoCollection crossjoins filtered by WarehouseCode are simulated')
+        rows = []
+        with self.data.lock:
+            for (item_code, whs_code), quantity in sorted(self.data.stock.items()):
+                if whs_code != warehouse:
+                    continue
+                item = self.data.items_by_code[item_code]
+                rows.append({
+                    'Items': {'ItemCode': item_code, 'ItemName': item['ItemName'],
+                              'QuantityOnStock': item['QuantityOnStock']},
+                    'Items/ItemWarehouseInfoCollection': {'InStock': quantity, 'Ordered': 0.0,
+                                                          'StandardAveragePrice': item['StandardPrice']},
+                })
+        return 200, {'odata.metadata': '$metadata#Collection(Edm.ComplexType)', 'value': rows}
+
+    # -- SQL queries ----------------------------------------------------
+
+    def _sql_query(self, method, resource, body):
+        match = re.match(r"^SQLQueries(?:\('((?:[^']|'')*)'\))?(/List)?$", resource)
+        if not match:
+            return sap_error(f"Resource not found for the segment '{resource}'", 404)
+        name, is_list = match.group(1), match.group(2)
+        if name is None:
+            # POST SQLQueries creates a query definition
+            return (201, json.loads(body or b'{}')) if method == 'POST' else (200, {'value': [
+                {'SqlCode': code, 'SqlName': code} for code in SQL_QUERIES]})
+        if name not in SQL_QUERIES:
+            return sap_error('No matching records found (ODBC -2028)', 404, -2028)
+        if not is_list:
+            return 200, {'SqlCode': name, 'SqlName': name}
+
+        params = parse_param_list(json.loads(body or b'{}').get('ParamList', ''))
+        with self.data.lock:
+            return 200, {'SqlText': f"simulated {name}", 'value': self._run_query(name, params)}
+
+    def _run_query(self, name, p):
+        data = self.data
+        if name in ('Series_Validation', 'Checkseries', 'GetItemWarehouseSerialStatus_i'):
+            serial = p.get('series') or p.get('serials') or p.get('serialnumber')
+            rows = data.serial_rows(serial, p.get('itemcode'), p.get('whscode') or p.get('warehousecode'),
+                                    in_stock=name != 'Checkseries')
+            if name == 'GetItemWarehouseSerialStatus_i':
+                return [{'ItemCode': row['ItemCode'], 'SerialNumber': number, 'WarehouseCode': row['WhsCode'],
+                         'QtyInWhs': row['Quantity']} for number, row in rows]
+            return [{'ItemCode': row['ItemCode'], 'DistNumber': number, 'WhsCode': row['WhsCode']}
+                    for number, row in rows]
+
+        if name in ('Item_Validation', 'ItemCode_Validation'):
+            rows = data.serial_rows(p.get('seriel_number'), p.get('item_code'), p.get('whcode'))
+            return [{'ItemCode': row['ItemCode'], 'itemName': data.items_by_code[row['ItemCode']]['ItemName'],
+                     'DistNumber': number, 'WhsCode': row['WhsCode']} for number, row in rows]
+
+        if name == 'Invoise_creation':
+            rows = []
+            for number, row in data.serial_rows(p.get('serial_number')):
+                warehouse = data.warehouse(row['WhsCode'])
+                rows.append({'ItemCode': row['ItemCode'], 'itemName': data.items_by_code[row['ItemCode']]['ItemName'],
+                             'DistNumber': number, 'WhsCode': row['WhsCode'], 'WhsName': warehouse['WarehouseName'],
+                             'BPLName': f"Branch {warehouse['BusinessPlaceID']}", 'BPLid': warehouse['BusinessPlaceID']})
+            return rows
+
+        if name == 'Quantity_Check':
+            item = data.items_by_code.get(p.get('itemcode'))
+            quantity = data.stock.get((p.get('itemcode'), p.get('whcode')), 0)
+            if not item or quantity <= 0:
+                return []
+            return [{'OnHand': quantity, 'ItemCode': item['ItemCode'],
+                     'ManSerNum': 'Y' if item['ManageSerialNumbers'] == 'tYES' else 'N'}]
+
+        if name == 'SO_Line_Stock':
+            order = next((o for o in data.orders if str(o['DocEntry']) == p.get('docentry')), None)
+            rows = []
+            for line in (order or {}).get('DocumentLines', []):
+                item = data.items_by_code[line['ItemCode']]
+                rows.append({'LineNum': line['LineNum'], 'ItemCode': line['ItemCode'],
+                             'WhsCode': line['WarehouseCode'], 'OpenQty': line['OpenQuantity'],
+                             'OnHand': data.stock.get((line['ItemCode'], line['WarehouseCode']), 0.0),
+                             'ManSerNum': 'Y' if item['ManageSerialNumbers'] == 'tYES' else 'N',
+                             'ManBtchNum': 'Y' if item['ManageBatchNumbers'] == 'tYES' else 'N'})
+            return rows
+
+        if name == 'Get_Item':
+            return [{'ItemCode': code, 'ItemName': data.items_by_code[code]['ItemName']}
+                    for (code, whs_code), quantity in sorted(data.stock.items())
+                    if whs_code == p.get('whcode') and quantity > 0]
+
+        if name == 'Item_Stock_Changes':
+            return [{'ItemCode': code, 'WhsCode': whs_code, 'OnHand': float(data.stock.get((code, whs_code), 0))}
+                    for (code, whs_code), moved in sorted(data.stock_moved.items()) if moved >= p.get('since', '')]
+
+        if name == 'Get_SO_Series':
+            return [{'SeriesName': 'Primary', 'Series': 17}]
+
+        if name == 'Get_SO_Details':
+            try:
+                return [{'DocEntry': int(p.get('sonumber', '0'))}]
+            except ValueError:
+                return []
+        return []
+
+    # -- $batch ---------------------------------------------------------
+
+    def _batch(self, content_type, body, session_id):
+        boundary = _boundary(content_type)
+        if not boundary:
+            status, payload = sap_error('Missing multipart boundary')
+            return status, payload, {}
+
+        response_boundary = f"batchresponse_{uuid.uuid4()}"
+        out = []
+        for kind, part in _split_multipart(body.decode('utf-8'), boundary):
+            if kind == 'changeset':
+                out.append(self._changeset(part, response_boundary, session_id))
+            else:
+                out.append(f"--{response_boundary}\r\n" + self._batch_part(part, session_id))
+        out.append(f"--{response_boundary}--\r\n")
+        return 202, ''.join(out), {'Content-Type': f"multipart/mixed;boundary={response_boundary}"}
+
+    def _changeset(self, changeset, response_boundary, session_id):
+        nested_boundary, requests_ = changeset
+        changeset_boundary = f"changesetresponse_{uuid.uuid4()}"
+        parts = []
+        created = []
+        for part in requests_:
+            status, payload = self._batch_request(part, session_id)
+            if status >= 400:
+                # A failed changeset is rolled back and answered with the single error
+                self._rollback(created)
+                return f"--{response_boundary}\r\n" + _http_part(status, payload)
+            created.append(payload)
+            parts.append(f"--{changeset_boundary}\r\n" + _http_part(status, payload))
+        return (f"--{response_boundary}\r\n"
+                f"Content-Type: multipart/mixed;boundary={changeset_boundary}\r\n\r\n"
+                + ''.join(parts) + f"--{changeset_boundary}--\r\n")
+
+    def _rollback(self, created):
+        with self.data.lock:
+            for document in created:
+                if not isinstance(document, dict) or 'DocEntry' not in document:
+                    continue
+                for name, documents in self.data.documents.items():
+                    if document in documents:
+                        documents.remove(document)
+                        for line in document.get('StockTransferLines') or document.get('DocumentLines') or []:
+                            for serial in line.get('SerialNumbers') or []:
+                                row = self.data.serials.get(serial.get('InternalSerialNumber'))
+                                if row is None:
+                                    continue
+                                if name == 'StockTransfers':
+                                    self.data.move_serial(row, line.get('FromWarehouseCode') or document.get('FromWarehouse'))
+                                else:
+                                    row['Quantity'] = 0
+                                    self.data.move_serial(row, row['WhsCode'])
+
+    def _batch_part(self, part, session_id):
+        status, payload = self._batch_request(part, session_id)
+        return _http_part(status, payload)
+
+    def _batch_request(self, part, session_id):
+        request_line, _, rest = part.partition('\n')
+        _, _, body = rest.partition('\n\n')
+        try:
+            method, path, _ = request_line.split(' ', 2)
+        except ValueError:
+            return sap_error(f"Malformed batch request line: {request_line}")
+        resource, _, query = path.split(SERVICE_ROOT + '/', 1)[-1].partition('?')
+        args = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair)
+        status, payload, _ = self.handle(method, resource, args, {}, body.strip().encode('utf-8'),
+                                         session_id, nested=True)
+        return status, payload
+
+
+def _boundary(content_type):
+    for param in content_type.split(';'):
+        param = param.strip()
+        if param.lower().startswith('boundary='):
+            return param.split('=', 1)[1].strip('"')
+    return None
+
+
+def _split_multipart(body, boundary):
+    """Yield ('request', embedded_http) or ('changeset', (boundary, [embedded_http...])) parts"""
+    body = body.replace('\r\n', '\n')
+    for part in body.split(f"--{boundary}")[1:]:
+        if part.startswith('--'):
+            break
+        headers, _, content = part.strip('\n').partition('\n\n')
+        content_type = next((line.split(':', 1)[1].strip() for line in headers.split('\n')
+                             if line.lower().startswith('content-type:')), '')
+        if content_type.lower().startswith('multipart/mixed'):
+            nested = _boundary(content_type)
+            yield 'changeset', (nested, [embedded for _, embedded in _split_multipart(content, nested)])
+        else:
+            yield 'request', content
+
+
+def _http_part(status, payload):
+    reason = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized',
+              404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable'}.get(status, '')
+    body = json.dumps(payload) if payload is not None else ''
+    return ("Content-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json;charset=utf-8\r\n\r\n{body}\r\n")
+
+
+def create_simulator_app(simulator):
+    """Flask app serving the simulator under /b1s/v1"""
+    app = Flask(__name__)
+
+    @app.route(f"{SERVICE_ROOT}/<path:resource>", methods=['GET', 'POST', 'PATCH', 'PUT', 'DELETE'])
+    def service_layer(resource):
+        status, payload, headers = simulator.handle(
+            request.method, resource, request.args.to_dict(), request.headers,
+            request.get_data(), request.cookies.get('B1SESSION'))
+        if isinstance(payload, str):
+            return Response(payload, status=status, headers=headers)
+        body = json.dumps(payload) if payload is not None else ''
+        return Response(body, status=status, headers=headers, mimetype='application/json')
+
+    return app
+
+
+def start_background_server(simulator, host='127.0.0.1', port=0):
+    """Serve the simulator from a daemon thread; returns (server, base_url)"""
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, create_simulator_app(simulator), threaded=True)
+    threading.Thread(target=server.serve_forever, name='sap-simulator', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SAP B1 Service Layer simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=42, help='Dataset seed (default: 42)')
+    parser.add_argument('--serials', type=int, default=20000, help='Serial numbers in stock (default: 20000)')
+    parser.add_argument('--items', type=int, default=200, help='Items in the item master (default: 200)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency added to every request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Uniform +/- jitter on the latency')
+    parser.add_argument('--write-latency-ms', type=float, default=0.0, help='Extra latency per created document')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503')
+    args = parser.parse_args()
+
+    dataset = Dataset(seed=args.seed, items=args.items, serials=args.serials)
+    simulator = ServiceLayerSimulator(dataset, args.latency_ms, args.jitter_ms, args.error_rate,
+                                      args.write_latency_ms, seed=args.seed)
+
+    print("🧪 SAP B1 Service Layer Simulator")
+    print("=" * 50)
+    print(f"Listening on http://{args.host}:{args.port}{SERVICE_ROOT}")
+    print(f"Dataset: {len(dataset.items)} items, {len(dataset.serials)} serials, "
+          f"{len(dataset.warehouses)} warehouses, {len(dataset.bins)} bins")
+    print(f"Latency: {args.latency_ms:.0f} ms +/- {args.jitter_ms:.0f} ms, error rate {args.error_rate:.1%}")
+    create_simulator_app(simulator).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
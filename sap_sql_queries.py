@@ -1,12 +1,20 @@
+import hashlib
+import json
 import requests
 import logging
 import urllib3
+from concurrent.futures import ThreadPoolExecutor
 from credential_loader import load_credentials_from_json, get_credential
+from sap_circuit import prepare_session
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Parallel SQLQueries existence checks during provisioning
+QUERY_CHECK_WORKERS = 5
+
+
 class SAPSQLQueryManager:
-    """Manages SAP B1 SQL Queries - ensures required queries exist on application startup"""
+    """Manages SAP B1 SQL Queries - ensures required queries exist in the company database"""
     
     REQUIRED_QUERIES = [
         {
@@ -20,6 +28,12 @@ class SAPSQLQueryManager:
             "SqlText": "SELECT Distinct T1.\"OnHand\", T0.\"ItemCode\", T0.\"ManSerNum\" FROM \"OITM\" T0  INNER JOIN \"OITW\" T1 ON T0.\"ItemCode\" = T1.\"ItemCode\" WHERE T1.\"OnHand\" >'0' AND  T1.\"WhsCode\" =:whCode AND  T0.\"ItemCode\" =:itemCode",
             "ParamList": "whCode,itemCode"
         },
+        {
+            "SqlCode": "SO_Line_Stock",
+            "SqlName": "SO_Line_Stock",
+            "SqlText": "SELECT T0.\"LineNum\", T0.\"ItemCode\", T0.\"WhsCode\", T0.\"OpenQty\", T1.\"OnHand\", T2.\"ManSerNum\", T2.\"ManBtchNum\" FROM \"RDR1\" T0 INNER JOIN \"OITW\" T1 ON T1.\"ItemCode\" = T0.\"ItemCode\" AND T1.\"WhsCode\" = T0.\"WhsCode\" INNER JOIN \"OITM\" T2 ON T2.\"ItemCode\" = T0.\"ItemCode\" WHERE T0.\"DocEntry\" =:docEntry",
+            "ParamList": "docEntry"
+        },
         {
             "SqlCode": "ItemCode_Validation",
             "SqlName": "ItemCode_Validation",
@@ -59,6 +73,12 @@ class SAPSQLQueryManager:
             "SqlCode": "GetItemWarehouseSerialStatus_i",
             "SqlName": "Get Item Warehouse Serial Status_i",
             "SqlText": "SELECT \"OSRN\".\"ItemCode\", \"OSRN\".\"DistNumber\" AS \"SerialNumber\", \"OSRQ\".\"WhsCode\" AS \"WarehouseCode\", \"OSRQ\".\"Quantity\" AS \"QtyInWhs\" FROM \"OSRN\" INNER JOIN \"OSRQ\" ON \"OSRN\".\"SysNumber\" = \"OSRQ\".\"SysNumber\" AND \"OSRN\".\"ItemCode\" = \"OSRQ\".\"ItemCode\" WHERE \"OSRN\".\"ItemCode\" = :ItemCode AND \"OSRN\".\"DistNumber\" = :SerialNumber AND \"OSRQ\".\"WhsCode\" = :WarehouseCode AND \"OSRQ\".\"Quantity\" > 0"
+        },
+        {
+            "SqlCode": "Item_Stock_Changes",
+            "SqlName": "Item_Stock_Changes",
+            "SqlText": "SELECT DISTINCT T0.\"ItemCode\", T0.\"WhsCode\", T0.\"OnHand\" FROM \"OITW\" T0 INNER JOIN \"OINM\" T1 ON T1.\"ItemCode\" = T0.\"ItemCode\" AND T1.\"Warehouse\" = T0.\"WhsCode\" WHERE T1.\"CreateDate\" >=:since",
+            "ParamList": "since"
         }
     ]
     
@@ -68,10 +88,19 @@ class SAPSQLQueryManager:
         self.username = get_credential(credentials, 'SAP_B1_USERNAME', '')
         self.password = get_credential(credentials, 'SAP_B1_PASSWORD', '')
         self.company_db = get_credential(credentials, 'SAP_B1_COMPANY_DB', '')
-        self.session = requests.Session()
+        self.session = prepare_session(requests.Session())
         self.session.verify = False
         self.session_id = None
         
+    def queries_version(self):
+        """Hash of the required query definitions and target company - changes when either does"""
+        source = json.dumps({
+            'server': self.base_url,
+            'company_db': self.company_db,
+            'queries': self.REQUIRED_QUERIES
+        }, sort_keys=True)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
     def login(self):
         """Login to SAP B1 Service Layer"""
         if not self.base_url or not self.username or not self.password or not self.company_db:
@@ -156,12 +185,15 @@ class SAPSQLQueryManager:
         queries_existing = 0
         queries_failed = 0
         
-        for query_def in self.REQUIRED_QUERIES:
+        # Existence checks are independent GETs - run them concurrently, create missing ones afterwards
+        with ThreadPoolExecutor(max_workers=QUERY_CHECK_WORKERS) as pool:
+            existence = list(pool.map(lambda query_def: self.check_query_exists(query_def['SqlCode']),
+                                      self.REQUIRED_QUERIES))
+        
+        for query_def, exists in zip(self.REQUIRED_QUERIES, existence):
             sql_code = query_def['SqlCode']
             queries_checked += 1
             
-            exists = self.check_query_exists(sql_code)
-            
             if exists is True:
                 queries_existing += 1
                 logging.debug(f"✓ Query '{sql_code}' already exists")
@@ -185,10 +217,14 @@ class SAPSQLQueryManager:
 
 
 def initialize_sap_queries():
-    """Initialize SAP B1 SQL queries on application startup"""
+    """
+    Validate/create the required SAP B1 SQL queries.
+    Returns (success, version) - version identifies the definitions that were verified.
+    """
     try:
         manager = SAPSQLQueryManager()
-        manager.validate_and_create_queries()
+        return manager.validate_and_create_queries(), manager.queries_version()
     except Exception as e:
         logging.error(f"❌ Error initializing SAP SQL queries: {str(e)}")
         logging.warning("⚠️ Application will continue without SAP query validation")
+        return False, None
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Worker Startup Benchmark
+Profiles application import with `python -X importtime` and checks it against a startup budget.
+
+Usage:
+    python startup_benchmark.py                      # profile `import main`, 1000 ms budget
+    python startup_benchmark.py --module app --top 30
+    python startup_benchmark.py --budget-ms 800 --runs 5
+
+The target is imported in a fresh interpreter per run, so the database configured
+for the app must be reachable (app.py performs a connection check on import).
+Exit code is 1 when the median wall-clock import time exceeds the budget.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def run_import(module):
+    """Import module in a fresh interpreter; returns (wall_ms, [(self_us, cumulative_us, depth, name)])"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+
+    if result.returncode != 0:
+        tail = '\n'.join(line for line in result.stderr.splitlines() if not line.startswith('import time:'))[-2000:]
+        raise RuntimeError(f"import {module} failed:\n{tail}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((int(self_us), int(cumulative_us), len(indent) // 2, name))
+    return wall_ms, entries
+
+
+def summarize(entries, top):
+    """Print the slowest imports by cumulative time and the total per top-level package"""
+    print(f"\nTop {top} imports by cumulative time:")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for self_us, cumulative_us, depth, name in sorted(entries, key=lambda e: e[1], reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {'  ' * depth}{name}")
+
+    packages = {}
+    for self_us, cumulative_us, depth, name in entries:
+        root = name.split('.')[0]
+        packages[root] = packages.get(root, 0) + self_us
+
+    print(f"\nSelf time by top-level package (top {top}):")
+    for root, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{self_us / 1000:>10.1f} ms  {root}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile WMS worker import time against a startup budget')
+    parser.add_argument('--module', default='main', help='Module to import (default: main)')
+    parser.add_argument('--runs', type=int, default=3, help='Fresh-interpreter runs (default: 3)')
+    parser.add_argument('--top', type=int, default=20, help='Rows to show in the profile (default: 20)')
+    parser.add_argument('--budget-ms', type=float, default=1000.0,
+                        help='Startup budget for the median wall-clock import (default: 1000)')
+    args = parser.parse_args()
+
+    print("🚀 WMS Startup Benchmark")
+    print("=" * 50)
+    print(f"Module: {args.module}")
+    print(f"Runs: {args.runs}")
+    print(f"Budget: {args.budget_ms:.0f} ms")
+
+    timings = []
+    entries = []
+    try:
+        for run in range(args.runs):
+            wall_ms, entries = run_import(args.module)
+            timings.append(wall_ms)
+            print(f"Run {run + 1}: {wall_ms:.0f} ms")
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(2)
+
+    # Profile of the last (warm file cache) run
+    summarize(entries, args.top)
+
+    median_ms = statistics.median(timings)
+    print("\n" + "=" * 50)
+    print(f"Median import time: {median_ms:.0f} ms (min {min(timings):.0f} ms, max {max(timings):.0f} ms)")
+    if median_ms <= args.budget_ms:
+        print(f"✅ Within startup budget ({args.budget_ms:.0f} ms)")
+    else:
+        print(f"❌ Over startup budget by {median_ms - args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()